@@ -1,6 +1,6 @@
 
 
-# Load Python **packages**
+"""# Load Python **packages**
 """
 
 # @title
@@ -10,8 +10,6 @@ import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
 import scipy
-from tabulate import tabulate
-from scipy.stats import ttest_rel
 
 """# Set up
 ## set options for df display
@@ -20,9 +18,11 @@ from scipy.stats import ttest_rel
 
 # @title
 # set options for data dispaly
-pd.set_option('display.max_rows',None)
-pd.set_option('display.max_columns', None)
-pd.set_option('display.width', None)
+# Bounded so a national facility list is truncated on display; use print_table to page through it
+pd.set_option('display.max_rows', 60)
+pd.set_option('display.min_rows', 20)
+pd.set_option('display.max_columns', 40)
+pd.set_option('display.width', 200)
 
 # @title
 # Connect to G-Drive
@@ -40,813 +40,2503 @@ creds, _ = default()
 
 gc = gspread.authorize(creds)
 
-"""# Read and process EmONC Knowledge Data"""
+"""# Pipeline tracing
+Wall time, CPU time, peak memory and row counts for each named stage of a run
+"""
 
 # @title
-# Provide url of the G-Sheet where data is
-# googlesheet ID truncated for data protection purposes
-sheet_url = 'https://docs.google.com/spreadsheets/d/.....'
+# Stage tracer
+import os
+import json
+import time
+import threading
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+# Flip on to trace this run; a disabled tracer hands out a shared no-op context.
+# TRACE_MEMORY adds per-stage peak memory from tracemalloc, which slows allocation-heavy stages
+# several times over, so its wall times are not comparable with an untraced run: use a separate run.
+TRACE_PIPELINE = False
+TRACE_MEMORY = False
+
+class StageTracer:
+    def __init__(self, enabled=False, memory=False):
+        self.enabled = enabled
+        self.memory = memory
+        self.records = []
+        self._lock = threading.Lock()
+        self._open = []
+        self._started = False
+        self._origin = time.perf_counter()
+        self._null = nullcontext({})
+
+    # Use as `with tracer.stage('fetch', worksheet=name) as stage: ...; stage['rows'] = len(df)`.
+    # Extra keyword arguments are kept with the record and shown in the Chrome trace.
+    def stage(self, name, rows=None, **args):
+        if not self.enabled:
+            return self._null
+        return self._stage(name, rows, args)
+
+    def _peak_since_last_mark(self):
+        # tracemalloc has one process-wide peak, so every open stage takes the
+        # peak seen since the last mark before it is reset for the next window
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        for record in self._open:
+            record['_peak'] = max(record['_peak'], peak)
+        return current
+
+    @contextmanager
+    def _stage(self, name, rows, args):
+        record = {'stage': name, 'rows': rows, **args, 'thread': threading.current_thread().name}
+        if self.memory:
+            with self._lock:
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                    self._started = True
+                record['_start_mem'] = record['_peak'] = self._peak_since_last_mark()
+                self._open.append(record)
+        start, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield record
+        finally:
+            # CPU time is that of the thread running the stage; work handed to pools is not counted
+            record['wall_s'] = round(time.perf_counter() - start, 4)
+            record['cpu_s'] = round(time.thread_time() - cpu, 4)
+            record['start_s'] = round(start - self._origin, 6)
+            with self._lock:
+                if self.memory:
+                    self._peak_since_last_mark()
+                    self._open.remove(record)
+                    record['peak_mb'] = round((record.pop('_peak') - record.pop('_start_mem')) / 2**20, 2)
+                    if not self._open and self._started:
+                        tracemalloc.stop()
+                        self._started = False
+                self.records.append(record)
+
+    def reset(self):
+        self.records = []
+        self._origin = time.perf_counter()
+
+    def to_frame(self):
+        return pd.DataFrame(self.records)
+
+    # Total time, memory and rows per stage name, slowest first
+    def summary(self):
+        if not self.records:
+            return pd.DataFrame()
+        df = self.to_frame()
+        agg = {'calls': ('wall_s', 'size'), 'wall_s': ('wall_s', 'sum'), 'cpu_s': ('cpu_s', 'sum'),
+               'rows': ('rows', 'sum')}
+        if 'peak_mb' in df:
+            agg['peak_mb'] = ('peak_mb', 'max')
+        return df.groupby('stage').agg(**agg).sort_values('wall_s', ascending=False)
+
+    # One JSON line per stage, appended so runs can be compared
+    def save_json(self, path, run=None):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'a') as f:
+            f.writelines(json.dumps({**record, 'run': run}, default=str) + '\n' for record in self.records)
+
+    # Chrome trace event format, viewable in chrome://tracing or Perfetto
+    def save_chrome_trace(self, path):
+        threads = {}
+        events = []
+        for record in self.records:
+            tid = threads.setdefault(record['thread'], len(threads))
+            events.append({'name': record['stage'], 'ph': 'X', 'pid': 0, 'tid': tid,
+                           'ts': record['start_s'] * 1e6, 'dur': record['wall_s'] * 1e6,
+                           'args': {k: v for k, v in record.items() if k not in ('stage', 'thread', 'start_s')}})
+        events += [{'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': tid, 'args': {'name': thread}}
+                   for thread, tid in threads.items()]
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f, default=str)
+
+tracer = StageTracer(enabled=TRACE_PIPELINE, memory=TRACE_MEMORY)
+
+"""# Worksheet snapshot cache
+Worksheets are kept as parquet snapshots on the mounted drive so reruns read from disk instead of the Sheets API
+"""
 
 # @title
-# Read in moh curriculum baseline data from google drive
-spreadsheet = gc.open_by_url(sheet_url)
-
-# List all worksheets
-spreadsheet.worksheets()
+# Local snapshot cache for worksheet reads
+import re
+
+# Snapshots live on the mounted drive so they survive Colab restarts
+SNAPSHOT_DIR = os.environ.get('EMONC_SNAPSHOT_DIR', '/content/gdrive/MyDrive/emonc_snapshots')
+
+# Convert get_all_records() output (fetched as strings) to columns that parquet can store. Schema
+# columns are left as strings for parse_worksheet to convert once; only the rest need their types inferred
+def records_to_frame(records, schema=None):
+    df = pd.DataFrame(records)
+    return type_columns(df, [col for col in df.columns if col not in (schema or {})])
+
+def type_columns(df, columns=None):
+    for col in df.columns if columns is None else columns:
+        values = df[col]
+        if pd.api.types.is_numeric_dtype(values):
+            continue
+        filled = values[values != '']
+        if len(filled) and pd.to_numeric(filled, errors='coerce').notna().all():
+            # numbers with blank cells, e.g. an unanswered Likert item
+            df[col] = pd.to_numeric(values.replace('', np.nan))
+        else:
+            df[col] = values.astype(str)
+    return df
+
+# Worksheet metadata for each spreadsheet, fetched with a single call per run,
+# and the time of the spreadsheet's last edit, fetched from Drive alongside it
+_worksheet_listing = {}
+_spreadsheet_modified = {}
+
+def list_worksheets(spreadsheet, refresh=False):
+    if refresh or spreadsheet.id not in _worksheet_listing:
+        _worksheet_listing[spreadsheet.id] = {ws.title: ws for ws in spreadsheet.worksheets()}
+        modified = spreadsheet_modified(spreadsheet)
+        own = _own_write(spreadsheet.id)
+        _spreadsheet_modified[spreadsheet.id] = own['before'] if own and own['after'] == modified else modified
+    return _worksheet_listing[spreadsheet.id]
+
+# The notebook's own writes to a spreadsheet (the summary export) change its last update time but no
+# survey data. The time after the latest such write is kept, per spreadsheet and on the drive, with
+# the time it replaced; while the spreadsheet is untouched since, the earlier time stays the change
+# signal, so publishing into the survey workbook invalidates neither snapshots nor the query service.
+_own_writes = {}
+
+def _own_writes_path(spreadsheet_id):
+    return os.path.join(SNAPSHOT_DIR, str(spreadsheet_id), 'own_writes.json')
+
+def _own_write(spreadsheet_id):
+    if spreadsheet_id not in _own_writes and os.path.exists(_own_writes_path(spreadsheet_id)):
+        with open(_own_writes_path(spreadsheet_id)) as f:
+            _own_writes[spreadsheet_id] = json.load(f)
+    return _own_writes.get(spreadsheet_id)
+
+# Call right after writing, with the change signal read before the write. An edit by someone else
+# between that read and the write is only seen at the next change.
+def record_own_write(spreadsheet, before):
+    _own_writes[spreadsheet.id] = {'after': spreadsheet_modified(spreadsheet), 'before': before}
+    os.makedirs(os.path.dirname(_own_writes_path(spreadsheet.id)), exist_ok=True)
+    with open(_own_writes_path(spreadsheet.id), 'w') as f:
+        json.dump(_own_writes[spreadsheet.id], f)
+    _spreadsheet_modified[spreadsheet.id] = before
+
+# gspread 6 has get_lastUpdateTime(); gspread 5 exposes the same Drive field as a property
+def spreadsheet_modified(spreadsheet):
+    get = getattr(spreadsheet, 'get_lastUpdateTime', None)
+    return get() if callable(get) else spreadsheet.lastUpdateTime
+
+# Sheets has no per-worksheet revision. The spreadsheet's last update time changes with any cell edit
+# or appended row, including rows added inside the sheet's existing grid, and the worksheet's id and
+# grid size tell a snapshot of a recreated or resized sheet apart.
+def snapshot_key(spreadsheet, worksheet):
+    return {'spreadsheet_id': spreadsheet.id,
+            'modified': _spreadsheet_modified.get(spreadsheet.id),
+            'worksheet': worksheet.title,
+            'worksheet_id': worksheet.id,
+            'row_count': worksheet.row_count,
+            'col_count': worksheet.col_count}
+
+def snapshot_path(key):
+    name = re.sub(r'[^A-Za-z0-9_-]+', '_', key['worksheet'])
+    return os.path.join(SNAPSHOT_DIR, str(key['spreadsheet_id']), name)
+
+# Read a worksheet as a DataFrame, refetching it only when its snapshot is stale
+def read_worksheet(spreadsheet, name, refresh=False, schema=None):
+    worksheet = list_worksheets(spreadsheet)[name]
+    key = snapshot_key(spreadsheet, worksheet)
+    path = snapshot_path(key)
+    if not refresh and os.path.exists(path + '.json') and os.path.exists(path + '.parquet'):
+        with open(path + '.json') as f:
+            if json.load(f) == key:
+                with tracer.stage('read_snapshot', worksheet=name) as stage:
+                    df = pd.read_parquet(path + '.parquet')
+                    stage['rows'] = len(df)
+                return df
+
+    with tracer.stage('get_all_records', worksheet=name) as stage:
+        # Unconverted cell text, as get_values returns it on the streaming path
+        records = worksheet.get_all_records(numericise_ignore=['all'])
+        stage['rows'] = len(records)
+    with tracer.stage('records_to_frame', rows=len(records), worksheet=name):
+        df = records_to_frame(records, schema)
+    with tracer.stage('write_snapshot', rows=len(df), worksheet=name):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write the data before the key so an interrupted write is treated as stale
+        df.to_parquet(path + '.parquet', index=False)
+        with open(path + '.json', 'w') as f:
+            json.dump(key, f)
+    return df
+
+"""# Result cache
+Analysis results memoized on a content hash of their inputs, in memory and optionally on disk
+"""
 
 # @title
-# Access EmONC Knowledge worksheet and convert it to a data frame
-EmONC_Knowledge = spreadsheet.worksheet('Knowledge')
-EmONC_Knowledge = pd.DataFrame(EmONC_Knowledge.get_all_records())
-EmONC_Knowledge.sample(3)
-
-"""Specific County Selector
-
+# Memoization of analysis functions
+import sys
+import pickle
+import inspect
+import hashlib
+import functools
+from collections import OrderedDict
+
+RESULT_CACHE_BYTES = 512 * 2**20
+# Persist results next to the snapshots so a new runtime starts warm
+PERSIST_RESULTS = False
+RESULT_CACHE_DIR = os.path.join(SNAPSHOT_DIR, 'results')
+
+# Feed a content fingerprint of an argument into a hash: frames by their hashed rows, index,
+# columns and dtypes, arrays by their bytes, containers element by element
+def _update_hash(digest, value):
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        digest.update(type(value).__name__.encode())
+        digest.update(pd.util.hash_pandas_object(value, index=True).to_numpy().tobytes())
+        if isinstance(value, pd.DataFrame):
+            digest.update(repr(list(zip(value.columns, value.dtypes.astype(str)))).encode())
+        else:
+            digest.update(repr((value.name, str(value.dtype))).encode())
+    elif isinstance(value, np.ndarray):
+        digest.update(repr((value.shape, str(value.dtype))).encode())
+        digest.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, dict):
+        digest.update(b'{')
+        for key in sorted(value, key=repr):
+            _update_hash(digest, key)
+            _update_hash(digest, value[key])
+        digest.update(b'}')
+    elif isinstance(value, (list, tuple)):
+        digest.update(b'[' if isinstance(value, list) else b'(')
+        for item in value:
+            _update_hash(digest, item)
+        digest.update(b']')
+    elif value is None or isinstance(value, (str, bytes, int, float, bool, np.generic)):
+        digest.update(repr(value).encode())
+    else:
+        raise TypeError(f"Cannot fingerprint {type(value).__name__}")
+
+def _result_nbytes(value):
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return int(np.sum(value.memory_usage(deep=True)))
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (list, tuple)):
+        return sum(map(_result_nbytes, value))
+    if isinstance(value, dict):
+        return sum(map(_result_nbytes, value.values()))
+    return sys.getsizeof(value)
+
+def _copy_result(value):
+    if isinstance(value, (pd.DataFrame, pd.Series, np.ndarray)):
+        return value.copy()
+    if isinstance(value, (list, tuple)):
+        return type(value)(map(_copy_result, value))
+    if isinstance(value, dict):
+        # dict.copy keeps the mapping type (OrderedDict, defaultdict)
+        copied = value.copy()
+        copied.update((key, _copy_result(item)) for key, item in value.items())
+        return copied
+    return value
+
+class ResultCache:
+    # Least recently used results are evicted once their total size passes max_bytes.
+    # With a path, every result is also pickled there and read back on a memory miss.
+    def __init__(self, max_bytes=RESULT_CACHE_BYTES, path=None):
+        self.max_bytes = max_bytes
+        self.path = path
+        self.enabled = True
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.pkl')
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, self._entries[key][0]
+        if self.path and os.path.exists(self._file(key)):
+            with open(self._file(key), 'rb') as f:
+                value = pickle.load(f)
+            self.put(key, value, persist=False)
+            self.hits += 1
+            return True, value
+        self.misses += 1
+        return False, None
+
+    def put(self, key, value, persist=True):
+        nbytes = _result_nbytes(value)
+        with self._lock:
+            if key in self._entries:
+                self._nbytes -= self._entries.pop(key)[1]
+            if nbytes <= self.max_bytes:
+                self._entries[key] = (value, nbytes)
+                self._nbytes += nbytes
+            while self._nbytes > self.max_bytes:
+                self._nbytes -= self._entries.popitem(last=False)[1][1]
+        if persist and self.path:
+            os.makedirs(self.path, exist_ok=True)
+            # Write to a temporary file first so a reader never loads a partial pickle
+            tmp = f"{self._file(key)}.{threading.get_ident()}.tmp"
+            with open(tmp, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self._file(key))
+
+    def clear(self, disk=False):
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+        if disk and self.path and os.path.isdir(self.path):
+            for name in os.listdir(self.path):
+                if name.endswith('.pkl'):
+                    os.remove(os.path.join(self.path, name))
+
+    def info(self):
+        return {'entries': len(self._entries), 'bytes': self._nbytes, 'hits': self.hits, 'misses': self.misses}
+
+    # Decorator: key on the function name and code (see _update_code_hash) plus a content hash of every
+    # bound argument, so a changed frame, parameter (county, survey, threshold, ...), function body,
+    # constant or helper it calls is a different entry.
+    # Callers get a copy of cached frames, so mutating a result does not change the cache.
+    def memoize(self, fn):
+        signature = inspect.signature(fn)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not self.enabled:
+                return fn(*args, **kwargs)
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            digest = hashlib.sha1(f"{fn.__module__}.{fn.__qualname__}".encode())
+            _update_code_hash(digest, fn)
+            try:
+                _update_hash(digest, bound.arguments)
+            except TypeError:
+                return fn(*args, **kwargs)
+            key = digest.hexdigest()
+            found, value = self.get(key)
+            if not found:
+                value = fn(*args, **kwargs)
+                self.put(key, value)
+            return _copy_result(value)
+        wrapper.cache = self
+        return wrapper
+
+# Bytecode and constants of a function and of the code nested in it, the values of plain module-level
+# constants it reads, and the same for every function of its module that it calls, followed
+# transitively. Nested code and frozensets are hashed by content, since their repr is not stable
+# between sessions.
+def _update_code_hash(digest, fn, seen=None):
+    seen = set() if seen is None else seen
+    seen.add(fn)
+    codes = [fn.__code__]
+    while codes:
+        code = codes.pop()
+        digest.update(code.co_code)
+        for const in code.co_consts:
+            if inspect.iscode(const):
+                codes.append(const)
+            else:
+                digest.update(repr(sorted(const, key=repr) if isinstance(const, frozenset) else const).encode())
+        for name in code.co_names:
+            value = fn.__globals__.get(name)
+            value = getattr(value, '__wrapped__', value)
+            if inspect.isfunction(value) and value.__module__ == fn.__module__ and value not in seen:
+                digest.update(name.encode())
+                _update_code_hash(digest, value, seen)
+            elif isinstance(value, (bool, int, float, str)):
+                digest.update(f"{name}={value!r}".encode())
+
+result_cache = ResultCache(RESULT_CACHE_BYTES, path=RESULT_CACHE_DIR if PERSIST_RESULTS else None)
+
+"""# Instrument registry
+Each instrument declares its worksheets, items, pass rule and KPI target once;
+ingest, the score cube, the reports, the chart pack and the query service are all driven from here
 """
 
-EmONC_Knowledge.columns
-
 # @title
-# Select columns of interest
-EmONC_Knowledge_df=EmONC_Knowledge[['county','Facility','Survey',\
-                     'signs_obstructed_labor', 'risks_factor_obs_labor', 'medications_hip',\
-                     'pre_eclampsia_risk_factors', 'shoulder_dystocia_management', \
-                    'shoulder_dystocia_maneuvers', 'definitive_cord_prolapse_mx', \
-                    'cord_prolapse_dx', 'inhibitors_of_rmc', 'categories_of_disrespect', \
-                    'second_stage_labor', 'newborn_care', 'secondary_pph', 'maternal_cpr', \
-                    'antepartum_hemorrhage', 'complication_hypovolemic_shock', 'ipc_handling_sharps',\
-                    'ipc_waste_segregation', 'neonatal_resusc_reassessemnts', 'chest_compression_nnr',\
-                    'labor_monitoring_2nd_stage', 'fetal_compromise', 'fetal_compromise_monitoring', \
-                    'mpdsr','Score']]
-
-EmONC_Knowledge_df = EmONC_Knowledge_df[EmONC_Knowledge_df['county']=='Muranga']
-EmONC_Knowledge_df = EmONC_Knowledge_df[EmONC_Knowledge_df['Survey']=='Endline']
-EmONC_Knowledge_df.sample(4)
+# Instruments and their configuration
+from dataclasses import dataclass, field
+
+knowledge_items = ['signs_obstructed_labor', 'risks_factor_obs_labor', 'hip_medications',\
+                   'pre_eclampsia_risk_factors', 'shoulder_dystocia_management', \
+                   'shoulder_dystocia_maneuvers', 'definitive_cord_prolapse_mx', \
+                   'cord_prolapse_dx', 'inhibitors_of_rmc', 'categories_of_disrespect', \
+                   'second_stage_labor', 'newborn_care', 'secondary_pph', 'maternal_cpr', \
+                   'antepartum_hemorrhage', 'complication_hypovolemic_shock', 'ipc_handling_sharps',\
+                   'ipc_waste_segregation', 'neonatal_resusc_reassessemnts', 'chest_compression_nnr',\
+                   'labor_monitoring_2nd_stage', 'fetal_compromise', 'fetal_compromise_monitoring', \
+                   'mpdsr']
+
+nnr_items = ['Equipment_check', 'Dry_and_stimulate', 'ABC_assessment', 'Firm_seal', '40_60th_breaths', \
+             'Chest_rise', 'Reassessment', 'Ratio_Vent_Compression', 'Oxygen', 'Message_to_mother']
+
+pc_items = ['Postpartum_hemorrhage', 'Hypertension_in_pregnancy', \
+            'Shoulder_dystocia', 'Birth_Asphyxia', 'Antepartum_hemorrhage']
+
+@dataclass
+class Instrument:
+    name: str
+    worksheet: str                # every survey wave, one row per assessment
+    baseline_worksheet: str       # earlier baseline scores (Facility, Score and optionally mentee_id)
+    items: list                   # item columns, named as in the cube
+    passed: object                # pass rule: callable on an item column, True where the item was passed
+    kpi_target: float
+    item_kind: str = 'category'   # schema kinds of the item and Score columns (see WORKSHEET_SCHEMAS)
+    score_kind: str = 'score'
+    label: str = None             # name used in chart titles and axes
+    renames: dict = field(default_factory=dict)   # worksheet column -> cube column
+    min_score: float = None       # rows scoring at or below this are not assessments and are dropped
+    excluded_mentees: tuple = ()  # test records, dropped from both worksheets
+
+    def __post_init__(self):
+        self.label = self.label or self.name
+
+    # Schemas of the instrument's worksheets, in the worksheets' own column names
+    def schemas(self):
+        sheet_names = {new: old for old, new in self.renames.items()}
+        columns = {'County': 'category', 'Facility': 'category', 'Survey': 'category',
+                   **dict.fromkeys(self.items, self.item_kind), 'Score': self.score_kind}
+        return {self.worksheet: {sheet_names.get(col, col): kind for col, kind in columns.items()},
+                self.baseline_worksheet: {'Facility': 'category', 'Score': 'score'}}
+
+INSTRUMENTS = {instrument.name: instrument for instrument in [
+    Instrument('Knowledge', 'Knowledge', 'Knowledge Pre', knowledge_items,
+               passed=lambda v: v == 'Correct', kpi_target=80, item_kind='correct', score_kind='percent',
+               renames={'county': 'County', 'medications_hip': 'hip_medications'},
+               excluded_mentees=(721274871,)),
+    Instrument('NNR', 'NNR', 'NNR Pre', nnr_items,
+               passed=lambda v: v == 'Yes', kpi_target=90, item_kind='yesno', label='NNR Skill', min_score=0),
+    # At least 4 in confidence rating
+    Instrument('Provider Confidence', 'Provider Confidence', 'PC Pre', pc_items,
+               passed=lambda v: v > 3, kpi_target=80, item_kind='likert', score_kind='percent'),
+]}
+
+instrument_items = {name: instrument.items for name, instrument in INSTRUMENTS.items()}
+instrument_pass_rules = {name: instrument.passed for name, instrument in INSTRUMENTS.items()}
+instrument_worksheets = {name: instrument.worksheet for name, instrument in INSTRUMENTS.items()}
+
+"""# Worksheet schemas
+Column types for every worksheet, parsed in one pass while loading
+"""
 
 # @title
-# rename columns
-column_mapper = {'county': 'County',
-                 'medications_hip': 'hip_medications'}
-
-EmONC_Knowledge_df.rename(columns=column_mapper, inplace=True)
-
-"""# EmONC Knowledge Analysis"""
+# Declarative per-worksheet schemas
+# Column kinds:
+#   'percent'  - '87.5%' or 87.5 -> float32
+#   'score'    - numeric score -> float32
+#   'likert'   - rating 1-5 -> int8 (Int8 when some ratings are blank)
+#   'category' - free labels such as County and Facility -> category
+#   answer kinds in ANSWER_CATEGORIES - category with only the allowed values; any other cell is invalid
+ANSWER_CATEGORIES = {
+    'correct': ['Incorrect', 'Correct'],
+    'yesno': ['No', 'Yes'],
+    'completion': ['Incomplete', 'Complete'],
+    'match': ['Not a match', 'Match'],
+}
+
+WORKSHEET_SCHEMAS = {
+    **{sheet: schema for instrument in INSTRUMENTS.values() for sheet, schema in instrument.schemas().items()},
+    'CME Completion': {'Status': 'completion', 'mentee match': 'match'},
+    'Drill Completion': {'Status': 'completion', 'mentee match': 'match'},
+}
+
+def _is_blank(values):
+    return values.isna() | values.astype(str).str.strip().isin(['', 'nan', 'None'])
+
+# Parse one column to its schema kind; returns the parsed column and a mask of invalid cells
+def parse_column(values, kind):
+    if kind == 'category':
+        return values.astype('category'), np.zeros(len(values), dtype=bool)
+    blank = _is_blank(values)
+    if kind in ANSWER_CATEGORIES:
+        # Misspelt or padded answers ('Corect', 'yes ') are reported and left blank, not scored as wrong
+        answers = pd.Series(pd.Categorical(values.where(~blank), categories=ANSWER_CATEGORIES[kind]),
+                            index=values.index)
+        return answers, (answers.isna() & ~blank).to_numpy()
+    if kind == 'percent' and not pd.api.types.is_numeric_dtype(values):
+        values = values.astype(str).str.rstrip('%')
+    numbers = pd.to_numeric(values, errors='coerce')
+    if kind == 'likert':
+        numbers = numbers.where(numbers.between(1, 5) & (numbers % 1 == 0))
+    invalid = (numbers.isna() & ~blank).to_numpy()
+    if kind == 'likert':
+        return numbers.astype('Int8' if numbers.isna().any() else 'int8'), invalid
+    if kind in ('percent', 'score'):
+        return numbers.astype('float32'), invalid
+    raise ValueError(f"Unknown column kind: {kind}")
+
+# Apply a worksheet schema to a frame.
+# Returns the typed frame and one row per invalid cell (sheet row numbers count the header row;
+# first_row is the sheet row of the frame's first row).
+def parse_worksheet(df, schema, name=None, first_row=2):
+    parsed, invalid = {}, []
+    for col, kind in (schema or {}).items():
+        if col not in df:
+            continue
+        parsed[col], bad = parse_column(df[col], kind)
+        if bad.any():
+            invalid.append(pd.DataFrame({'Worksheet': name, 'Column': col, 'Expected': kind,
+                                         'Row': np.flatnonzero(bad) + first_row,
+                                         'Value': df[col].to_numpy()[bad]}))
+    report = pd.concat(invalid, ignore_index=True) if invalid else \
+        pd.DataFrame(columns=['Worksheet', 'Column', 'Expected', 'Row', 'Value'])
+    return df.assign(**parsed), report
 
 # @title
-# Convert % Score to a float
-EmONC_Knowledge_df['Score'] = EmONC_Knowledge_df['Score'].str.rstrip('%').astype(float)
-# Check data types of columns
-EmONC_Knowledge_df.dtypes
+# Fetch every survey worksheet in one ingestion stage
+from concurrent.futures import ThreadPoolExecutor
+
+SURVEY_WORKSHEETS = [sheet for instrument in INSTRUMENTS.values()
+                     for sheet in (instrument.worksheet, instrument.baseline_worksheet)] \
+                    + ['CME Completion', 'Drill Completion']
+
+# Stale worksheets are fetched on parallel threads, so ingest takes about as long
+# as the slowest sheet instead of the sum of every round trip.
+# Each sheet is parsed with its schema as it loads, and the analysis cells get a dict
+# of typed DataFrames so they do no I/O. Invalid cells are collected per worksheet in `invalid_cells`.
+def ingest_worksheets(spreadsheet, names=SURVEY_WORKSHEETS, max_workers=None, refresh=False,
+                      schemas=WORKSHEET_SCHEMAS, invalid_cells=None):
+    def load(name):
+        df = read_worksheet(spreadsheet, name, refresh=refresh, schema=schemas.get(name))
+        with tracer.stage('parse_worksheet', rows=len(df), worksheet=name):
+            return parse_worksheet(df, schemas.get(name), name)
+
+    with tracer.stage('ingest', worksheets=len(names)):
+        with tracer.stage('list_worksheets'):
+            list_worksheets(spreadsheet, refresh=True)
+        with ThreadPoolExecutor(max_workers=max_workers or max(1, len(names))) as pool:
+            loaded = dict(zip(names, pool.map(load, names)))
+    if invalid_cells is not None:
+        invalid_cells.update({name: report for name, (df, report) in loaded.items() if len(report)})
+    return {name: df for name, (df, report) in loaded.items()}
 
 # @title
-# Select only facilities that have closed data collection
-
-EmONC_Knowledge_df.Facility.unique()
+# Stream large worksheets in row chunks
+from gspread.utils import rowcol_to_a1
+
+STREAM_CHUNK_ROWS = 50_000
+
+# Yield a worksheet as typed frames of up to chunk_rows rows, starting at sheet row start_row.
+# Each chunk is one get_values call over an A1 row range, converted and parsed with the schema
+# as soon as it arrives, so neither the full list of records nor the full raw frame is ever built.
+# Chunk indexes continue from one chunk to the next, as if the sheet had been read whole.
+def iter_worksheet_chunks(worksheet, chunk_rows=STREAM_CHUNK_ROWS, schema=None, start_row=2, invalid_cells=None):
+    header = worksheet.row_values(1)
+    width = len(header)
+    for first in range(start_row, worksheet.row_count + 1, chunk_rows):
+        last = min(first + chunk_rows - 1, worksheet.row_count)
+        with tracer.stage('get_values', worksheet=worksheet.title) as stage:
+            rows = worksheet.get_values(f"{rowcol_to_a1(first, 1)}:{rowcol_to_a1(last, width)}")
+            stage['rows'] = len(rows)
+        if not rows:
+            return
+        with tracer.stage('parse_chunk', rows=len(rows), worksheet=worksheet.title):
+            # The API trims trailing blank cells from each row
+            df = pd.DataFrame([row + [''] * (width - len(row)) for row in rows], columns=header,
+                              index=pd.RangeIndex(first - 2, first - 2 + len(rows)))
+            # Schema columns are parsed from the raw strings; only the rest need their types inferred
+            df = type_columns(df, [col for col in header if col not in (schema or {})])
+            df, report = parse_worksheet(df, schema, worksheet.title, first_row=first)
+        if invalid_cells is not None and len(report):
+            invalid_cells.setdefault(worksheet.title, []).append(report)
+        yield df
+        # Trailing blank rows are not returned either, so a short chunk is the end of the data
+        if len(rows) < last - first + 1:
+            return
+
+"""# Survey store
+Every worksheet in an indexed SQLite database, so filtered slices are index lookups instead of full-frame masks
+"""
 
 # @title
-#summary of Score
-EmONC_Knowledge_df['Score']\
-.describe()\
-.round(1)
+# Indexed embedded store for all instruments, waves and completion data
+import sqlite3
+import tempfile
+
+# Local disk rather than the Drive mount, where SQLite file locking is unreliable
+SURVEY_STORE_DIR = tempfile.gettempdir()
+# Columns indexed in every table that has them (matched case-insensitively)
+STORE_INDEX_COLUMNS = ['county', 'facility', 'survey', 'mentee_id']
+_SQL_OPERATORS = {'=', '!=', '<', '<=', '>', '>=', 'IN', 'NOT IN'}
+
+def _table_name(worksheet):
+    return re.sub(r'[^a-z0-9]+', '_', worksheet.lower()).strip('_')
+
+def _quote(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+def _sql_value(value):
+    return value.item() if isinstance(value, np.generic) else value
+
+class SurveyStore:
+    # One table per worksheet; _sync remembers how many rows of each were stored and a digest of them
+    def __init__(self, path):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            # A store from before prefix digests were kept is rewritten on its next sync
+            if 'prefix' not in [row[1] for row in self._conn.execute('PRAGMA table_info(_sync)')]:
+                self._conn.execute('DROP TABLE IF EXISTS _sync')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS _sync (worksheet TEXT PRIMARY KEY, rows INTEGER, prefix TEXT)')
+
+    def _columns(self, worksheet):
+        return [row[1] for row in self._conn.execute(f"PRAGMA table_info({_quote(_table_name(worksheet))})")]
+
+    def _create_indexes(self, worksheet, columns):
+        table = _table_name(worksheet)
+        by_name = {col.lower(): col for col in columns}
+        indexed = [[by_name[col]] for col in STORE_INDEX_COLUMNS if col in by_name]
+        if 'county' in by_name and 'survey' in by_name:
+            indexed.append([by_name['county'], by_name['survey']])
+        for cols in indexed:
+            name = _quote(f"ix_{table}_{'_'.join(_table_name(col) for col in cols)}")
+            self._conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {_quote(table)} ({', '.join(map(_quote, cols))})")
+
+    # Bring a worksheet's table in line with its frame. Rows appended since the last sync are
+    # inserted; a change to any stored row, or to the columns, rewrites the table.
+    # Returns the number of rows written.
+    def sync(self, worksheet, df):
+        table = _table_name(worksheet)
+        with self._lock:
+            synced = self._conn.execute('SELECT rows, prefix FROM _sync WHERE worksheet = ?', (worksheet,)).fetchone()
+            start = synced[0] if synced else 0
+            if synced and (start > len(df) or list(df.columns) != self._columns(worksheet)
+                           or synced[1] != _prefix_fingerprint(df, start)):
+                start = 0
+            if start == 0:
+                self._conn.execute(f"DROP TABLE IF EXISTS {_quote(table)}")
+            df.iloc[start:].to_sql(table, self._conn, if_exists='append', index=False, chunksize=50_000)
+            self._create_indexes(worksheet, df.columns)
+            self._conn.execute('INSERT OR REPLACE INTO _sync VALUES (?, ?, ?)',
+                               (worksheet, len(df), _prefix_fingerprint(df, len(df))))
+            self._conn.commit()
+        return len(df) - start
+
+    def sync_all(self, sheets):
+        return {worksheet: self.sync(worksheet, df) for worksheet, df in sheets.items()}
+
+    # Number of rows stored for a worksheet
+    def rows(self, worksheet):
+        with self._lock:
+            synced = self._conn.execute('SELECT rows FROM _sync WHERE worksheet = ?', (worksheet,)).fetchone()
+        return synced[0] if synced else 0
+
+    def columns(self, worksheet):
+        with self._lock:
+            return self._columns(worksheet)
+
+    def drop(self, worksheet):
+        with self._lock:
+            self._conn.execute(f"DROP TABLE IF EXISTS {_quote(_table_name(worksheet))}")
+            self._conn.execute('DELETE FROM _sync WHERE worksheet = ?', (worksheet,))
+            self._conn.commit()
+
+    # Append a chunk streamed from a worksheet, in sheet order after the rows already stored.
+    # There is no whole frame to digest, so a later sync() of the full sheet rewrites the table once.
+    def append(self, worksheet, chunk):
+        table = _table_name(worksheet)
+        with self._lock:
+            synced = self._conn.execute('SELECT rows FROM _sync WHERE worksheet = ?', (worksheet,)).fetchone()
+            chunk.to_sql(table, self._conn, if_exists='append', index=False, chunksize=50_000)
+            self._create_indexes(worksheet, chunk.columns)
+            self._conn.execute('INSERT OR REPLACE INTO _sync VALUES (?, ?, NULL)',
+                               (worksheet, (synced[0] if synced else 0) + len(chunk)))
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def query(self, sql, params=()):
+        with self._lock:
+            return pd.read_sql_query(sql, self._conn, params=list(params))
+
+    # Rows of a worksheet matching every condition, in sheet order, typed with the worksheet schema.
+    # Keyword filters test equality (or membership for a list), e.g. County='Muranga', Survey='Endline';
+    # `where` takes (column, operator, value) triples such as ('Score', '>', 0).
+    # Rows keep their position in the worksheet as index, as in a frame of the whole sheet: tables are
+    # only ever appended to in sheet order, so that is rowid - 1.
+    def select(self, worksheet, columns=None, where=(), **equals):
+        by_name = {col.lower(): col for col in self._columns(worksheet)}
+        if not by_name:
+            raise KeyError(f"No table for worksheet {worksheet!r}")
+        conditions = [(col, 'IN' if isinstance(value, (list, tuple, set)) else '=', value)
+                      for col, value in equals.items()] + list(where)
+        clauses, params = [], []
+        for col, op, value in conditions:
+            op = op.upper()
+            if op not in _SQL_OPERATORS:
+                raise ValueError(f"Unsupported operator: {op}")
+            col = _quote(by_name[col.lower()])
+            if op in ('IN', 'NOT IN'):
+                value = list(value)
+                clauses.append(f"{col} {op} ({', '.join('?' * len(value))})")
+                params += [_sql_value(v) for v in value]
+            else:
+                clauses.append(f"{col} {op} ?")
+                params.append(_sql_value(value))
+        selected = ', '.join(_quote(by_name[col.lower()]) for col in columns) if columns else '*'
+        sql = f"SELECT {selected} FROM {_quote(_table_name(worksheet))}"
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        df = self.query(sql.replace('SELECT ', 'SELECT rowid - 1 AS _position, ', 1) + ' ORDER BY rowid', params)
+        df = df.set_index('_position').rename_axis(None)
+        return parse_worksheet(df, WORKSHEET_SCHEMAS.get(worksheet), worksheet)[0]
+
+"""# Data-quality rules
+Exclusion and validation rules for every worksheet, evaluated together in one vectorized pass
+with a report of the rows each rule caught
+"""
 
 # @title
-#
-#EmONC Knowledge Score by Facilit
-
-# Calculate overall summary
-overall_summary = EmONC_Knowledge_df['Score'].agg(['mean', 'std', 'count']).round(1).to_frame().T
-overall_summary.columns = ['Mean Score','Std', 'Count']
-overall_summary.index = ['Overall']
-# Calculate mean, standard deviation, and count by county
-mean_score_by_facility = EmONC_Knowledge_df[['Facility', 'Score']] \
-                .groupby('Facility') \
-                .agg({'Score': ['mean', 'std', 'count']}) \
-                .round(1) \
-                .sort_values(('Score', 'mean'), ascending=True)
-
-# Rename columns for clarity
-mean_score_by_facility.columns = ['Mean Score', 'Std', 'Count']
-
-# Reset index to make 'county' a regular column
-mean_score_by_facility.reset_index(inplace=True)
-
-# Concatenate overall and county-wise summaries
-mean_score_by_facility = pd.concat([mean_score_by_facility, overall_summary])
-table = tabulate(mean_score_by_facility, headers='keys')
-
-# # Split the table into lines
-# table_lines = table.split('\n')
-
-# # Add alternating colors to table lines
-# for i in range(2, len(table_lines), 2):
-#     table_lines[i] = '\033[47m' + table_lines[i] + '\033[0m'
-
-# # Combine table lines back into a string
-# table = '\n'.join(table_lines)
-
-# Display the table
-print(table)
-
-mean_score_by_facility
+# Declarative rules and the engine that applies them
+@dataclass
+class Rule:
+    name: str
+    worksheets: tuple             # worksheets the rule applies to
+    columns: tuple                # columns the rule reads; it is skipped on frames without them
+    check: object                 # frame -> boolean array, True where a row passes; must only look within the row
+    action: str = 'exclude'       # 'exclude' drops failing rows, 'flag' only reports them
+    description: str = ''
+
+# Exclusions declared on each instrument in INSTRUMENTS, plus checks common to every instrument
+def instrument_rules(spec):
+    rules = [Rule('score_out_of_range', (spec.worksheet, spec.baseline_worksheet), ('Score',),
+                  lambda df: df['Score'].isna() | df['Score'].between(0, 100), 'flag',
+                  'Score outside 0-100'),
+             Rule('missing_score', (spec.worksheet, spec.baseline_worksheet), ('Score',),
+                  lambda df: df['Score'].notna(), 'flag', 'No score'),
+             Rule('missing_mentee_id', (spec.worksheet,), ('mentee_id',),
+                  lambda df: df['mentee_id'].notna(), 'flag', 'No mentee_id, so the row cannot be paired')]
+    if spec.min_score is not None:
+        rules.append(Rule('unscored', (spec.worksheet,), ('Score',),
+                          lambda df, floor=spec.min_score: df['Score'] > floor,
+                          description=f"Score at or below {spec.min_score}: not an assessment"))
+    if spec.excluded_mentees:
+        rules.append(Rule('test_record', (spec.worksheet, spec.baseline_worksheet), ('mentee_id',),
+                          lambda df, ids=spec.excluded_mentees: ~df['mentee_id'].isin(ids),
+                          description='Test record'))
+    return rules
+
+DATA_RULES = [rule for spec in INSTRUMENTS.values() for rule in instrument_rules(spec)] + [
+    # 'Match' is added to the completion sheets by match_mentees
+    Rule('unmatched_mentee', ('CME Completion', 'Drill Completion'), ('Match',),
+         lambda df: df['Match'] != 'none', description='Not linked to an assessed mentee'),
+]
+
+# Identity of a rule's logic: name, action, columns, code, constants and any captured values
+def _rule_signature(rule):
+    code = rule.check.__code__
+    captured = [cell.cell_contents for cell in (rule.check.__closure__ or ())] + list(rule.check.__defaults__ or ())
+    return (rule.name, rule.action, tuple(rule.columns), code.co_code, repr(code.co_consts), repr(captured))
+
+def _grow(array, size, fill):
+    if len(array) >= size:
+        return array
+    grown = np.full((size,) + array.shape[1:], fill, dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+class RuleEngine:
+    # Outcomes are cached per worksheet and sheet row together with a hash of the columns the rules
+    # read, so rows unchanged since an earlier run (or chunk) are looked up instead of re-checked.
+    # The lock serialises apply() for engines shared between threads.
+    def __init__(self, rules=DATA_RULES):
+        self.rules = list(rules)
+        self.reports = {}
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def rules_for(self, worksheet, columns):
+        return [rule for rule in self.rules if worksheet in rule.worksheets and set(rule.columns) <= set(columns)]
+
+    # Boolean matrix of rule outcomes, one row per frame row and one column per rule.
+    # Rows are identified by their integer index labels (positions for any other index).
+    def evaluate(self, worksheet, df):
+        rules = self.rules_for(worksheet, df.columns)
+        outcomes = np.ones((len(df), len(rules)), dtype=bool)
+        if not rules or not len(df):
+            return rules, outcomes
+        read = list(dict.fromkeys(col for rule in rules for col in rule.columns))
+        keys = pd.util.hash_pandas_object(df[read], index=False).to_numpy()
+        labels = df.index.to_numpy()
+        if not np.issubdtype(labels.dtype, np.integer) or labels.min() < 0:
+            labels = np.arange(len(df))
+
+        signature = [_rule_signature(rule) for rule in rules]
+        cache = self._cache.get(worksheet)
+        if cache is None or cache['signature'] != signature:
+            cache = {'signature': signature, 'keys': np.zeros(0, dtype=np.uint64),
+                     'known': np.zeros(0, dtype=bool), 'outcomes': np.zeros((0, len(rules)), dtype=bool)}
+        size = labels.max() + 1
+        cache['keys'] = _grow(cache['keys'], size, 0)
+        cache['known'] = _grow(cache['known'], size, False)
+        cache['outcomes'] = _grow(cache['outcomes'], size, True)
+
+        cache['rules'] = rules
+        hit = cache['known'][labels] & (cache['keys'][labels] == keys)
+        outcomes[hit] = cache['outcomes'][labels[hit]]
+        missed = np.flatnonzero(~hit)
+        if len(missed):
+            new = df.iloc[missed]
+            outcomes[missed] = np.column_stack([np.asarray(rule.check(new), dtype=bool) for rule in rules])
+            cache['keys'][labels[missed]] = keys[missed]
+            cache['known'][labels[missed]] = True
+            cache['outcomes'][labels[missed]] = outcomes[missed]
+        self._cache[worksheet] = cache
+        return rules, outcomes
+
+    # Rows passing every exclusion rule, taken in one step. self.reports keeps the violations of every
+    # rule with sheet row numbers (first_row is the sheet row of position 0 of the index), over every
+    # row of the worksheet checked so far: chunks of a streamed sheet and county slices add up, and a
+    # row that was fixed drops out when it is checked again. whole=True says df is the whole worksheet,
+    # so outcomes of rows past its end (rows deleted since) are forgotten.
+    def apply(self, worksheet, df, first_row=2, whole=False):
+        with tracer.stage('data_rules', rows=len(df), worksheet=worksheet), self._lock:
+            rules, outcomes = self.evaluate(worksheet, df)
+            if whole:
+                self._truncate(worksheet, len(df))
+            self.reports[worksheet] = self._report(worksheet, rules, first_row)
+            self._cache.get(worksheet, {})['first_row'] = first_row
+            excluded = [j for j, rule in enumerate(rules) if rule.action == 'exclude']
+            if not excluded:
+                return df
+            keep = outcomes[:, excluded].all(axis=1)
+            return df if keep.all() else df[keep]
+
+    # Forget the outcomes of rows from position `rows` on, e.g. once a streamed sheet has been read to its end
+    def truncate(self, worksheet, rows):
+        with self._lock:
+            cache = self._truncate(worksheet, rows)
+            if cache is not None and worksheet in self.reports and 'rules' in cache:
+                self.reports[worksheet] = self._report(worksheet, cache['rules'], cache.get('first_row', 2))
+
+    def _truncate(self, worksheet, rows):
+        cache = self._cache.get(worksheet)
+        if cache is not None:
+            for name in ('keys', 'known', 'outcomes'):
+                cache[name] = cache[name][:rows]
+        return cache
+
+    # Violations of every rule over the rows in the worksheet's outcome cache
+    def _report(self, worksheet, rules, first_row):
+        cache = self._cache.get(worksheet)
+        current = cache is not None and cache['signature'] == [_rule_signature(rule) for rule in rules]
+        known = np.flatnonzero(cache['known']) if current and len(rules) else np.zeros(0, dtype=int)
+        failed = ~cache['outcomes'][known] if len(known) else np.zeros((0, len(rules)), dtype=bool)
+        return pd.DataFrame(
+            [{'Worksheet': worksheet, 'Rule': rule.name, 'Action': rule.action,
+              'Description': rule.description, 'Violations': int(failed[:, j].sum()),
+              'Rows': (known[failed[:, j]] + first_row).tolist()} for j, rule in enumerate(rules)],
+            columns=['Worksheet', 'Rule', 'Action', 'Description', 'Violations', 'Rows'])
+
+    # Violation counts of every worksheet checked so far
+    def report(self):
+        return pd.concat(self.reports.values(), ignore_index=True) if self.reports else \
+            pd.DataFrame(columns=['Worksheet', 'Rule', 'Action', 'Description', 'Violations', 'Rows'])
+
+data_rules = RuleEngine()
+
+"""# Item response matrix
+Item answers are encoded once into a compact pass/fail matrix so pass rates come from a single reduction
+"""
 
 # @title
-
-# Calculate the mean score by county, round it to one decimal place, and sort by score in ascending order
-mean_score_by_facility = mean_score_by_facility[mean_score_by_facility['Mean Score']!=87.6]
-
-# # Create the bar chart with sorted data
-plt.figure(figsize=(10, 6))
-sns.barplot(x='Facility',
-            y='Mean Score',
-            data=mean_score_by_facility,
-            palette='viridis')
-
-# # Add labels to the bars
-for index, value in enumerate(mean_score_by_facility['Mean Score']):
-    plt.text(index, value + 0.5, str(value), ha='center', va='bottom', fontsize=10)
-
-# Add horizontal line at the target value of 80
-plt.axhline(y=80, color='red', linestyle='--', label='KPI Target (80) vs mean(87.6)')
-
-plt.title('Mean Knowledge Score by Facility (Ascending Order)')
-plt.xlabel('Facility')
-plt.ylabel('Mean Knowledge Score')
-plt.xticks(rotation=45, ha='right')
-plt.ylim(0,100)
-
-# Show the legend
-plt.legend()
-
-plt.tight_layout()
-
-# Show the chart
-plt.show()
-
-# Concatenate overall and county-wise summaries
-mean_score_by_facility = pd.concat([mean_score_by_facility])
-table = tabulate(mean_score_by_facility, headers='keys')
-
-# Split the table into lines
-table_lines = table.split('\n')
-
-# Add alternating colors to table lines
-for i in range(2, len(table_lines), 2):
-    table_lines[i] = '\033[47m' + table_lines[i] + '\033[0m'
-
-# Combine table lines back into a string
-table = '\n'.join(table_lines)
-
-# Display the table
-print(table)
+# Compact pass/fail matrix for item analysis
+class ResponseMatrix:
+    # data: uint8 array of shape (mentees, items), 1 where the item was passed
+    # groups: categorical columns (Facility, County, ...) aligned with the rows
+    def __init__(self, data, items, index, groups):
+        self.data = data
+        self.items = pd.Index(items, name='Item')
+        self.index = pd.Index(index)
+        self.groups = groups
+
+    # Encode the item columns of a frame with a pass rule such as lambda v: v == 'Correct'
+    @classmethod
+    def from_frame(cls, df, items, passed, index=None, groups=()):
+        data = np.ascontiguousarray(passed(df[items]).fillna(False).to_numpy(dtype=np.uint8))
+        index = df[index] if index is not None else df.index
+        groups = df[list(groups)].astype('category').reset_index(drop=True)
+        return cls(data, items, index, groups)
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+    # Rows matching every filter, e.g. select(Facility='Kangema SCH')
+    def select(self, **filters):
+        mask = np.ones(len(self), dtype=bool)
+        for col, value in filters.items():
+            mask &= (self.groups[col] == value).to_numpy()
+        return ResponseMatrix(self.data[mask], self.items, self.index[mask],
+                              self.groups[mask].reset_index(drop=True))
+
+    # Pass rate and count of passes for every item
+    def pass_rates(self):
+        counts = self.data.sum(axis=0, dtype=np.int64)
+        rates = counts / max(len(self), 1) * 100
+        return pd.DataFrame({'Pass rate(%)': rates, 'Count': counts}, index=self.items)
+
+    # Group code of every row and the group labels; a single 'Overall' group when by is None
+    def _group_codes(self, by):
+        if by is None:
+            return np.zeros(len(self), dtype=np.intp), pd.Index(['Overall'])
+        by = [by] if isinstance(by, str) else list(by)
+        codes, groups = pd.MultiIndex.from_frame(self.groups[by]).factorize()
+        groups.names = by
+        return codes, groups
+
+    # Per-group sums of each item column times weights (one weight per row), shape (groups, items)
+    def _item_sums(self, codes, n_groups, weights=None):
+        n_items = len(self.items)
+        cells = (codes[:, None] * n_items + np.arange(n_items)).ravel()
+        values = self.data if weights is None else self.data * weights[:, None]
+        return np.bincount(cells, weights=values.ravel(), minlength=n_groups * n_items).reshape(n_groups, n_items)
+
+    # Passes per item and response count for each group, from one bincount over the whole matrix
+    def pass_counts_by(self, by):
+        codes, groups = self._group_codes(by)
+        counts = pd.DataFrame(self._item_sums(codes, len(groups)).astype(np.int64),
+                              index=groups, columns=self.items)
+        totals = pd.Series(np.bincount(codes, minlength=len(groups)), index=counts.index, name='Responses')
+        return counts, totals
+
+    # Item pass rates for each group
+    def pass_rates_by(self, by):
+        counts, totals = self.pass_counts_by(by)
+        return counts.div(totals, axis=0) * 100
+
+    # Classical test theory statistics for each group (the whole matrix when by is None).
+    # Every statistic comes from per-group sums of x, T, T^2 and x*T (x the 0/1 item matrix,
+    # T the total score), each one bincount, so there is no loop over items or groups.
+    # Returns an item table indexed by (group..., Item) with Difficulty (proportion passing),
+    # Discrimination (corrected point-biserial, item against the total of the other items) and
+    # Alpha if deleted, and a test table per group with Cronbach's alpha, which for pass/fail
+    # items is KR-20, and the standard error of measurement.
+    def item_statistics(self, by=None):
+        codes, groups = self._group_codes(by)
+        n_groups, k = len(groups), len(self.items)
+        total = self.data.sum(axis=1, dtype=np.float64)
+        n = np.bincount(codes, minlength=n_groups).astype(np.float64)
+        sum_x = self._item_sums(codes, n_groups)
+        sum_xt = self._item_sums(codes, n_groups, total)
+        sum_t = np.bincount(codes, weights=total, minlength=n_groups)
+        sum_tt = np.bincount(codes, weights=total ** 2, minlength=n_groups)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dof = (n - 1)[:, None]
+            var_x = (sum_x - sum_x ** 2 / n[:, None]) / dof
+            var_t = (sum_tt - sum_t ** 2 / n) / (n - 1)
+            cov_xt = (sum_xt - sum_x * sum_t[:, None] / n[:, None]) / dof
+            # Total of the other items: var(T - x) and cov(x, T - x)
+            var_rest = var_t[:, None] - 2 * cov_xt + var_x
+            cov_rest = cov_xt - var_x
+            discrimination = cov_rest / np.sqrt(var_x * var_rest)
+            sum_var = var_x.sum(axis=1)
+            alpha = k / (k - 1) * (1 - sum_var / var_t)
+            alpha_deleted = (k - 1) / (k - 2) * (1 - (sum_var[:, None] - var_x) / var_rest) if k > 2 \
+                else np.full_like(var_x, np.nan)
+
+        item_index = pd.MultiIndex.from_arrays(
+            [groups.get_level_values(i).repeat(k) for i in range(groups.nlevels)] + [np.tile(self.items, n_groups)],
+            names=list(groups.names) + ['Item']) if by is not None else self.items
+        item_stats = pd.DataFrame({'Difficulty': (sum_x / n[:, None]).ravel(),
+                                   'Discrimination': discrimination.ravel(),
+                                   'Alpha if deleted': alpha_deleted.ravel()}, index=item_index)
+        test_stats = pd.DataFrame({'Responses': n.astype(np.int64), 'Items': k,
+                                   'Mean': sum_t / n, 'Std': np.sqrt(var_t),
+                                   'Alpha (KR-20)': alpha,
+                                   'SEM': np.sqrt(var_t * (1 - alpha))}, index=groups)
+        return item_stats, test_stats
+
+"""# Score distributions
+Fixed-bin score histograms that add up across facilities, counties, waves and instruments.
+Quantiles, box-plot statistics and KDE curves come from the bins, so distribution charts need no rows
+"""
 
 # @title
-# Overall distribution of scores
-
-# Distribution of scores
-plt.figure(figsize=(10, 6))
-sns.histplot(
-    EmONC_Knowledge_df['Score'],
-    kde= True
-
-)
-
-plt.title('EmONC Knowledge Score Distribution')
-plt.ylabel('Frequency')
-plt.xlabel('Knowledge Score')
-plt.xticks(rotation=45, ha='right')
-plt.ylim(0,15)
-plt.xlim(50,100)
-
-# Show the legend
-plt.legend()
-plt.tight_layout()
-
-# Show the chart
-plt.show()
+# Mergeable binned score distributions
+# Scores are binned on SCORE_RANGE, so quantiles and box statistics are exact to within one bin width
+SCORE_RANGE = (0.0, 100.0)
+SCORE_BIN_WIDTH = 0.25
+SCORE_BINS = int(round((SCORE_RANGE[1] - SCORE_RANGE[0]) / SCORE_BIN_WIDTH))
+# Bar width of histogram charts drawn from the bins
+HIST_DISPLAY_WIDTH = 2.5
+
+# Bin of each score; scores outside the range go to the end bins
+def score_bins(scores):
+    bins = np.floor((np.asarray(scores, dtype='float64') - SCORE_RANGE[0]) / SCORE_BIN_WIDTH)
+    return np.clip(bins, 0, SCORE_BINS - 1).astype(np.int64)
+
+# Number of scores per group and bin, for the non-empty bins only
+def score_histogram(df, by):
+    scores = df['Score'].to_numpy(dtype='float64')
+    scored = ~np.isnan(scores)
+    return df.loc[scored, by].assign(Bin=score_bins(scores[scored])) \
+            .groupby(by + ['Bin'], observed=True, sort=False).size().rename('Count').reset_index()
+
+def _sum_bin_counts(flat, by):
+    return flat.groupby(by + ['Bin'], sort=False)[['Count']].sum()
+
+class ScoreDistribution:
+    # counts: number of scores in each of the SCORE_BINS bins
+    def __init__(self, counts):
+        self.counts = np.asarray(counts, dtype=np.int64)
+
+    @classmethod
+    def from_scores(cls, scores):
+        scores = np.asarray(scores, dtype='float64')
+        return cls(np.bincount(score_bins(scores[~np.isnan(scores)]), minlength=SCORE_BINS))
+
+    # From long-form Bin / Count rows, e.g. a slice of the cube's histograms
+    @classmethod
+    def from_bins(cls, bins):
+        counts = np.bincount(bins['Bin'].to_numpy(dtype=np.int64), weights=bins['Count'].to_numpy(),
+                             minlength=SCORE_BINS)
+        return cls(counts.round())
+
+    def __add__(self, other):
+        return ScoreDistribution(self.counts + other.counts)
+
+    def __len__(self):
+        return int(self.counts.sum())
+
+    @property
+    def edges(self):
+        return SCORE_RANGE[0] + SCORE_BIN_WIDTH * np.arange(SCORE_BINS + 1)
+
+    @property
+    def centers(self):
+        return self.edges[:-1] + SCORE_BIN_WIDTH / 2
+
+    def mean(self):
+        return float(self.counts @ self.centers / max(len(self), 1))
+
+    def std(self):
+        n = len(self)
+        return float(np.sqrt(self.counts @ (self.centers - self.mean()) ** 2 / (n - 1))) if n > 1 else np.nan
+
+    # Quantiles, interpolating linearly within the bin that holds each one
+    def quantiles(self, q):
+        q = np.atleast_1d(np.asarray(q, dtype='float64'))
+        cumulative = np.cumsum(self.counts)
+        target = q * cumulative[-1]
+        last = np.flatnonzero(self.counts)[-1] if len(self) else 0
+        i = np.minimum(np.searchsorted(cumulative, target, side='right'), last)
+        before = cumulative[i] - self.counts[i]
+        fraction = (target - before) / np.maximum(self.counts[i], 1)
+        return self.edges[i] + fraction.clip(0, 1) * SCORE_BIN_WIDTH
+
+    # Statistics for Axes.bxp: quartiles, whiskers at the furthest bins within 1.5 IQR, fliers beyond
+    def box_stats(self, label=None):
+        q1, med, q3 = self.quantiles([0.25, 0.5, 0.75])
+        centers = self.centers[self.counts > 0]
+        inside = (centers >= q1 - 1.5 * (q3 - q1)) & (centers <= q3 + 1.5 * (q3 - q1))
+        return {'label': label, 'whislo': centers[inside].min() if inside.any() else q1, 'q1': q1, 'med': med,
+                'q3': q3, 'whishi': centers[inside].max() if inside.any() else q3, 'mean': self.mean(),
+                'fliers': tuple(centers[~inside]), 'count': len(self)}
+
+    # Gaussian KDE at the bin centers by FFT convolution of the counts, in scores per bin
+    # (Scott's rule bandwidth unless one is given)
+    def kde(self, bandwidth=None):
+        n = len(self)
+        if n < 2:
+            return self.counts.astype('float64')
+        if bandwidth is None:
+            bandwidth = self.std() * n ** (-1 / 5)
+        bandwidth = max(bandwidth, SCORE_BIN_WIDTH)
+        radius = int(np.ceil(4 * bandwidth / SCORE_BIN_WIDTH))
+        kernel = np.exp(-0.5 * (np.arange(-radius, radius + 1) * SCORE_BIN_WIDTH / bandwidth) ** 2)
+        kernel /= kernel.sum()
+        size = 1 << (SCORE_BINS + len(kernel) - 2).bit_length()
+        smoothed = np.fft.irfft(np.fft.rfft(self.counts, size) * np.fft.rfft(kernel, size), size)
+        return smoothed[radius:radius + SCORE_BINS].clip(min=0)
+
+    # Bin left edges, counts and KDE, the data of a 'binned_hist' chart
+    def to_frame(self, kde=True):
+        frame = pd.DataFrame({'Score': self.edges[:-1], 'Count': self.counts})
+        if kde:
+            frame['KDE'] = self.kde()
+        return frame
+
+# One bxp row per distribution, for a 'bxp' chart
+def box_table(distributions):
+    return pd.DataFrame([distribution.box_stats(label)
+                         for label, distribution in distributions.items() if len(distribution)])
+
+"""# Score cube
+Mean, std, count and item pass rates for every instrument, county, facility and survey wave,
+with county, survey and overall roll-ups, built in one grouped pass per instrument
+"""
 
 # @title
-# Distribution of scores by Facility
-plt.figure(figsize=(10, 6))
-sns.boxplot(x='Facility',
-            y='Score',
-            data=EmONC_Knowledge_df,
-            palette='viridis')
-
-# Add horizontal line at the target value of 80
-plt.axhline(y=80, color='red', linestyle='--', label='KPI Target (80)')
-
-plt.title('EmONC Knowledge Score Distribution')
-plt.xlabel('Facility')
-plt.ylabel('Knowledge Score')
-plt.xticks(rotation=45, ha='right')
-plt.ylim(60,105)
-
-# Show the legend
-plt.legend()
-plt.tight_layout()
-
-# Show the chart
-plt.show()
-
-# # @title
-# def classify_question(question):
-#     if question in new_questions:
-#         return 'new_topic'
-#     else:
-#         return 'old_topic'
-
-# new_questions = ['signs_obstructed_labor', 'risks_factor_obs_labor', 'definitive_cord_prolapse_mx',
-#                  'cord_prolapse_dx',  'maternal_cpr',
-#                  'antepartum_hemorrhage',  'fetal_compromise', 'fetal_compromise_monitoring',
-#                  'mpdsr']
-# old_questions = ['hip_medications', 'inhibitors_of_rmc', 'categories_of_disrespect',
-#                  'second_stage_labor', 'newborn_care', 'secondary_pph',
-#                  'pre_eclampsia_risk_factors', 'shoulder_dystocia_management',
-#                  'shoulder_dystocia_maneuvers', 'complication_hypovolemic_shock',
-#                  'ipc_handling_sharps',
-#                  'ipc_waste_segregation', 'neonatal_resusc_reassessemnts', 'chest_compression_nnr',
-#                  'labor_monitoring_2nd_stage']
+# Multi-county, multi-survey aggregation cube
+CUBE_DIMS = ['County', 'Facility', 'Survey']
+ALL = 'All'
+
+# Dimensions kept at each roll-up level; a facility is only reported within its county
+CUBE_ROLLUPS = [('County', 'Facility', 'Survey'),
+                ('County', 'Facility'),
+                ('County', 'Survey'),
+                ('County',),
+                ('Survey',),
+                ()]
+
+# Count, mean and sum of squared deviations (M2) of Score per group
+def score_moments(df, by):
+    scores = df['Score'].astype('float64')
+    moments = scores.groupby([df[col] for col in by], observed=True, sort=False).agg(['count', 'mean', 'var'])
+    moments['M2'] = moments['var'].fillna(0) * (moments['count'] - 1)
+    return moments[['count', 'mean', 'M2']]
+
+# Combine the moments of groups sharing the same key (parallel variance formula)
+def merge_moments(moments, by):
+    n = moments['count']
+    total = n * moments['mean']
+    parts = moments[by].assign(count=n, total=total, M2=moments['M2'], square=total * moments['mean'])
+    merged = parts.groupby(by, sort=False).sum()
+    merged['mean'] = merged['total'] / merged['count']
+    merged['M2'] = (merged['M2'] + merged['square'] - merged['total'] * merged['mean']).clip(lower=0)
+    return merged[['count', 'mean', 'M2']]
+
+# Replace the dimensions that are rolled up with 'All' and re-aggregate
+def _rollup(flat, keep, merge):
+    flat = flat.copy()
+    for dim in CUBE_DIMS:
+        if dim not in keep:
+            flat[dim] = ALL
+    return merge(flat, ['Instrument'] + CUBE_DIMS)
+
+def _sum_item_counts(flat, by):
+    return flat.groupby(by + ['Item'], sort=False)[['Passed', 'Responses']].sum()
+
+# Digest of the first `rows` rows, so an edit to any row already aggregated is noticed;
+# hashing is a small fraction of the cost of aggregating the same rows
+def _prefix_fingerprint(df, rows):
+    hashes = pd.util.hash_pandas_object(df.iloc[:rows], index=False).to_numpy()
+    return hashlib.blake2b(hashes.tobytes(), digest_size=16).hexdigest()
+
+# Digest of a pass rule's code, constants and captured values, so statistics aggregated under an
+# earlier version of the rule are rebuilt
+def _pass_rule_fingerprint(passed):
+    digest = hashlib.blake2b(digest_size=16)
+    _update_code_hash(digest, passed)
+    captured = [cell.cell_contents for cell in (passed.__closure__ or ())] + list(passed.__defaults__ or ())
+    digest.update(repr(captured).encode())
+    return digest.hexdigest()
+
+class FacilityScoreStats:
+    # Running count/mean/M2 of Score, score histograms and item pass counts per
+    # (Instrument, County, Facility, Survey). Batches are merged with the parallel variance formula
+    # and by adding counts, so rows appended to a worksheet since the last run are the only rows
+    # aggregated on a refresh.
+    def __init__(self, path=None):
+        self.path = path
+        self.moments = None
+        self.histograms = None
+        self.item_counts = None
+        self.seen = {}
+
+    @classmethod
+    def load(cls, path):
+        stats = cls(path)
+        # Statistics saved without histograms are rebuilt
+        if os.path.exists(path + '.json') and os.path.exists(path + '_hist.parquet'):
+            with open(path + '.json') as f:
+                stats.seen = json.load(f)
+            stats.moments = pd.read_parquet(path + '_moments.parquet')
+            stats.histograms = pd.read_parquet(path + '_hist.parquet')
+            stats.item_counts = pd.read_parquet(path + '_items.parquet')
+        return stats
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.moments.to_parquet(self.path + '_moments.parquet', index=False)
+        self.histograms.to_parquet(self.path + '_hist.parquet', index=False)
+        self.item_counts.to_parquet(self.path + '_items.parquet', index=False)
+        with open(self.path + '.json', 'w') as f:
+            json.dump(self.seen, f)
+
+    def drop(self, instrument):
+        if self.moments is not None:
+            self.moments = self.moments[self.moments['Instrument'] != instrument]
+            self.histograms = self.histograms[self.histograms['Instrument'] != instrument]
+            self.item_counts = self.item_counts[self.item_counts['Instrument'] != instrument]
+        self.seen.pop(instrument, None)
+
+    # Merge the statistics of a batch of rows into the running totals
+    def update(self, instrument, df, items, passed):
+        if not len(df):
+            return
+        df = df.assign(**{dim: df[dim].astype(str) for dim in CUBE_DIMS})
+        keys = ['Instrument'] + CUBE_DIMS
+
+        batch = score_moments(df, CUBE_DIMS).reset_index().assign(Instrument=instrument)
+        if self.moments is not None:
+            batch = pd.concat([self.moments, batch], ignore_index=True)
+        self.moments = merge_moments(batch, keys).reset_index()
+
+        batch = score_histogram(df, CUBE_DIMS).assign(Instrument=instrument)
+        if self.histograms is not None:
+            batch = pd.concat([self.histograms, batch], ignore_index=True)
+        self.histograms = _sum_bin_counts(batch, keys).reset_index()
+
+        rm = ResponseMatrix.from_frame(df, items, passed, groups=CUBE_DIMS)
+        passes, totals = rm.pass_counts_by(CUBE_DIMS)
+        batch = passes.stack().rename('Passed').reset_index() \
+                .merge(totals.reset_index(), on=CUBE_DIMS) \
+                .assign(Instrument=instrument)
+        if self.item_counts is not None:
+            batch = pd.concat([self.item_counts, batch], ignore_index=True)
+        self.item_counts = _sum_item_counts(batch, keys).reset_index()
+
+    # Fold in the rows appended to an instrument's frame since the last refresh.
+    # Edited or deleted history (or a changed item list or pass rule) rebuilds that instrument from scratch.
+    def refresh(self, instrument, df, items, passed):
+        seen = self.seen.get(instrument, {})
+        start = seen.get('rows', 0)
+        rule = _pass_rule_fingerprint(passed)
+        # Statistics without a row count or prefix digest here were streamed from the sheet, or saved
+        # before prefix digests were kept, and are rebuilt
+        if ('prefix' not in seen or start > len(df)
+                or seen.get('items') != list(items)
+                or seen.get('passed') != rule
+                or seen['prefix'] != _prefix_fingerprint(df, start)):
+            self.drop(instrument)
+            start = 0
+        self.update(instrument, df.iloc[start:], items, passed)
+        self.seen[instrument] = {'rows': len(df), 'items': list(items), 'passed': rule,
+                                 'prefix': _prefix_fingerprint(df, len(df))}
+        return len(df) - start
 
 # @title
-# Select data for Knowledge Item analysis
-EmONC_Knowledge_Item_df = EmONC_Knowledge_df[['signs_obstructed_labor', 'risks_factor_obs_labor', 'hip_medications',\
-                     'pre_eclampsia_risk_factors', 'shoulder_dystocia_management', \
-                    'shoulder_dystocia_maneuvers', 'definitive_cord_prolapse_mx', \
-                    'cord_prolapse_dx', 'inhibitors_of_rmc', 'categories_of_disrespect', \
-                    'second_stage_labor', 'newborn_care', 'secondary_pph', 'maternal_cpr', \
-                    'antepartum_hemorrhage', 'complication_hypovolemic_shock', 'ipc_handling_sharps',\
-                    'ipc_waste_segregation', 'neonatal_resusc_reassessemnts', 'chest_compression_nnr',\
-                    'labor_monitoring_2nd_stage', 'fetal_compromise', 'fetal_compromise_monitoring', \
-                    'mpdsr']]
-
-
-
-# Convert EmONC_Knowledge_Item_df to a data frame
-df1 = pd.DataFrame(EmONC_Knowledge_Item_df)
-
-# Function to calculate percentage correct and count of correct responses
-def calculate_percentage_correct(column):
-    total_responses = len(column)
-    correct_responses = (column == 'Correct').sum()
-    percentage_correct = (correct_responses / total_responses) * 100
-    return percentage_correct, correct_responses
-
-# Apply the function to each column
-result = df1.apply(calculate_percentage_correct)
-
-result = result.T
-result.columns = ['Pass rate(%)', 'Count ']
-result.index.name = 'Item'
-
-
-# result['Category'] = result.index.map(classify_question)
-
-result = result\
-        .sort_values('Pass rate(%)', ascending=True)\
-        .round(1)
-
-
-# Create the bar chart with sorted data
-plt.figure(figsize=(10, 6))
-sns.barplot(x='Item',
-            y='Pass rate(%)',
-            data=result,
-            palette='viridis')
-
-# # Add labels to the bars
-for index, value in enumerate(result['Pass rate(%)']):
-     plt.text(index, value + 0.5, str(value), ha='center', va='bottom', fontsize=8)
-
-plt.title('Pass rate by question')
-plt.xlabel('Knowledge Item')
-plt.ylabel('Pass rate(%)')
-plt.xticks(rotation=45, ha='right')
-plt.ylim(0,110)
-
-plt.show()
-
-# @title
-# Read previous EmONC Knowledge data
-# Access worksheet and convert it to a data frame
-Pre_Knowledge = spreadsheet.worksheet('Knowledge Pre')
-Pre_Knowledge_df = pd.DataFrame(Pre_Knowledge.get_all_records())
-Pre_Knowledge_df = Pre_Knowledge_df[Pre_Knowledge_df['mentee_id'] != 721274871]
-Pre_Knowledge_df = Pre_Knowledge_df[['Facility','Score']]
-Current_EmONC_Knowledge_df = EmONC_Knowledge_df[['Facility','Score']]
-# print(Pre_Knowledge_df.sample(3))
-# print(Current_EmONC_Knowledge_df.sample(3))
-
-# Add a 'previous' label to Pre_Knowledge_df
-Pre_Knowledge_df_labeled = Pre_Knowledge_df.copy()
-Pre_Knowledge_df_labeled['Label'] = 'Baseline'
-
-
-# Add a 'current' label to Current_EmONC_Knowledge_df
-Current_EmONC_Knowledge_df_labeled = Current_EmONC_Knowledge_df.copy()
-Current_EmONC_Knowledge_df_labeled['Label'] = 'Endline'
-
-# Concatenate the two dataframes
-concatenated_df = pd.concat([Pre_Knowledge_df_labeled, Current_EmONC_Knowledge_df_labeled])
-
-concatenated_df.sample(5)
-
-# Plot previous versus current score distribution
-
-sns.boxplot(y='Score',
-            x= 'Label',
-            data = concatenated_df,
-            hue = 'Label'
-            )
-plt.title('Baseline vs Endline Knowledge Score Distribution')
-plt.ylabel('Knowledge Score')
-plt.xlabel('Baseline vs Endline')
-plt.show()
-
-Pre_Knowledge_df_labeled.describe()
-
-Current_EmONC_Knowledge_df_labeled.describe()
-
-# Perform paired T-test
-t_statistic, p_value = ttest_rel(Pre_Knowledge_df_labeled['Score'], Current_EmONC_Knowledge_df_labeled['Score'])
-
-# Output the results
-print("Paired T-test Results:")
-print("T-statistic:", t_statistic)
-print("P-value:", p_value)
-
-# Interpret the results
-alpha = 0.05  # You can set your desired significance level here
-if p_value < alpha:
-    print("Reject the null hypothesis: There is a significant difference between previous and current knowledge scores.")
-else:
-    print("Fail to reject the null hypothesis: There is no significant difference between previous and current knowledge scores.")
-
-# # @title
-# Curriculum_Completion.dtypes
-
-# # @title
-# plt.figure(figsize=(10, 6))
-# lm=sns.lmplot(x='cme_topic',
-#            y='Knowledge_score',
-#            data=Curriculum_Completion)
-# plt.title('Curriculum Completion vs. EmONC Knowledge Score')
-
-"""# Analysis on Neonatal Resuscitation Skills Score for a specific county"""
+# Empirical-Bayes facility means
+from statistics import NormalDist
+
+# Level of the facility credible intervals
+EB_LEVEL = 95
+
+# Normal-normal empirical Bayes for the facility means of every instrument, county and wave at once.
+# Within a county, facility j's mean y_j has sampling variance v_j = s2 / n_j (s2 pooled within
+# facilities) and true means are spread around mu with variance tau2 (DerSimonian-Laird estimate).
+# The posterior mean y_j + B_j (mu - y_j), with B_j = v_j / (v_j + tau2), pulls small facilities
+# furthest towards the county; its variance v_j (1 - B_j) + B_j^2 / sum(1 / (v + tau2)) also
+# carries the uncertainty in mu. All sums are bincounts over the facility rows of the cube.
+def shrink_facility_means(scores, level=EB_LEVEL):
+    rows = scores[scores.index.get_level_values('Facility') != ALL]
+    codes = pd.factorize(rows.index.droplevel('Facility'))[0]
+    groups = codes.max() + 1 if len(codes) else 0
+    total = lambda values: np.bincount(codes, weights=values, minlength=groups)
+    n = rows['count'].to_numpy(dtype='float64')
+    y = rows['mean'].to_numpy(dtype='float64')
+    k = total(np.ones(len(rows)))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        within = total(rows['M2'].to_numpy(dtype='float64')) / (total(n) - k)
+        v = within[codes] / n
+        w = 1 / v
+        s1, s2 = total(w), total(w * w)
+        q = total(w * (y - (total(w * y) / s1)[codes]) ** 2)
+        tau2 = np.where(k > 1, ((q - (k - 1)) / (s1 - s2 / s1)).clip(min=0), 0)
+        weight = 1 / (v + tau2[codes])
+        mu = total(weight * y) / total(weight)
+        shrinkage = v / (v + tau2[codes])
+        variance = v * (1 - shrinkage) + shrinkage ** 2 / total(weight)[codes]
+    # Facilities without a within-facility variance estimate are left unshrunk
+    usable = np.isfinite(shrinkage) & np.isfinite(variance)
+    posterior = np.where(usable, y + shrinkage * (mu[codes] - y), y)
+    half = NormalDist().inv_cdf(0.5 + level / 200) * np.sqrt(np.where(usable, variance, np.nan))
+    return pd.DataFrame({'EB mean': posterior, 'EB low': posterior - half, 'EB high': posterior + half,
+                         'Shrinkage': np.where(usable, shrinkage, 0.0)}, index=rows.index)
+
+class ScoreCube:
+    # scores: count/mean/M2 indexed by (Instrument, County, Facility, Survey)
+    # items: item passes and responses indexed by (Instrument, County, Facility, Survey, Item)
+    # histograms: score bin counts indexed by (Instrument, County, Facility, Survey, Bin)
+    # Everything is an aggregate, so a cube can be built from streamed statistics without any rows.
+    def __init__(self, scores, items, histograms=None):
+        self.scores = scores
+        self.items = items
+        self.histograms = histograms
+        self.shrunken = shrink_facility_means(scores)
+
+    # frames: instrument -> DataFrame with County, Facility, Survey, numeric Score and item columns
+    # items: instrument -> item columns, pass_rules: instrument -> pass rule for ResponseMatrix
+    # stats: FacilityScoreStats already holding every instrument, in which case frames is not read
+    # (None when the sheets were streamed); built from the frames when not given
+    @classmethod
+    def build(cls, frames, items, pass_rules, stats=None):
+        if stats is None:
+            stats = FacilityScoreStats()
+            for instrument, df in frames.items():
+                stats.update(instrument, df, items[instrument], pass_rules[instrument])
+
+        scores = pd.concat([_rollup(stats.moments, keep, merge_moments) for keep in CUBE_ROLLUPS])
+        scores['std'] = np.sqrt(scores['M2'] / (scores['count'] - 1))
+        item_counts = pd.concat([_rollup(stats.item_counts, keep, _sum_item_counts) for keep in CUBE_ROLLUPS])
+        item_counts['Pass rate(%)'] = item_counts['Passed'] / item_counts['Responses'] * 100
+        histograms = pd.concat([_rollup(stats.histograms, keep, _sum_bin_counts) for keep in CUBE_ROLLUPS])
+        return cls(scores, item_counts, histograms)
+
+    # Instruments in the cube, in registry order
+    @property
+    def instruments(self):
+        present = set(self.scores.index.get_level_values('Instrument'))
+        return [name for name in INSTRUMENTS if name in present]
+
+    # Rows of a cube table for one instrument, county (None for every county) and survey (None for all waves)
+    def _lookup(self, table, instrument, county, survey, facility_rows):
+        index = table.index
+        mask = (index.get_level_values('Instrument') == instrument) \
+               & (index.get_level_values('Survey') == (survey if survey is not None else ALL))
+        county_level = index.get_level_values('County')
+        facility_level = index.get_level_values('Facility')
+        if facility_rows:
+            mask &= facility_level != ALL
+            if county is not None:
+                mask &= county_level == county
+        else:
+            mask &= (county_level == (county if county is not None else ALL)) & (facility_level == ALL)
+        return table[mask]
+
+    # Facility mean, std, count and empirical-Bayes mean with its credible interval, ranked ascending
+    # by the EB mean so that small facilities do not crowd the extremes, with the 'Overall' row at the end
+    def facility_table(self, instrument, county=None, survey=None, mean_label='Mean'):
+        columns = {'mean': mean_label, 'std': 'Std', 'count': 'Count'}
+        facilities = self._lookup(self.scores, instrument, county, survey, facility_rows=True)
+        facilities = facilities.join(self.shrunken).reset_index() \
+                [['Facility'] + list(columns) + ['EB mean', 'EB low', 'EB high']] \
+                .rename(columns=columns) \
+                .round(1) \
+                .sort_values(['EB mean', mean_label], ascending=True) \
+                .reset_index(drop=True)
+        overall = self._lookup(self.scores, instrument, county, survey, facility_rows=False)
+        if not len(overall):
+            raise KeyError(self._missing(instrument, county, survey))
+        overall = overall[list(columns)].rename(columns=columns).round(1)
+        overall.index = ['Overall']
+        return pd.concat([facilities, overall])
+
+    # Which of an instrument, county and survey has no rows in the cube, for lookup errors
+    def _missing(self, instrument, county, survey, facility=None):
+        index = self.scores.index
+        for dim, value in (('Instrument', instrument), ('County', county), ('Survey', survey), ('Facility', facility)):
+            if value is not None and value not in index.get_level_values(dim):
+                return f"No {dim.lower()} {value!r} in the score cube"
+        where = f"facility {facility!r}, " if facility is not None else ''
+        return f"No {instrument} scores for {where}county {county!r} and survey {survey!r}"
+
+    # Score distribution of a county/survey (None for every county or wave), or of one facility
+    def distribution(self, instrument, county=None, survey=None, facility=None):
+        rows = self._lookup(self.histograms, instrument, county, survey, facility_rows=facility is not None)
+        if facility is not None:
+            rows = rows[rows.index.get_level_values('Facility') == facility]
+        if not len(rows):
+            raise KeyError(self._missing(instrument, county, survey, facility))
+        return ScoreDistribution.from_bins(rows.reset_index())
+
+    # Score distribution of every facility of a county/survey, in one bincount over the facility rows
+    def facility_distributions(self, instrument, county=None, survey=None):
+        rows = self._lookup(self.histograms, instrument, county, survey, facility_rows=True).reset_index()
+        codes, facilities = pd.factorize(rows['Facility'], sort=True)
+        counts = np.bincount(codes * SCORE_BINS + rows['Bin'].to_numpy(dtype=np.int64),
+                             weights=rows['Count'].to_numpy(), minlength=len(facilities) * SCORE_BINS)
+        counts = counts.round().reshape(len(facilities), SCORE_BINS)
+        return {facility: ScoreDistribution(row) for facility, row in zip(facilities, counts)}
+
+    # Pass rate and count of passes per item for a county/survey, or for one facility
+    def item_pass_rates(self, instrument, county=None, survey=None, facility=None):
+        rows = self._lookup(self.items, instrument, county, survey, facility_rows=facility is not None)
+        if facility is not None:
+            rows = rows[rows.index.get_level_values('Facility') == facility]
+        if not len(rows):
+            raise KeyError(self._missing(instrument, county, survey, facility))
+        return self._pass_rates(rows)
+
+    # Item pass rates of every facility in a county/survey from a single lookup, as facility -> table
+    def facility_item_pass_rates(self, instrument, county=None, survey=None):
+        rows = self._lookup(self.items, instrument, county, survey, facility_rows=True)
+        rates = self._pass_rates(rows, ['Facility', 'Item'])
+        # Contiguous rows per facility, items kept in their order within it
+        rates = rates.iloc[np.argsort(pd.factorize(rates.index.get_level_values('Facility'))[0], kind='stable')]
+        facilities = rates.index.get_level_values('Facility')
+        starts = np.flatnonzero(np.r_[True, facilities[1:] != facilities[:-1]])
+        return {facilities[start]: rates.iloc[start:end].droplevel('Facility')
+                for start, end in zip(starts, np.r_[starts[1:], len(rates)])}
+
+    @staticmethod
+    def _pass_rates(rows, levels=('Item',)):
+        rows = rows.groupby(level=list(levels), sort=False, observed=True)[['Passed', 'Responses']].sum()
+        return pd.DataFrame({'Pass rate(%)': rows['Passed'] / rows['Responses'] * 100, 'Count': rows['Passed']},
+                            index=rows.index.rename('Item', level=-1) if len(levels) > 1 else rows.index.rename('Item'))
 
 # @title
-# Access worksheet and convert it to a data frame
-NNR_Skills = spreadsheet.worksheet('NNR')
-NNR_Skills = pd.DataFrame(NNR_Skills.get_all_records())
-NNR_Skills = NNR_Skills[NNR_Skills['Survey']=='Endline']
-NNR_Skills.sample(2)
-
-NNR_Skills.columns
+# Instruments feeding the cube (see INSTRUMENTS)
+
+# Consistent column names and valid rows for one instrument; works on a whole sheet or a chunk of it
+def clean_instrument(instrument, df, rules=None, whole=False):
+    spec = INSTRUMENTS[instrument]
+    df = (rules or data_rules).apply(spec.worksheet, df, first_row=2, whole=whole)
+    return df.rename(columns=spec.renames) if spec.renames else df
+
+# Full datasets of each instrument with consistent column names
+def instrument_frames_from_sheets(sheets, rules=None):
+    return {instrument: clean_instrument(instrument, sheets[name], rules, whole=True)
+            for instrument, name in instrument_worksheets.items()}
+
+# Fold an instrument's worksheet into FacilityScoreStats chunk by chunk, straight from the sheet,
+# and append the same parsed chunks to the survey store when one is given, so row-level analyses
+# can select slices without the sheet ever being loaded whole.
+# Sheets has no per-row revision, so the spreadsheet's last update time is the change signal, as in
+# snapshot_key: while it is unchanged nothing is read, and once it moves (an edit to any row, or new
+# responses) the instrument is rebuilt from the top. A changed item list or pass rule, or a store that
+# does not hold exactly the rows streamed so far, also rebuilds. Returns the number of rows read.
+def stream_instrument_stats(spreadsheet, stats, instrument, chunk_rows=STREAM_CHUNK_ROWS, invalid_cells=None,
+                            store=None):
+    worksheet = list_worksheets(spreadsheet)[instrument_worksheets[instrument]]
+    modified = _spreadsheet_modified.get(spreadsheet.id)
+    items = instrument_items[instrument]
+    rule = _pass_rule_fingerprint(instrument_pass_rules[instrument])
+    seen = stats.seen.get(instrument, {})
+    end = seen.get('sheet_rows', 1)
+    if ('sheet_rows' not in seen or end > worksheet.row_count
+            or seen.get('items') != list(items)
+            or seen.get('passed') != rule
+            or seen.get('modified') != modified
+            or (store is not None and store.rows(worksheet.title) != end - 1)):
+        stats.drop(instrument)
+        end = 1
+    if end == 1 and store is not None:
+        store.drop(worksheet.title)
+
+    rows = 0
+    invalid = {}
+    for chunk in iter_worksheet_chunks(worksheet, chunk_rows, WORKSHEET_SCHEMAS.get(worksheet.title),
+                                       start_row=end + 1, invalid_cells=invalid):
+        if store is not None:
+            with tracer.stage('store_append', rows=len(chunk), worksheet=worksheet.title):
+                store.append(worksheet.title, chunk)
+        with tracer.stage('aggregation', rows=len(chunk), instrument=instrument):
+            stats.update(instrument, clean_instrument(instrument, chunk), items, instrument_pass_rules[instrument])
+        rows += len(chunk)
+    end += rows
+    # The sheet was read to its end, so rule outcomes of rows past it belong to deleted rows
+    data_rules.truncate(worksheet.title, end - 1)
+    stats.seen[instrument] = {'sheet_rows': end, 'items': list(items), 'passed': rule, 'modified': modified}
+    if invalid_cells is not None and invalid:
+        invalid_cells[worksheet.title] = pd.concat(invalid[worksheet.title], ignore_index=True)
+    return rows
+
+# Columns of the instrument worksheets that the row-level cells use (mentee panel, mentee matching,
+# combined scores), in cube names
+ROW_COLUMNS = ['mentee_id', 'Mentee', 'County', 'Facility', 'Survey', 'Score']
+
+# Instrument frames read from the survey store with only the given columns, cleaned like the sheets.
+# Used instead of the whole worksheets when they were streamed.
+def instrument_frames_from_store(store, columns=ROW_COLUMNS, rules=None):
+    frames = {}
+    for name, spec in INSTRUMENTS.items():
+        sheet_names = {new: old for old, new in spec.renames.items()}
+        stored = {col.lower() for col in store.columns(spec.worksheet)}
+        wanted = [sheet_names.get(col, col) for col in columns if sheet_names.get(col, col).lower() in stored]
+        frames[name] = clean_instrument(name, store.select(spec.worksheet, columns=wanted), rules, whole=True)
+    return frames
+
+"""# Paired comparisons
+Baseline vs Endline tests with the waves joined on mentee_id, for every stratum and measure in one call
+"""
 
 # @title
-NNR_Skills_df = NNR_Skills[['Mentee', 'mentee_id', 'County', 'Facility', \
-                            'Equipment_check', 'Dry_and_stimulate', 'ABC_assessment', 'Firm_seal', '40_60th_breaths', 'Chest_rise', \
-                            'Reassessment', 'Ratio_Vent_Compression', 'Oxygen', 'Message_to_mother', 'Score']]
-
-
-NNR_Skills_df.sample(3)
+# Mentee-indexed paired comparison engine
+from scipy import stats
+
+# Benjamini-Hochberg adjusted p-values (NaN p-values are left out)
+def fdr_bh(p_values):
+    p_values = np.asarray(p_values, dtype=float)
+    adjusted = np.full(p_values.shape, np.nan)
+    valid = np.flatnonzero(~np.isnan(p_values))
+    order = valid[np.argsort(p_values[valid])]
+    ranked = p_values[order] * len(order) / np.arange(1, len(order) + 1)
+    adjusted[order] = np.minimum.accumulate(ranked[::-1])[::-1].clip(max=1)
+    return adjusted
+
+# Join two waves on mentee id and return one row per mentee and measure with the change (after - before).
+# Strata columns are taken from the later wave; rows without an id cannot be paired and are dropped.
+def paired_differences(before, after, measures, strata=(), on='mentee_id'):
+    before = before.dropna(subset=[on]).drop_duplicates(on, keep='last').set_index(on)[measures]
+    after = after.dropna(subset=[on]).drop_duplicates(on, keep='last').set_index(on)[list(strata) + measures]
+    pairs = after.join(before, how='inner', rsuffix=' (before)')
+    long = []
+    for measure in measures:
+        long.append(pd.DataFrame({**{col: pairs[col].to_numpy() for col in strata},
+                                  'Measure': measure,
+                                  'Before': pairs[measure + ' (before)'].to_numpy(dtype=float),
+                                  'After': pairs[measure].to_numpy(dtype=float)}))
+    long = pd.concat(long, ignore_index=True)
+    long['Change'] = long['After'] - long['Before']
+    return long.dropna(subset=['Change'])
+
+# Paired t-test and Wilcoxon signed-rank test (normal approximation with tie correction,
+# zero changes dropped) for every group of a long frame of changes
+def _paired_group_tests(long, keys):
+    grouped = long.groupby(keys, observed=True, sort=False)
+    out = grouped.agg(n=('Change', 'size'), Before=('Before', 'mean'), After=('After', 'mean'),
+                      Change=('Change', 'mean'), sd=('Change', 'std'))
+    out['t'] = out['Change'] / (out['sd'] / np.sqrt(out['n']))
+    out['p (t-test)'] = 2 * stats.t.sf(np.abs(out['t']), out['n'] - 1)
+
+    nonzero = long[long['Change'] != 0].assign(magnitude=lambda d: d['Change'].abs())
+    nonzero['rank'] = nonzero.groupby(keys, observed=True, sort=False)['magnitude'].rank()
+    nonzero['positive'] = np.where(nonzero['Change'] > 0, nonzero['rank'], 0.0)
+    ties = nonzero.groupby(keys + ['magnitude'], observed=True, sort=False).size()
+    ties = (ties ** 3 - ties).groupby(level=keys, sort=False).sum()
+    signed = nonzero.groupby(keys, observed=True, sort=False).agg(n_r=('rank', 'size'), W=('positive', 'sum'))
+    signed['ties'] = ties
+    n_r = signed['n_r']
+    expected = n_r * (n_r + 1) / 4
+    variance = n_r * (n_r + 1) * (2 * n_r + 1) / 24 - signed['ties'] / 48
+    z = (signed['W'] - expected) / np.sqrt(variance)
+    out['W'] = signed['W']
+    out['p (Wilcoxon)'] = pd.Series(2 * stats.norm.sf(np.abs(z)), index=signed.index)
+    return out.drop(columns='sd')
+
+# waves: instrument -> (before, after) frames; measures: instrument -> numeric columns to compare.
+# levels: strata to test at, e.g. [(), ('County',), ('County', 'Facility')]; 'All' marks a pooled dimension.
+# Returns one row per instrument, stratum and measure with Benjamini-Hochberg adjusted p-values.
+@result_cache.memoize
+def paired_tests(waves, measures, levels=((),), on='mentee_id'):
+    dims = list(dict.fromkeys(dim for level in levels for dim in level))
+    with tracer.stage('paired_tests', instruments=len(waves)) as stage:
+        long = pd.concat([paired_differences(before, after, measures[instrument], dims, on)
+                          .assign(Instrument=instrument)
+                          for instrument, (before, after) in waves.items()], ignore_index=True)
+        stage['rows'] = len(long)
+        results = []
+        for level in levels:
+            pooled = long.assign(**{dim: ALL for dim in dims if dim not in level})
+            results.append(_paired_group_tests(pooled, ['Instrument'] + dims + ['Measure']))
+        results = pd.concat(results).reset_index()
+    results['p adj (t-test)'] = fdr_bh(results['p (t-test)'])
+    results['p adj (Wilcoxon)'] = fdr_bh(results['p (Wilcoxon)'])
+    return results
+
+"""# Bootstrap confidence intervals
+Percentile intervals for facility, county and item means from batched index resampling
+"""
 
 # @title
-print(NNR_Skills.shape) # row count ,column count
-print(NNR_Skills.isna().sum().sum()) # Check missingness
+# Vectorized bootstrap confidence intervals
+from concurrent.futures import ProcessPoolExecutor
+
+BOOTSTRAP_SEED = 2024
+
+# Percentile interval of the mean of each column of values (rows x measures).
+# Resamples are drawn as index arrays, a chunk of resamples at a time to bound memory.
+def _bootstrap_mean_ci(values, n_boot, level, seed, chunk_cells=4_000_000):
+    n = len(values)
+    if n < 2:
+        return np.full((2, values.shape[1]), np.nan)
+    rng = np.random.default_rng(seed)
+    means = np.empty((n_boot, values.shape[1]))
+    step = max(1, chunk_cells // (n * values.shape[1]))
+    for start in range(0, n_boot, step):
+        stop = min(n_boot, start + step)
+        means[start:stop] = values[rng.integers(0, n, size=(stop - start, n))].mean(axis=1)
+    tail = (100 - level) / 2
+    return np.percentile(means, [tail, 100 - tail], axis=0)
+
+def _bootstrap_strata(strata, n_boot, level):
+    return [_bootstrap_mean_ci(values, n_boot, level, seed) for values, seed in strata]
+
+# Bootstrap CI of the mean of `value` (a column or list of columns) for each group of `by`,
+# or for the whole frame ('Overall') when by is None.
+# Every stratum gets its own child seed, so results do not depend on the number of processes.
+# processes=None uses a process pool across strata for large runs.
+@result_cache.memoize
+def bootstrap_ci(df, by=None, value='Score', n_boot=10_000, level=95, seed=BOOTSTRAP_SEED, processes=None):
+    with tracer.stage('bootstrap_ci', rows=len(df), by=str(by), n_boot=n_boot):
+        return _bootstrap_ci(df, by, value, n_boot, level, seed, processes)
+
+def _bootstrap_ci(df, by, value, n_boot, level, seed, processes):
+    columns = [value] if isinstance(value, str) else list(value)
+    if by is None:
+        keys, groups = pd.Index(['Overall']), [np.arange(len(df))]
+    else:
+        grouped = df.groupby(by, observed=True, sort=False).indices
+        keys, groups = pd.Index(list(grouped), name=by if isinstance(by, str) else None), list(grouped.values())
+        if not isinstance(by, str):
+            keys = pd.MultiIndex.from_tuples(keys, names=by)
+    values = df[columns].to_numpy(dtype=float)
+    seeds = np.random.SeedSequence(seed).spawn(len(groups))
+    strata = [(values[rows], child) for rows, child in zip(groups, seeds)]
+
+    if processes is None:
+        processes = os.cpu_count() if len(strata) >= 64 else 1
+    if processes > 1:
+        chunks = [strata[i::processes] for i in range(processes)]
+        with ProcessPoolExecutor(processes) as pool:
+            parts = list(pool.map(_bootstrap_strata, chunks, [n_boot] * processes, [level] * processes))
+        bounds = [None] * len(strata)
+        for i, part in enumerate(parts):
+            bounds[i::processes] = part
+    else:
+        bounds = _bootstrap_strata(strata, n_boot, level)
+
+    bounds = np.stack(bounds)
+    if isinstance(value, str):
+        return pd.DataFrame({'CI low': bounds[:, 0, 0], 'CI high': bounds[:, 1, 0]}, index=keys)
+    index = pd.MultiIndex.from_product([keys, columns], names=list(keys.names) + ['Measure'])
+    ci = pd.DataFrame({'CI low': bounds[:, 0, :].ravel(), 'CI high': bounds[:, 1, :].ravel()}, index=index)
+    return ci.droplevel(0) if by is None else ci
+
+# Add bootstrap CI columns to a facility table, including its 'Overall' row
+def with_bootstrap_ci(table, df, by='Facility', **kwargs):
+    table = table.join(bootstrap_ci(df, by, **kwargs).round(1), on=by)
+    if 'Overall' in table.index:
+        table.loc['Overall', ['CI low', 'CI high']] = bootstrap_ci(df, **kwargs).round(1).iloc[0].to_numpy()
+    return table
+
+"""# Combined scores
+Each mentee's score on every instrument for one survey wave, joined locally on mentee_id
+"""
 
 # @title
-
-NNR_Skills_df = NNR_Skills_df[NNR_Skills_df['Score']>0]
-NNR_Skills_df.Facility.unique()
+# Combined score table and correlations
+class CombinedScores:
+    # table: one row per mentee_id with County and a score column per instrument.
+    # A mentee assessed more than once in the wave keeps the latest score.
+    def __init__(self, survey, instruments=tuple(INSTRUMENTS)):
+        self.survey = survey
+        self.instruments = list(instruments)
+        self.table = pd.DataFrame(columns=['County'] + self.instruments, index=pd.Index([], name='mentee_id'))
+        self.seen = {}
+
+    # Write the scores of a batch of instrument rows into the table by mentee_id
+    def upsert(self, instrument, df):
+        df = df[(df['Survey'] == self.survey) & df['mentee_id'].notna()]
+        batch = pd.DataFrame({'County': df['County'].astype(str).to_numpy(),
+                              instrument: df['Score'].astype('float64').to_numpy()},
+                             index=pd.Index(df['mentee_id'].to_numpy(), name='mentee_id'))
+        batch = batch[~batch.index.duplicated(keep='last')]
+        table = self.table.reindex(self.table.index.union(batch.index))
+        table.loc[batch.index, instrument] = batch[instrument]
+        table['County'] = table['County'].fillna(batch['County'])
+        self.table = table.astype({name: 'float64' for name in self.instruments})
+
+    # Upsert the rows appended to an instrument's frame since the last refresh, like
+    # FacilityScoreStats.refresh; an edit to any row already upserted reloads that instrument's column.
+    def refresh(self, instrument, df):
+        seen = self.seen.get(instrument, {})
+        start = seen.get('rows', 0)
+        if start and (start > len(df) or seen.get('prefix') != _prefix_fingerprint(df, start)):
+            self.table[instrument] = np.nan
+            start = 0
+        self.upsert(instrument, df.iloc[start:])
+        self.seen[instrument] = {'rows': len(df), 'prefix': _prefix_fingerprint(df, len(df))}
+        return len(df) - start
+
+    # Pearson or Spearman correlation of every pair of instruments over the mentees having both scores
+    def correlations(self, method='pearson', county=None):
+        return correlation_matrix(self._scores(county), method)
+
+    # Number of mentees behind each pairwise correlation
+    def pair_counts(self, county=None):
+        present = self._scores(county).notna().astype(np.int64)
+        return present.T @ present
+
+    def _scores(self, county):
+        table = self.table if county is None else self.table[self.table['County'] == county]
+        return table[self.instruments]
+
+@result_cache.memoize
+def correlation_matrix(scores, method='pearson'):
+    return scores.corr(method=method)
+
+# The notebook's combined scores, kept across reruns of the cell that refreshes them
+combined = None
+
+"""# Mentee panel
+Every mentee's score in every survey wave and instrument in one dense array, so changes, trajectories
+and retention between any waves are whole-cohort array operations
+"""
 
 # @title
-NNR_Skills_df['Score']\
-.describe()\
-.round(1)
-
-#NNR Skills Score by county
-# Calculate nnr overall summary
-nnr_overall_summary = NNR_Skills_df['Score'].agg(['mean', 'std', 'count']).round(1).to_frame().T
-nnr_overall_summary.columns = ['Mean', 'Std', 'Count']
-nnr_overall_summary.index = ['Overall']
-
-# Calculate mean, standard deviation, and count by county
-mean_nnr_score_by_facility = NNR_Skills_df[['Facility', 'Score']] \
-                .groupby('Facility') \
-                .agg({'Score': ['mean', 'std', 'count']}) \
-                .round(1) \
-                .sort_values(('Score', 'mean'), ascending=True)
-
-# Rename columns for clarity
-mean_nnr_score_by_facility.columns = ['Mean', 'Std', 'Count']
-
-# Reset index to make 'county' a regular column
-mean_nnr_score_by_facility.reset_index(inplace=True)
-mean_nnr_score_by_county = pd.concat([mean_nnr_score_by_facility, nnr_overall_summary])
-# print(mean_score_by_county)
-
-table2 = tabulate(mean_nnr_score_by_county, headers='keys')
-
-
-
-# Display the table
-print(table2)
+# Mentee x wave x instrument panel
+# Known waves in this order, any others after them alphabetically
+WAVE_ORDER = ['Baseline', 'Midline', 'Endline']
+# Wave of the rows in each instrument's baseline worksheet
+BASELINE_WAVE = 'Baseline'
+
+def _wave_index(waves):
+    waves = set(waves)
+    return pd.Index([wave for wave in WAVE_ORDER if wave in waves] + sorted(waves - set(WAVE_ORDER)), name='Wave')
+
+class MenteePanel:
+    # scores: float32 array of shape (mentees, waves, instruments), NaN where a mentee was not assessed
+    # mentees, waves, instruments: indexes mapping labels to positions along each axis
+    # attributes: County and Facility of each mentee from their latest assessment, aligned with mentees
+    def __init__(self, scores, mentees, waves, instruments, attributes):
+        self.scores = scores
+        self.mentees = mentees
+        self.waves = waves
+        self.instruments = instruments
+        self.attributes = attributes
+
+    # frames: instrument -> rows with mentee_id, Survey, County, Facility and Score.
+    # baselines: instrument -> baseline worksheet rows, placed in BASELINE_WAVE. A BASELINE_WAVE row in
+    # the instrument's own worksheet takes precedence, and a mentee assessed more than once in a wave keeps
+    # the latest score. Baseline rows without a mentee_id get negative placeholder ids: they count in
+    # their wave's distribution but never pair across waves.
+    @classmethod
+    def build(cls, frames, baselines=None):
+        sources = [(instrument, df, False) for instrument, df in (baselines or {}).items() if df is not None] \
+                  + [(instrument, df, True) for instrument, df in frames.items()]
+        instruments = pd.Index(list(dict.fromkeys(instrument for instrument, df, in_sheet in sources)),
+                               name='Instrument')
+        surveys = [df['Survey'].astype('category') if in_sheet else None for instrument, df, in_sheet in sources]
+        waves = _wave_index([BASELINE_WAVE] * any(s is None for s in surveys)
+                            + [wave for s in surveys if s is not None for wave in s.cat.categories.astype(str)])
+
+        instrument_codes, wave_codes, ids, values = [], [], [], []
+        for (instrument, df, in_sheet), survey in zip(sources, surveys):
+            n = len(df)
+            instrument_codes.append(np.full(n, instruments.get_loc(instrument)))
+            if survey is None:
+                wave_codes.append(np.full(n, waves.get_loc(BASELINE_WAVE)))
+            else:
+                wave_codes.append(waves.get_indexer(survey.cat.categories.astype(str))[survey.cat.codes.to_numpy()])
+            ids.append(pd.to_numeric(df['mentee_id'], errors='coerce').to_numpy(dtype=float)
+                       if 'mentee_id' in df else np.full(n, np.nan))
+            values.append(df['Score'].to_numpy(dtype=float))
+        instrument_codes, wave_codes, ids, values = map(np.concatenate, (instrument_codes, wave_codes, ids, values))
+
+        anonymous = np.isnan(ids)
+        ids[anonymous] = -np.arange(1, anonymous.sum() + 1)
+        mentee_codes, mentees = pd.factorize(ids.astype(np.int64), sort=True)
+        rows = np.arange(len(ids))
+
+        # Flat cell of each scored row; the last row written to a cell wins
+        scored = ~np.isnan(values)
+        cells = (mentee_codes * len(waves) + wave_codes) * len(instruments) + instrument_codes
+        last = np.full(len(mentees) * len(waves) * len(instruments), -1)
+        np.maximum.at(last, cells[scored], rows[scored])
+        scores = np.full((len(mentees), len(waves), len(instruments)), np.nan, dtype=np.float32)
+        filled = last >= 0
+        scores.reshape(-1)[filled] = values[last[filled]]
+
+        # County and Facility from each mentee's last row, looked up in the frame that row came from
+        last_row = np.full(len(mentees), -1)
+        np.maximum.at(last_row, mentee_codes, rows)
+        offsets = np.cumsum([0] + [len(df) for instrument, df, in_sheet in sources])
+        source = np.searchsorted(offsets, last_row, side='right') - 1
+        attributes = pd.DataFrame({'County': np.full(len(mentees), None, dtype=object),
+                                   'Facility': np.full(len(mentees), None, dtype=object)})
+        for s, (instrument, df, in_sheet) in enumerate(sources):
+            take = np.flatnonzero(source == s)
+            for col in ('County', 'Facility'):
+                if col in df and len(take):
+                    attributes.loc[take, col] = df[col].iloc[last_row[take] - offsets[s]].astype(object).to_numpy()
+        # Baseline worksheets have no County; take it from the facility
+        county_of = attributes.dropna().drop_duplicates('Facility', keep='last').set_index('Facility')['County']
+        attributes['County'] = attributes['County'].fillna(attributes['Facility'].map(county_of))
+        attributes.index = pd.Index(mentees, name='mentee_id')
+        return cls(scores, pd.Index(mentees, name='mentee_id'), waves, instruments, attributes)
+
+    def __len__(self):
+        return len(self.mentees)
+
+    # Boolean mask over mentees of a county and/or facility
+    def mentee_mask(self, county=None, facility=None):
+        mask = np.ones(len(self), dtype=bool)
+        if county is not None:
+            mask &= (self.attributes['County'] == county).to_numpy()
+        if facility is not None:
+            mask &= (self.attributes['Facility'] == facility).to_numpy()
+        return mask
+
+    def _wave_positions(self, waves):
+        return np.arange(len(self.waves)) if waves is None else self.waves.get_indexer_for(list(waves))
+
+    # Scores of one instrument as a mentee x wave frame, for mentees assessed in at least one of the waves
+    def trajectories(self, instrument, waves=None, county=None, facility=None):
+        positions = self._wave_positions(waves)
+        mask = self.mentee_mask(county, facility)
+        data = self.scores[mask][:, positions, self.instruments.get_loc(instrument)]
+        assessed = np.isfinite(data).any(axis=1)
+        return pd.DataFrame(data[assessed], index=self.mentees[mask][assessed], columns=self.waves[positions])
+
+    # Before, after and change for every identified mentee assessed in both waves
+    def deltas(self, instrument, before, after, county=None, facility=None):
+        pair = self.scores[:, self._wave_positions([before, after]), self.instruments.get_loc(instrument)]
+        both = self.mentee_mask(county, facility) & (self.mentees >= 0) & np.isfinite(pair).all(axis=1)
+        return pd.DataFrame({**{col: self.attributes[col].to_numpy()[both] for col in ('County', 'Facility')},
+                             before: pair[both, 0], after: pair[both, 1],
+                             'Change': pair[both, 1] - pair[both, 0]},
+                            index=self.mentees[both])
+
+    # Percentage of the identified mentees assessed in each wave (rows) who were also assessed in each
+    # other wave (columns), on one instrument or any; counts=True gives the numbers of mentees instead
+    def retention(self, instrument=None, county=None, facility=None, counts=False):
+        scores = self.scores if instrument is None else self.scores[:, :, [self.instruments.get_loc(instrument)]]
+        mask = self.mentee_mask(county, facility) & (self.mentees >= 0)
+        present = np.isfinite(scores[mask]).any(axis=2).astype(np.int64)
+        both = present.T @ present
+        if not counts:
+            both = both / np.maximum(np.diag(both), 1)[:, None] * 100
+        return pd.DataFrame(both, index=self.waves, columns=self.waves)
+
+    # One row per mentee and wave with a score (mentee_id, Facility, Wave, Score), e.g. to chart distributions
+    def long(self, instrument, waves=None, county=None, facility=None):
+        positions = self._wave_positions(waves)
+        mask = self.mentee_mask(county, facility)
+        data = self.scores[mask][:, positions, self.instruments.get_loc(instrument)]
+        mentee, wave = np.nonzero(np.isfinite(data))
+        return pd.DataFrame({'mentee_id': self.mentees[mask][mentee],
+                             'Facility': self.attributes['Facility'].to_numpy()[mask][mentee],
+                             'Wave': pd.Categorical.from_codes(wave, self.waves[positions]),
+                             'Score': data[mentee, wave]})
+
+"""# Mentee matching
+Completion rows are linked to assessed mentees by ID, then by name within the same facility
+"""
 
 # @title
-#
-# Create the bar chart with sorted data
-mean_nnr_score_by_facility = mean_nnr_score_by_facility[mean_nnr_score_by_facility['Count'] != 40]
-plt.figure(figsize=(10, 6))
-sns.barplot(x='Facility',
-            y='Mean',
-            data=mean_nnr_score_by_facility,
-            palette='viridis')
-
-# Add labels to the bars
-for index, value in enumerate(mean_nnr_score_by_facility['Mean']):
-    plt.text(index, value - 0.5, str(value), va='bottom', ha='center', fontsize=10)
-
-
-
-# Add horizontal line at the target value of 80
-plt.axhline(y=90, color='red', linestyle='--', label='KPI Target (90) vs. Mean(95.4)')
-
-plt.title('Mean Score by Facility (Ascending Order)')
-plt.xlabel('County')
-plt.ylabel('Mean Score')
-plt.xticks(rotation=45, ha='right')
-plt.ylim(0,120)
-
-# Show the legend
-plt.legend()
-plt.ylabel("Neonatal Resuscitation Score")
-plt.xlabel('Facility')
-
-plt.tight_layout()
-
-# Show the chart
-plt.show()
+# Record linkage against the mentee roster
+import unicodedata
+from scipy import sparse
+
+# Minimum cosine similarity of name trigrams for a name match
+MATCH_THRESHOLD = 0.6
+
+# Lowercase ASCII with punctuation dropped, e.g. "Murang'a West HC" -> 'muranga west hc'.
+# Each distinct value is normalized once.
+def normalize_keys(values):
+    codes, uniques = pd.factorize(values.astype(object).where(values.notna(), ''))
+    uniques = pd.Series(uniques, dtype=object).astype(str)
+    uniques = uniques.map(lambda v: unicodedata.normalize('NFKD', v).encode('ascii', 'ignore').decode())
+    uniques = uniques.str.lower().str.replace("'", '', regex=False).str.replace(r'[^a-z0-9]+', ' ', regex=True)
+    uniques = uniques.str.strip().to_numpy(dtype=object)
+    return pd.Series(uniques[codes] if len(uniques) else [], index=values.index, dtype=object)
+
+# Normalized names with their words sorted, so 'DOE, Jane' and 'jane doe' are the same name
+def normalize_names(names):
+    return normalize_keys(names).map(lambda name: ' '.join(sorted(name.split())))
+
+# One row per assessed mentee_id with the name and facility seen in the instrument frames,
+# preferring rows that carry a name (blank cells arrive as '', so a name is whatever normalizes to text)
+def mentee_roster(frames):
+    columns = ['mentee_id', 'Mentee', 'Facility', 'County']
+    roster = pd.concat([df[[col for col in columns if col in df]].astype(object) for df in frames.values()],
+                       ignore_index=True).reindex(columns=columns)
+    roster = roster[roster['mentee_id'].notna()]
+    roster = roster.assign(named=normalize_names(roster['Mentee']) != '').sort_values('named', kind='stable')
+    return roster.drop_duplicates('mentee_id', keep='last').drop(columns='named').reset_index(drop=True)
+
+# Row number and integer key of every character trigram of every (normalized, ASCII) name.
+# The key packs the three 7-bit characters together with the row's block code, so names
+# in different blocks never share a feature. Names are laid out as a byte matrix, so all
+# trigrams come from three shifted column slices.
+def _block_trigrams(names, blocks):
+    padded = ('  ' + names + '  ').tolist()
+    lengths = np.fromiter(map(len, padded), dtype=np.int64, count=len(padded))
+    width = int(lengths.max(initial=3))
+    chars = np.array(padded, dtype=f'S{width}').view(np.uint8).reshape(len(padded), width).astype(np.int64)
+    grams = (chars[:, :-2] << 14) | (chars[:, 1:-1] << 7) | chars[:, 2:]
+    rows, starts = np.nonzero(np.arange(width - 2) < (lengths - 2)[:, None])
+    return rows, (blocks[rows].astype(np.int64) << 21) | grams[rows, starts]
+
+def _unit_rows(matrix):
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    return sparse.diags(1 / np.where(norms > 0, norms, 1)) @ matrix
+
+# Link records (with mentee_id, Mentee and Facility columns) to roster mentees.
+# Rows whose mentee_id is on the roster match by ID. The rest are compared by name with
+# mentees of the same facility only: names become L2-normalized trigram count vectors, and one
+# sparse product gives the cosine similarity of every pair that shares a block and a trigram.
+# Returns, aligned with records, the matched roster mentee_id, the match method
+# ('id', 'name' or 'none') and the name similarity.
+def match_mentees(records, roster, threshold=MATCH_THRESHOLD):
+    matches = pd.DataFrame({'matched_id': pd.Series(None, index=records.index, dtype=object),
+                            'Match': 'none', 'Match score': np.nan}, index=records.index)
+    by_id = records['mentee_id'].isin(roster['mentee_id']).to_numpy() if 'mentee_id' in records \
+        else np.zeros(len(records), dtype=bool)
+    matches.loc[by_id, 'matched_id'] = records.loc[by_id, 'mentee_id'].astype(object)
+    matches.loc[by_id, 'Match'] = 'id'
+    matches.loc[by_id, 'Match score'] = 1.0
+
+    # Blank names would all match each other, so rows without one on either side are left out
+    rest_names = normalize_names(records.loc[~by_id, 'Mentee'])
+    rest, rest_names = records[~by_id][rest_names != ''], rest_names[rest_names != '']
+    named_names = normalize_names(roster['Mentee'])
+    named, named_names = roster[named_names != ''], named_names[named_names != '']
+    if not len(rest) or not len(named):
+        return matches
+    blocks, _ = pd.factorize(pd.concat([normalize_keys(rest['Facility']), normalize_keys(named['Facility'])]))
+    rows_a, keys_a = _block_trigrams(rest_names, blocks[:len(rest)])
+    rows_b, keys_b = _block_trigrams(named_names, blocks[len(rest):])
+    vocabulary, features = np.unique(np.concatenate([keys_a, keys_b]), return_inverse=True)
+    a = sparse.csr_matrix((np.ones(len(rows_a)), (rows_a, features[:len(rows_a)])),
+                          shape=(len(rest), len(vocabulary)))
+    b = sparse.csr_matrix((np.ones(len(rows_b)), (rows_b, features[len(rows_a):])),
+                          shape=(len(named), len(vocabulary)))
+    similarity = (_unit_rows(a) @ _unit_rows(b).T).tocsr()
+
+    # Best candidate of every row: sort entries by row, then by descending similarity
+    counts = np.diff(similarity.indptr)
+    order = np.lexsort((-similarity.data, np.repeat(np.arange(len(rest)), counts)))
+    has_candidate = np.flatnonzero(counts)
+    first = order[similarity.indptr[has_candidate]]
+    score = similarity.data[first]
+    found = score >= threshold
+    index = rest.index[has_candidate[found]]
+    matches.loc[index, 'matched_id'] = named['mentee_id'].to_numpy()[similarity.indices[first[found]]]
+    matches.loc[index, 'Match'] = 'name'
+    matches.loc[index, 'Match score'] = score[found]
+    return matches
+
+# Mean score on every instrument and number of mentees by completion status, for matched rows.
+# scores is a table indexed by mentee_id such as CombinedScores.table.
+def completion_scores(completion, matches, scores, instruments=tuple(INSTRUMENTS)):
+    matched = matches['Match'] != 'none'
+    ids = pd.Index(matches.loc[matched, 'matched_id'].to_numpy()).astype(scores.index.dtype)
+    joined = scores.reindex(ids)[list(instruments)].assign(Status=completion.loc[matched, 'Status'].to_numpy())
+    return joined.groupby('Status', observed=True).agg(['mean', 'count']).round(1)
+
+"""# Charts
+Each chart is described by a ChartSpec and drawn by one renderer, either in the notebook or headless to image files
+"""
 
 # @title
-# Distribution of scores
-plt.figure(figsize=(10, 6))
-sns.histplot(
-    NNR_Skills_df['Score'],
-    kde= True
-
-)
-
-plt.title('NNR SKill Score Distribution')
-
-plt.ylabel('Frequency')
-plt.xlabel('NNR Skill Score')
-plt.xticks(rotation=45, ha='right')
-plt.ylim(0,30)
-plt.xlim(50,100)
-# Show the legend
-plt.legend()
-
-plt.tight_layout()
-
-# Show the chart
-plt.show()
+# Chart specs and renderers
+from dataclasses import fields
+from matplotlib.figure import Figure
+
+@dataclass
+class ChartSpec:
+    kind: str                     # 'bar', 'hist', 'box' and 'heatmap' draw rows; 'binned_hist' and 'bxp' draw
+    data: pd.DataFrame            # summaries (ScoreDistribution.to_frame and box_table)
+    x: str = None
+    y: str = None
+    hue: str = None
+    title: str = ''
+    xlabel: str = None
+    ylabel: str = None
+    xlim: tuple = None
+    ylim: tuple = None
+    target: float = None          # KPI target drawn as a dashed red line
+    target_label: str = None
+    bar_labels: bool = False      # write each bar's value above it
+    label_offset: float = 0.5
+    label_fontsize: int = 10
+    errorbars: bool = False       # error_low / error_high columns around y
+    error_low: str = 'CI low'
+    error_high: str = 'CI high'
+    kde: bool = False
+    bin_width: float = HIST_DISPLAY_WIDTH   # bar width of a 'binned_hist'
+    palette: str = 'viridis'
+    rotate_xticks: bool = True
+    xtick_size: float = None
+    figsize: tuple = (10, 6)
+    name: str = None              # file name when rendered headless
+
+# Draw a chart spec onto a matplotlib Axes
+def draw_chart(spec, ax):
+    data = spec.data
+    if spec.x in getattr(data, 'columns', ()) and isinstance(data[spec.x].dtype, pd.CategoricalDtype):
+        # Only plot the categories left after filtering, e.g. one county's facilities
+        data = data.assign(**{spec.x: data[spec.x].cat.remove_unused_categories()})
+    if spec.kind == 'bar':
+        sns.barplot(x=spec.x, y=spec.y, data=data, palette=spec.palette, ax=ax)
+        if spec.bar_labels:
+            for index, value in enumerate(data[spec.y]):
+                ax.text(index, value + spec.label_offset, str(value), ha='center', va='bottom',
+                        fontsize=spec.label_fontsize)
+        if spec.errorbars:
+            ax.errorbar(range(len(data)), data[spec.y],
+                        yerr=[data[spec.y] - data[spec.error_low], data[spec.error_high] - data[spec.y]],
+                        fmt='none', ecolor='black', capsize=3)
+    elif spec.kind == 'hist':
+        sns.histplot(data[spec.x], kde=spec.kde, ax=ax)
+    elif spec.kind == 'box':
+        sns.boxplot(x=spec.x, y=spec.y, hue=spec.hue, data=data, palette=spec.palette, ax=ax)
+    elif spec.kind == 'binned_hist':
+        # Fine bins are summed into bars of bin_width; the KDE is scaled to the bar width
+        left = data[spec.x].to_numpy()
+        step = left[1] - left[0]
+        factor = max(int(round(spec.bin_width / step)), 1)
+        bars = np.bincount(np.arange(len(data)) // factor, weights=data['Count'].to_numpy())
+        ax.bar(left[::factor], bars, width=factor * step, align='edge', alpha=0.6, edgecolor='white')
+        if spec.kde and 'KDE' in data:
+            ax.plot(left + step / 2, data['KDE'].to_numpy() * factor)
+        if spec.xlim is None:
+            scored = left[data['Count'].to_numpy() > 0]
+            if len(scored):
+                ax.set_xlim(scored.min() - spec.bin_width, scored.max() + 2 * spec.bin_width)
+    elif spec.kind == 'bxp':
+        boxes = ax.bxp(data.to_dict('records'), patch_artist=True, medianprops={'color': 'black'})
+        for patch, color in zip(boxes['boxes'], sns.color_palette(spec.palette, len(data))):
+            patch.set_facecolor(color)
+    elif spec.kind == 'heatmap':
+        sns.heatmap(data, annot=True, cmap='Blues', linewidths=.5, fmt='.2f', ax=ax)
+    else:
+        raise ValueError(f"Unknown chart kind: {spec.kind}")
+
+    if spec.target is not None:
+        ax.axhline(y=spec.target, color='red', linestyle='--', label=spec.target_label)
+    ax.set_title(spec.title)
+    if spec.xlabel is not None:
+        ax.set_xlabel(spec.xlabel)
+    if spec.ylabel is not None:
+        ax.set_ylabel(spec.ylabel)
+    if spec.rotate_xticks:
+        ax.tick_params(axis='x', labelrotation=45, labelsize=spec.xtick_size)
+        for label in ax.get_xticklabels():
+            label.set_horizontalalignment('right')
+    if spec.xlim is not None:
+        ax.set_xlim(*spec.xlim)
+    if spec.ylim is not None:
+        ax.set_ylim(*spec.ylim)
+    if ax.get_legend_handles_labels()[0]:
+        ax.legend()
+
+# Show a chart in the notebook
+def show_chart(spec):
+    with tracer.stage('draw_chart', rows=len(spec.data), kind=spec.kind, title=spec.title):
+        fig, ax = plt.subplots(figsize=spec.figsize)
+        draw_chart(spec, ax)
+        fig.tight_layout()
+    with tracer.stage('show_chart', kind=spec.kind, title=spec.title):
+        plt.show()
+
+# Content hash of a spec: its data plus every other field
+def chart_hash(spec):
+    digest = hashlib.sha1()
+    digest.update(pd.util.hash_pandas_object(spec.data, index=True).to_numpy().tobytes())
+    digest.update(repr(list(spec.data.columns)).encode())
+    digest.update(repr([getattr(spec, f.name) for f in fields(spec) if f.name != 'data']).encode())
+    return digest.hexdigest()
+
+# Render one spec to a file on a bare Figure (Agg canvas), so no display backend is needed
+def _render_chart_file(spec, path):
+    fig = Figure(figsize=spec.figsize)
+    draw_chart(spec, fig.subplots())
+    fig.tight_layout()
+    fig.savefig(path)
+    return path
+
+# Render named specs to out_dir on a process pool.
+# Charts whose content hash matches the manifest from the previous run are skipped.
+def render_chart_pack(specs, out_dir, fmt='png', processes=None):
+    os.makedirs(out_dir, exist_ok=True)
+    manifest_path = os.path.join(out_dir, 'manifest.json')
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    todo, paths, hashes = [], [], {}
+    for spec in specs:
+        path = os.path.join(out_dir, f"{spec.name}.{fmt}")
+        hashes[spec.name] = chart_hash(spec)
+        if manifest.get(spec.name) != hashes[spec.name] or not os.path.exists(path):
+            todo.append(spec)
+            paths.append(path)
+
+    if todo:
+        with tracer.stage('render_chart_pack', charts=len(todo)), ProcessPoolExecutor(processes) as pool:
+            list(pool.map(_render_chart_file, todo, paths))
+    manifest.update(hashes)
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    return {'rendered': len(todo), 'skipped': len(specs) - len(todo)}
+
+def _chart_name(*parts):
+    return re.sub(r'[^A-Za-z0-9]+', '_', '_'.join(parts)).strip('_').lower()
+
+# Specs for one county and survey wave: facility ranking, score distributions and item pass rates
+# per instrument, plus item pass rates for every facility in the county. Every chart is drawn from
+# cube summaries, so no rows are needed.
+def county_chart_specs(cube, county, survey):
+    specs = []
+    for instrument in cube.instruments:
+        try:
+            distribution = cube.distribution(instrument, county, survey)
+        except KeyError:
+            continue
+        label = INSTRUMENTS[instrument].label
+        target = INSTRUMENTS[instrument].kpi_target
+        target_label = f'KPI Target ({target})'
+        facilities = cube.facility_table(instrument, county, survey).drop(index='Overall')
+        specs.append(ChartSpec('bar', facilities, x='Facility', y='EB mean',
+                               title=f'{county} {survey}: Mean {label} Score by Facility, Shrunk Within County (Ascending Order)',
+                               xlabel='Facility', ylabel=f'EB Mean {label} Score', ylim=(0, 110),
+                               target=target, target_label=target_label, bar_labels=True,
+                               errorbars=True, error_low='EB low', error_high='EB high',
+                               name=_chart_name(county, survey, instrument, 'facility_means')))
+        specs.append(ChartSpec('binned_hist', distribution.to_frame(), x='Score', kde=True,
+                               title=f'{county} {survey}: {label} Score Distribution',
+                               xlabel=f'{label} Score', ylabel='Frequency',
+                               name=_chart_name(county, survey, instrument, 'distribution')))
+        specs.append(ChartSpec('bxp', box_table(cube.facility_distributions(instrument, county, survey)),
+                               title=f'{county} {survey}: {label} Score Distribution by Facility',
+                               xlabel='Facility', ylabel=f'{label} Score',
+                               target=target, target_label=target_label,
+                               name=_chart_name(county, survey, instrument, 'facility_distribution')))
+        # The county's item rows are looked up once and split by facility
+        item_rates = cube.facility_item_pass_rates(instrument, county, survey)
+        item_rates[None] = cube.item_pass_rates(instrument, county, survey)
+        no_items = item_rates[None].iloc[:0]
+        for facility in [None] + list(facilities['Facility']):
+            items = item_rates.get(facility, no_items) \
+                    .sort_values('Pass rate(%)', ascending=True) \
+                    .round(1) \
+                    .reset_index()
+            specs.append(ChartSpec('bar', items, x='Item', y='Pass rate(%)',
+                                   title=f'{facility or county} {survey}: {label} Pass Rate by Item',
+                                   xlabel=f'{label} Item', ylabel='Pass rate(%)', ylim=(0, 110),
+                                   bar_labels=True, label_fontsize=8,
+                                   name=_chart_name(county, survey, instrument, facility or '', 'item_pass_rates')))
+    return specs
+
+"""# Tables
+Aggregated frames are printed as text tables one row at a time, so output starts immediately
+and memory stays flat however many facilities there are
+"""
 
 # @title
-# Distribution of scores
-plt.figure(figsize=(10, 6))
-sns.boxplot(x='Facility',
-            y='Score',
-            data=NNR_Skills_df,
-            palette='viridis')
-
-
-
-# Add horizontal line at the target value of 80
-plt.axhline(y=90, color='red', linestyle='--', label='KPI Target (90)')
-
-plt.title('NNR SKill Score Distribution by Facility')
-plt.xlabel('Facility')
-plt.ylabel('NNR Skill Score')
-plt.xticks(rotation=45, ha='right', size=8)
-plt.ylim(70,100)
-
-# Show the legend
-plt.legend()
-
-plt.tight_layout()
-
-# Show the chart
-plt.show()
+# Streaming table renderer
+TABLE_PAGE_ROWS = 50
+TABLE_MAX_COLWIDTH = 30
+TABLE_CHUNK_ROWS = 1_000
+STRIPE = '\033[47m'
+RESET = '\033[0m'
+
+# Cell text for a chunk of one column: floats to fixed decimals, blanks for missing values,
+# cut to max_width with an ellipsis
+def _format_cells(values, decimals, max_width):
+    if pd.api.types.is_float_dtype(values):
+        text = values.map(lambda v: '' if pd.isna(v) else f"{v:.{decimals}f}")
+    else:
+        text = values.astype(object).map(lambda v: '' if pd.isna(v) else str(v))
+    if max_width:
+        long = text.str.len() > max_width
+        text = text.where(~long, text.str[:max_width - 1] + '…')
+    return text
+
+# Frame (index included as the first column) in chunks of chunk_rows rows
+def _table_chunks(df, index, chunk_rows):
+    for start in range(0, len(df), chunk_rows):
+        chunk = df.iloc[start:start + chunk_rows]
+        yield chunk.reset_index() if index else chunk
+
+# Yield a text table line by line. Column widths are found in a first pass over chunks and the
+# rows are formatted in a second, so at most chunk_rows rows are ever held as text.
+# The header is repeated at the top of every page of page_rows rows, and alternate rows
+# are striped with an ANSI background when stripes is set.
+def iter_table_lines(df, page_rows=TABLE_PAGE_ROWS, max_colwidth=TABLE_MAX_COLWIDTH, stripes=True,
+                     decimals=1, index=True, chunk_rows=TABLE_CHUNK_ROWS):
+    frame = df.reset_index().iloc[:0] if index else df.iloc[:0]
+    headers = [('' if str(col).startswith('level_') or col == 'index' else str(col)) for col in frame.columns]
+    if max_colwidth:
+        headers = [h if len(h) <= max_colwidth else h[:max_colwidth - 1] + '…' for h in headers]
+    widths = [len(h) for h in headers]
+    for chunk in _table_chunks(df, index, chunk_rows):
+        for i, col in enumerate(chunk.columns):
+            widths[i] = max(widths[i], _format_cells(chunk[col], decimals, max_colwidth).str.len().max())
+    numeric = [pd.api.types.is_numeric_dtype(frame[col]) for col in frame.columns]
+
+    def line(cells):
+        return '  '.join(cell.rjust(w) if right else cell.ljust(w)
+                         for cell, w, right in zip(cells, widths, numeric))
+
+    header = [line(headers), '  '.join('-' * w for w in widths)]
+    row = 0
+    for chunk in _table_chunks(df, index, chunk_rows):
+        cells = [_format_cells(chunk[col], decimals, max_colwidth).tolist() for col in chunk.columns]
+        for values in zip(*cells):
+            if row == 0 or (page_rows and row % page_rows == 0):
+                if row:
+                    yield ''
+                yield from header
+            text = line(values)
+            yield STRIPE + text + RESET if stripes and row % 2 == 0 else text
+            row += 1
+    if row == 0:
+        yield from header
+
+# Print one page of a table (page counts from 1), or the whole table a line at a time
+def print_table(df, page=None, page_rows=TABLE_PAGE_ROWS, **kwargs):
+    pages = max(1, -(-len(df) // page_rows))
+    if page is not None:
+        df = df.iloc[(page - 1) * page_rows:page * page_rows]
+    with tracer.stage('print_table', rows=len(df)):
+        for text in iter_table_lines(df, page_rows=page_rows, **kwargs):
+            print(text)
+    if page is not None:
+        print(f"page {page} of {pages}")
+
+"""# Instrument reports
+The same facility, item and baseline analysis for every registered instrument, read from the shared score cube
+"""
 
 # @title
-# Select columns for NNR Skills Item analysis
-NNR_Item_df = NNR_Skills_df[[ 'Equipment_check', 'Dry_and_stimulate', 'ABC_assessment', 'Firm_seal', '40_60th_breaths', \
-                             'Chest_rise', 'Reassessment', 'Ratio_Vent_Compression', 'Oxygen', 'Message_to_mother']]
-
-type(NNR_Item_df)
-
-# Calculate pass rate and sort values in ascending order
-result3 = pd.DataFrame(
-    NNR_Item_df
-    .apply(lambda x: x.eq('Yes').mean() * 100).round(1)  # Calculate pass rate
-    .reset_index()
-    .rename(columns={'index': 'Item', 0: 'Pass rate(%)'})
-    .sort_values('Pass rate(%)', ascending=True)  # Sort values by 'Pass Rate (%)' in ascending order
-)
-
+# Per-instrument report
+@dataclass
+class InstrumentReport:
+    instrument: Instrument
+    county: str
+    survey: str
+    rows: pd.DataFrame            # the instrument's rows for the county and survey wave
+    facilities: pd.DataFrame      # facility mean, std, count and bootstrap CI, with the 'Overall' row
+    items: pd.DataFrame           # item pass rates and bootstrap CI, ascending
+    item_stats: pd.DataFrame      # item difficulty, discrimination and alpha if deleted
+    reliability: pd.DataFrame     # test reliability overall, then by facility
+    distribution: ScoreDistribution = None    # binned scores from the cube
+    facility_distributions: dict = None       # facility -> binned scores
+    waves: pd.DataFrame = None    # box statistics of the baseline and current wave, from the mentee panel
+    paired: pd.DataFrame = None   # paired tests overall and by facility
+
+# Report of one instrument for a county (None for every county) and survey wave (None for all waves).
+# Facility and item figures are cube lookups and the baseline comparison comes from the mentee panel.
+# The county's rows, needed for the bootstrap intervals and item statistics, are an indexed select
+# from the survey store rather than a mask over the whole worksheet.
+def instrument_report(cube, store, panel, instrument, county=None, survey=None, baseline_wave=BASELINE_WAVE):
+    spec = INSTRUMENTS[instrument]
+    filters = {dim: value for dim, value in (('County', county), ('Survey', survey)) if value is not None}
+    rows = clean_instrument(instrument, store.select(spec.worksheet, **filters))
+    if not len(rows):
+        raise ValueError(f"No {instrument} rows for {filters}")
+
+    facilities = with_bootstrap_ci(cube.facility_table(instrument, county, survey), rows)
+    responses = ResponseMatrix.from_frame(rows, spec.items, spec.passed, groups=['Facility'])
+    item_ci = bootstrap_ci(pd.DataFrame(responses.data, columns=spec.items), value=spec.items)
+    items = cube.item_pass_rates(instrument, county, survey) \
+            .join(item_ci * 100) \
+            .sort_values('Pass rate(%)', ascending=True) \
+            .round(1)
+    item_stats, reliability = responses.item_statistics()
+    by_facility = responses.item_statistics('Facility')[1]
+    reliability = pd.concat([reliability, by_facility.set_axis(by_facility.index.get_level_values(0))])
+
+    waves = paired = None
+    compared = [baseline_wave, survey]
+    if survey not in (None, baseline_wave) and set(compared) <= set(panel.waves) \
+            and instrument in panel.instruments:
+        trajectories = panel.trajectories(instrument, compared, county=county)
+        waves = box_table({wave: ScoreDistribution.from_scores(trajectories[wave]) for wave in compared})
+        if len(waves) < 2:
+            waves = None
+        changes = panel.deltas(instrument, *compared, county=county)
+        if len(changes):
+            before = pd.DataFrame({'mentee_id': changes.index, 'Score': changes[baseline_wave].to_numpy()})
+            after = pd.DataFrame({'mentee_id': changes.index, 'Facility': changes['Facility'].to_numpy(),
+                                  'Score': changes[survey].to_numpy()})
+            paired = paired_tests({instrument: (before, after)}, {instrument: ['Score']},
+                                  levels=[(), ('Facility',)])
+    return InstrumentReport(spec, county, survey, rows, facilities, items, item_stats, reliability,
+                            cube.distribution(instrument, county, survey),
+                            cube.facility_distributions(instrument, county, survey), waves, paired)
+
+# Charts of a report by name: facility ranking, score distributions, item pass rates and baseline vs endline
+def report_chart_specs(report):
+    label, target = report.instrument.label, report.instrument.kpi_target
+    where = ' '.join(value for value in (report.county, report.survey) if value is not None)
+    prefix = f"{where}: " if where else ''
+    name = lambda chart: _chart_name(where, report.instrument.name, chart)
+    overall = report.facilities.loc['Overall', 'Mean']
+    charts = {
+        # Ranked by empirical-Bayes means with their credible intervals
+        'facility_means': ChartSpec('bar', report.facilities.drop(index='Overall'), x='Facility', y='EB mean',
+                                    title=f'{prefix}Mean {label} Score by Facility, Shrunk Within County (Ascending Order)',
+                                    xlabel='Facility', ylabel=f'EB Mean {label} Score', ylim=(0, 110),
+                                    target=target, target_label=f'KPI Target ({target}) vs mean ({overall})',
+                                    bar_labels=True, label_fontsize=8, errorbars=True,
+                                    error_low='EB low', error_high='EB high',
+                                    name=name('facility_means')),
+        'distribution': ChartSpec('binned_hist', report.distribution.to_frame(), x='Score', kde=True,
+                                  title=f'{prefix}{label} Score Distribution',
+                                  xlabel=f'{label} Score', ylabel='Frequency', xlim=(50, 100),
+                                  name=name('distribution')),
+        'facility_distribution': ChartSpec('bxp', box_table(report.facility_distributions),
+                                           title=f'{prefix}{label} Score Distribution by Facility',
+                                           xlabel='Facility', ylabel=f'{label} Score',
+                                           target=target, target_label=f'KPI Target ({target})',
+                                           name=name('facility_distribution')),
+        'item_pass_rates': ChartSpec('bar', report.items.reset_index(), x='Item', y='Pass rate(%)',
+                                     title=f'{prefix}{label} Pass Rate by Item',
+                                     xlabel=f'{label} Item', ylabel='Pass rate(%)', ylim=(0, 110),
+                                     bar_labels=True, label_fontsize=8, errorbars=True,
+                                     name=name('item_pass_rates')),
+    }
+    if report.waves is not None:
+        before, after = report.waves['label']
+        charts['baseline_endline'] = ChartSpec('bxp', report.waves, palette=None,
+                                               title=f'{prefix}{before} vs {after} {label} Score Distribution',
+                                               xlabel=f'{before} vs {after}', ylabel=f'{label} Score',
+                                               rotate_xticks=False, figsize=None,
+                                               name=name('baseline_endline'))
+    return charts
+
+# Print a report's tables and show its charts in the notebook
+def show_instrument_report(report, alpha=0.05):
+    label = report.instrument.label
+    charts = report_chart_specs(report)
+    print(f"{label} Score ({len(report.rows)} assessments)")
+    print(report.rows['Score'].describe().round(1))
+    print_table(report.facilities, stripes=False)
+    for chart in ('facility_means', 'distribution', 'facility_distribution'):
+        show_chart(charts[chart])
+
+    print_table(report.items)
+    print(report.item_stats.round(2))
+    print(report.reliability.round(2))
+    show_chart(charts['item_pass_rates'])
+
+    if 'baseline_endline' in charts:
+        show_chart(charts['baseline_endline'])
+    if report.paired is not None:
+        # t > 0 means the current wave scores higher than the baseline
+        t_statistic, p_value = report.paired.loc[0, ['t', 'p (t-test)']]
+        print("Paired T-test Results:")
+        print("T-statistic:", t_statistic)
+        print("P-value:", p_value)
+        if p_value < alpha:
+            print(f"Reject the null hypothesis: There is a significant difference between baseline and current {label} scores.")
+        else:
+            print(f"Fail to reject the null hypothesis: There is no significant difference between baseline and current {label} scores.")
+        # Paired tests by facility, with Benjamini-Hochberg adjusted p-values
+        print(report.paired.round(3))
 
-
-# Create the bar chart with sorted data
-plt.figure(figsize=(10, 6))
-sns.barplot(x='Item',
-            y='Pass rate(%)',
-            data=result3,
-            palette='viridis')
-
-# # Add labels to the bars
-for index, value in enumerate(result3['Pass rate(%)']):
-     plt.text(index, value + 0.5, str(value), ha='center', va='bottom', fontsize=10)
-
-plt.title('NNR Skill Pass Rate by Question')
-plt.xlabel('NNR Skill Item')
-plt.ylabel('Pass rate(%)')
-plt.xticks(rotation=45, ha='right')
-plt.ylim(0,110)
+"""# Read and process EmONC Knowledge Data"""
 
 # @title
-# Read previous EmONC Knowledge data
-# Access worksheet and convert it to a data frame
-Pre_NNR = spreadsheet.worksheet('NNR Pre')
-Pre_NNR_df = pd.DataFrame(Pre_NNR.get_all_records())
-Pre_NNR_df = Pre_NNR_df[['Facility','Score']]
-Current_NNR_df = NNR_Skills_df[['Facility','Score']]
-# print(Pre_Knowledge_df.sample(3))
-# print(Current_EmONC_Knowledge_df.sample(3))
-
-# Add a 'previous' label to Pre_Knowledge_df
-Pre_NNR_df_labeled = Pre_NNR_df.copy()
-Pre_NNR_df_labeled['Label'] = 'Baseline'
-
-# Add a 'current' label to Current_EmONC_Knowledge_df
-Current_NNR_df_labeled = Current_NNR_df.copy()
-Current_NNR_df_labeled['Label'] = 'Endline'
-
-# Concatenate the two dataframes
-concatenated_df1 = pd.concat([Pre_NNR_df_labeled, Current_NNR_df_labeled])
-concatenated_df1.sample(5)
-
-
+# Provide url of the G-Sheet where data is
+# googlesheet ID truncated for data protection purposes
+sheet_url = 'https://docs.google.com/spreadsheets/d/.....'
 
 # @title
-# Plot previous versus current score distribution
-
-sns.boxplot(y='Score',
-            x= 'Label',
-            data = concatenated_df1,
-            hue = 'Label'
-            )
-plt.title('Baseline vs Endline NNR Score Distribution')
-plt.ylabel('NNR Skill Score')
-plt.xlabel('Baseline vs Endline')
-plt.show()
+# Read in moh curriculum baseline data from google drive
+spreadsheet = gc.open_by_url(sheet_url)
 
-Pre_NNR_df_labeled.describe()
+# With STREAM_INGEST the instrument worksheets are never loaded whole: the cube cell below streams them
+# in row chunks into the facility statistics and the survey store instead
+STREAM_INGEST = False
 
-"""# Provider Confidence Analysis by County"""
+# Read the survey worksheets (only stale snapshots are refetched), typed by WORKSHEET_SCHEMAS
+invalid_cells = {}
+streamed = set(instrument_worksheets.values()) if STREAM_INGEST else set()
+sheets = ingest_worksheets(spreadsheet, names=[name for name in SURVEY_WORKSHEETS if name not in streamed],
+                           invalid_cells=invalid_cells)
+sheets.keys()
 
 # @title
-# Access worksheet and convert it to a data frame
-Provider_Confidence = spreadsheet.worksheet('Provider Confidence')
-Provider_Confidence_df = pd.DataFrame(Provider_Confidence.get_all_records())
-Provider_Confidence_df = Provider_Confidence_df[Provider_Confidence_df['Survey']=='Endline']
-Provider_Confidence_df.sample(3)
+# Keep the survey store in step with the worksheets; only appended rows are inserted
+survey_store = SurveyStore(os.path.join(SURVEY_STORE_DIR, f"emonc_{_table_name(str(spreadsheet.id))}.sqlite"))
+survey_store.sync_all(sheets)
 
 # @title
-Provider_Confidence_df.columns
+# Build the score cube for every county, facility and survey wave
+# Facility statistics persist between runs; only rows appended since the last run are aggregated.
+facility_stats = FacilityScoreStats.load(os.path.join(SNAPSHOT_DIR, str(spreadsheet.id), 'facility_stats'))
+if STREAM_INGEST:
+    # Each chunk goes to the statistics and the store; the cube is built from the statistics alone and
+    # the row-level cells below read just the columns they use from the store
+    for instrument in INSTRUMENTS:
+        new_rows = stream_instrument_stats(spreadsheet, facility_stats, instrument,
+                                           invalid_cells=invalid_cells, store=survey_store)
+        print(f"{instrument}: {new_rows} new rows")
+    with tracer.stage('cleaning'):
+        instrument_frames = instrument_frames_from_store(survey_store)
+else:
+    with tracer.stage('cleaning'):
+        instrument_frames = instrument_frames_from_sheets(sheets)
+    for instrument, df in instrument_frames.items():
+        with tracer.stage('aggregation', rows=len(df), instrument=instrument):
+            new_rows = facility_stats.refresh(instrument, df, instrument_items[instrument], instrument_pass_rules[instrument])
+        print(f"{instrument}: {new_rows} new rows")
+facility_stats.save()
+
+with tracer.stage('score_cube'):
+    score_cube = ScoreCube.build(None if STREAM_INGEST else instrument_frames, instrument_items,
+                                 instrument_pass_rules, stats=facility_stats)
+score_cube.scores.head()
 
 # @title
-Provider_Confidence_df = Provider_Confidence_df[['County', 'Facility','Postpartum_hemorrhage',\
-                                                 'Hypertension_in_pregnancy', 'Shoulder_dystocia',\
-                                                 'Birth_Asphyxia','Antepartum_hemorrhage', 'Score']]
-
-Provider_Confidence_df.sample(3)
-
-Provider_Confidence_df.columns
-
-Provider_Confidence_df.dtypes
-
-Provider_Confidence_df['Postpartum_hemorrhage']=Provider_Confidence_df['Postpartum_hemorrhage'].astype('int')
-Provider_Confidence_df['Hypertension_in_pregnancy']=Provider_Confidence_df['Hypertension_in_pregnancy'].astype('float')
-Provider_Confidence_df['Shoulder_dystocia']=Provider_Confidence_df['Shoulder_dystocia'].astype('int')
-Provider_Confidence_df['Birth_Asphyxia']=Provider_Confidence_df['Birth_Asphyxia'].astype('int')
-Provider_Confidence_df['Antepartum_hemorrhage']=Provider_Confidence_df['Antepartum_hemorrhage'].astype('int')
+# Cells that could not be parsed to their schema type (streamed worksheets included)
+pd.concat(invalid_cells.values()) if invalid_cells else 'No invalid cells'
 
 # @title
-# Convert the score into a float
-Provider_Confidence_df['Score'] = Provider_Confidence_df['Score'].str.rstrip('%').astype('float')
-Provider_Confidence_df.columns
-
-Provider_Confidence_df.Score.describe().round(1)
+# Rows excluded or flagged by the data-quality rules, with their sheet row numbers
+data_rules.report()
 
 # @title
-# Calculate the mean score by county, round it to one decimal place, and sort by score in ascending order
-mean_provider_confidence_Score_by_county = Provider_Confidence_df[['Facility', 'Score']] \
-                            .groupby('Facility') \
-                            .mean() \
-                            .round(1) \
-                            .sort_values(by='Score', ascending=True)
-
-# Create the bar chart with sorted data
-plt.figure(figsize=(10, 6))
-sns.barplot(x=mean_provider_confidence_Score_by_county.index,
-            y='Score',
-            data=mean_provider_confidence_Score_by_county,
-            palette='viridis')
-
-# Add labels to the bars
-for index, value in enumerate(mean_provider_confidence_Score_by_county['Score']):
-    plt.text(index, value + 0.5, str(value), ha='center', va='bottom', fontsize=8)
-
-# Add horizontal line at the target value of 80
-plt.axhline(y=80, color='red', linestyle='--', label='KPI Target (80)')
-
-plt.title('Mean Confidence Score by Facility (Ascending Order)')
-plt.xlabel('Facility')
-plt.ylabel('Mean Provider Confidence Score')
-plt.xticks(rotation=45, ha='right', size=10)
-plt.ylim(0,110)
-
-# Show the legend
-plt.legend()
-
-plt.tight_layout()
-
-# Show the chart
-plt.show()
-
-# Calculate mean, standard deviation, and count by county
-mean_provider_score_by_facility = Provider_Confidence_df[['Facility', 'Score']] \
-                .groupby('Facility') \
-                .agg({'Score': ['mean', 'std', 'count']}) \
-                .round(1) \
-                .sort_values(('Score', 'mean'), ascending=True)
-
-# Rename columns for clarity
-mean_provider_score_by_facility.columns = ['Mean', 'Std', 'Count']
+# Access EmONC Knowledge worksheet and convert it to a data frame
+EmONC_Knowledge = instrument_frames['Knowledge']
+EmONC_Knowledge.sample(3)
 
-# Reset index to make 'county' a regular column
-mean_provider_score_by_facility.reset_index(inplace=True)
-# print(mean_score_by_county)
+"""Specific County Selector
 
-table3 = tabulate(mean_provider_score_by_facility, headers='keys')
-print(table3)
+"""
 
 # @title
-# Distribution of provider confidence scores
-plt.figure(figsize=(10, 6))
-sns.histplot(
-    Provider_Confidence_df['Score'],
-    kde= True
-
-)
-
-plt.title('Provider Confidence Score Distribution')
+# County and survey wave to report on; every view below is a lookup in the score cube
+COUNTY = 'Muranga'
+SURVEY = 'Endline'
 
-plt.ylabel('Frequency')
-plt.xlabel('Provider Confidence Score')
-plt.xticks(rotation=45, ha='right')
-plt.ylim(0,12)
-plt.xlim(50,100)
-
-# Show the legend
-plt.legend()
-
-plt.tight_layout()
+EmONC_Knowledge.columns
 
-# Show the chart
-plt.show()
+"""# Instrument Analysis
+Knowledge, Neonatal Resuscitation Skills and Provider Confidence, each reported the same way from its INSTRUMENTS entry
+"""
 
 # @title
-# Distribution of provider confidence scores by county
-plt.figure(figsize=(10, 6))
-sns.boxplot(x='Facility',
-            y='Score',
-            data=Provider_Confidence_df,
-            palette='viridis')
-
-# Add horizontal line at the target value of 80
-plt.axhline(y=80, color='red', linestyle='--', label='KPI Target (80)')
-
-plt.title('Provider ConfidenceScore Distribution by Facility')
-plt.xlabel('Facility')
-plt.ylabel('Provider Confidence Score')
-plt.xticks(rotation=45, ha='right')
-plt.ylim(50,100)
-
-# Show the legend
-plt.legend()
-
-plt.tight_layout()
-
-# Show the chart
-plt.show();
+# Baseline scores of every instrument, without test records
+baselines = {}
+for name, instrument in INSTRUMENTS.items():
+    baselines[name] = data_rules.apply(instrument.baseline_worksheet,
+                                       survey_store.select(instrument.baseline_worksheet), whole=True)
 
 # @title
-# %%capture
-# Select columns for NNR Skills Item analysis
-Provider_Confidence_Item_df = Provider_Confidence_df[[ 'Postpartum_hemorrhage','Hypertension_in_pregnancy', \
-                             'Shoulder_dystocia','Birth_Asphyxia','Antepartum_hemorrhage']]
-
-# Calculate pass rate and sort values in ascending order
-result_pc = pd.DataFrame(
-    Provider_Confidence_Item_df
-    .apply(lambda x: (x > 3).mean() * 100).round(1)  # Calculate pass rate(At least 4 in confidence rating)
-    .reset_index()
-    .rename(columns={'index': 'Item', 0: 'Pass rate(%)'})
-    .sort_values('Pass rate(%)', ascending=True)  # Sort values by 'Pass Rate (%)' in ascending order
-)
-
-
-# Create the bar chart with sorted data
-plt.figure(figsize=(10, 6))
-sns.barplot(x='Item',
-            y='Pass rate(%)',
-            data=result_pc,
-            palette='viridis')
-
-# # Add labels to the bars
-for index, value in enumerate(result_pc['Pass rate(%)']):
-     plt.text(index, value + 0.5, str(value), ha='center', va='bottom', fontsize=10)
-
-plt.title('Provider Confidence Rating >3')
-plt.xlabel('Provider Confidence Item')
-plt.ylabel('Pass rate(%)')
-plt.xticks(rotation=45, ha='right')
-plt.ylim(0,100)
-
-plt.show()
+# Every mentee's score in every wave and instrument; baseline worksheets fill the Baseline wave
+mentee_panel = MenteePanel.build(instrument_frames, baselines)
+print(mentee_panel.retention(county=COUNTY).round(1))
+print(mentee_panel.deltas('Knowledge', BASELINE_WAVE, SURVEY, county=COUNTY).describe().round(1))
 
 # @title
-# Read previous EmONC Knowledge data
-# Access worksheet and convert it to a data frame
-PC_Pre = spreadsheet.worksheet('PC Pre')
-PC_Pre_df = pd.DataFrame(PC_Pre.get_all_records())
-PC_Pre_df = PC_Pre_df[['Facility','Score']]
-Current_PC_df = Provider_Confidence_df[['Facility','Score']]
-# print(Pre_Knowledge_df.sample(3))
-# print(Current_EmONC_Knowledge_df.sample(3))
-
-# Add a 'previous' label to Pre_Knowledge_df
-PC_Pre_df_labeled = PC_Pre_df.copy()
-PC_Pre_df_labeled['Label'] = 'Baseline'
-
-# Add a 'current' label to Current_EmONC_Knowledge_df
-Current_PC_df_labeled = Current_PC_df.copy()
-Current_PC_df_labeled['Label'] = 'Endline'
-
-# Concatenate the two dataframes
-concatenated_df3 = pd.concat([PC_Pre_df_labeled, Current_PC_df_labeled])
-concatenated_df3.sample(5)
+# Facility scores, item pass rates, item statistics and the paired baseline comparison per instrument
+instrument_reports = {name: instrument_report(score_cube, survey_store, mentee_panel, name, COUNTY, SURVEY)
+                      for name in INSTRUMENTS}
 
 # @title
-# Plot previous versus current score distribution
-
-sns.boxplot(y='Score',
-            x= 'Label',
-            data = concatenated_df3,
-            hue = 'Label'
-            )
-plt.title('Baseline vs Endline Provider Confidence Score Distribution')
-plt.ylabel('Provider Confidence Score')
-plt.xlabel('Baseline vs Endline')
-plt.show()
-
-# Perform paired T-test
-t_statistic, p_value = ttest_rel(PC_Pre_df_labeled['Score'], Current_PC_df_labeled['Score'])
-
-# Output the results
-print("Paired T-test Results:")
-print("T-statistic:", t_statistic)
-print("P-value:", p_value)
-
-# Interpret the results
-alpha = 0.05  # You can set your desired significance level here
-if p_value < alpha:
-    print("Reject the null hypothesis: There is a significant difference between baseline and endline knowledge scores.")
-else:
-    print("Fail to reject the null hypothesis: There is no significant difference between baseline and endline knowledge scores.")
-
-PC_Pre_df_labeled.describe()
+# Tables and charts of every instrument, in registry order
+for report in instrument_reports.values():
+    show_instrument_report(report)
 
 # CME & DRILL Completion
-cme_completion = spreadsheet.worksheet('CME Completion')
-cme_completion = pd.DataFrame(cme_completion.get_all_records())
+cme_completion = sheets['CME Completion']
 cme_completion.sample(3)
 
 cme_completion.columns
 
-# Summarize CME Completion
-cme_completion = cme_completion[cme_completion['mentee match'] != 'Not a match']
+# Link completion rows to assessed mentees by ID, then by name within the facility
+mentees = mentee_roster(instrument_frames)
+cme_matches = match_mentees(cme_completion, mentees)
+print(cme_matches['Match'].value_counts())
+
+# Summarize CME Completion for matched mentees
+cme_completion = data_rules.apply('CME Completion', cme_completion.assign(Match=cme_matches['Match']), whole=True)
 proportion_complete = (cme_completion['Status'] == 'Complete').mean()
 print(f"Proportion of complete: {proportion_complete}")
 
@@ -858,46 +2548,1042 @@ proportion_complete = num_complete
 
 print(f"Proportion of complete: {proportion_complete}")
 
-drill_completion = spreadsheet.worksheet('Drill Completion')
-drill_completion = pd.DataFrame(drill_completion.get_all_records())
+drill_completion = sheets['Drill Completion']
 drill_completion.sample(3)
 
-# Summarize CME Completion
-drill_completion = drill_completion[drill_completion['mentee match'] != 'Not a match']
+drill_matches = match_mentees(drill_completion, mentees)
+print(drill_matches['Match'].value_counts())
+
+# Summarize Drill Completion for matched mentees
+drill_completion = data_rules.apply('Drill Completion', drill_completion.assign(Match=drill_matches['Match']),
+                                    whole=True)
 proportion_complete = (drill_completion['Status'] == 'Complete').mean()
 print(f"Proportion of complete: {proportion_complete}")
 
 drill_completion.describe()
 
-# Access combined scores worksheet and convert it to a data frame
-combined_scores = spreadsheet.worksheet('Combined scores')
-combined_scores = pd.DataFrame(combined_scores.get_all_records())
+# Combined scores of every mentee in the survey wave, joined on mentee_id across the instrument frames.
+# Rerunning the cell after new rows arrive only upserts the new rows.
+if combined is None or combined.survey != SURVEY:
+    combined = CombinedScores(SURVEY)
+for instrument, df in instrument_frames.items():
+    combined.refresh(instrument, df)
+combined_scores = combined.table
 combined_scores.sample(3)
 
-combined_scores.dtypes
+# Pairwise-complete correlations and the number of mentees behind each pair
+corr_matrix = combined.correlations('pearson')
+print(combined.correlations('spearman').round(2))
+combined.pair_counts()
 
-combined_scores['Knowledge Score'] = combined_scores['Knowledge Score'].str.strip('%').astype('float')
-combined_scores['Provider  Confidence Score'] = combined_scores['Provider  Confidence Score'].str.strip('%').astype('float')
+# Draw the heatmap
+show_chart(ChartSpec('heatmap', corr_matrix, title='Correlation Mentee Cohort',
+                     rotate_xticks=False, figsize=(6, 4)))
 
-combined_scores.rename(columns=column_mapper, inplace=True)
-combined_scores.sample(5)
+# @title
+# Scores of matched mentees by CME and Drill completion status
+print(completion_scores(sheets['CME Completion'], cme_matches, combined_scores))
+print(completion_scores(sheets['Drill Completion'], drill_matches, combined_scores))
 
-combined_scores.columns
+"""# County chart pack
+Writes every chart for every county and facility to image files, skipping charts whose inputs are unchanged
+"""
 
-corr_matrix = combined_scores[['Knowledge Score', 'NNR Score', 'Provider  Confidence Score']].corr()
-corr_matrix
+# @title
+# Render the chart pack headless
+RENDER_CHART_PACK = False
+CHART_DIR = os.path.join(SNAPSHOT_DIR, str(spreadsheet.id), 'charts')
+
+if RENDER_CHART_PACK:
+    counties = sorted(set(score_cube.scores.index.get_level_values('County')) - {ALL})
+    chart_specs = [spec
+                   for county in counties
+                   for spec in county_chart_specs(score_cube, county, SURVEY)]
+    print(render_chart_pack(chart_specs, CHART_DIR))
+
+"""# Sheets export
+Facility, item, paired-test and correlation tables written back to output worksheets, in one batched
+values update that only carries the ranges whose cells changed
+"""
 
-column_mapper = {'Provider  Confidence Score': 'Provider Confidence',
-                 }
+# @title
+# Batched, diffed write-back of summary tables
+import random
+
+# Output worksheets are named EXPORT_PREFIX + table name
+EXPORT_PREFIX = 'Output - '
+# Rate-limit (429) and server errors are retried with exponential backoff and jitter, capped per wait
+EXPORT_RETRY_STATUS = {429, 500, 502, 503, 504}
+EXPORT_RETRIES = 6
+EXPORT_BACKOFF_SECONDS = 1.0
+EXPORT_MAX_BACKOFF_SECONDS = 64.0
+SHEETS_MAX_CELLS = 10_000_000
+
+def _quote_title(title):
+    return "'" + title.replace("'", "''") + "'"
+
+# Header and rows of a table as RAW cell values: numbers stay numbers, missing and infinite values are
+# blank and everything else is text. A named or non-default index is written as leading columns.
+def sheet_values(df):
+    if not isinstance(df.index, pd.RangeIndex) or df.index.name is not None:
+        df = df.reset_index()
+    columns = []
+    for col in df.columns:
+        values = df[col]
+        if pd.api.types.is_bool_dtype(values) or not pd.api.types.is_numeric_dtype(values):
+            cells = values.astype(object).where(values.notna(), '').map(str).to_numpy(dtype=object)
+        else:
+            numbers = values.to_numpy(dtype='float64', na_value=np.nan)
+            cells = numbers.astype(object)
+            cells[~np.isfinite(numbers)] = ''
+        columns.append(cells)
+    rows = np.column_stack(columns).tolist() if len(df) and columns else []
+    return [[str(col) for col in df.columns]] + rows
+
+# Sheets drops trailing blank cells from the rows it returns
+def _trim(row):
+    end = len(row)
+    while end and row[end - 1] == '':
+        end -= 1
+    return row[:end]
+
+# Ranges of rows that differ between the worksheet's current values and the table, one per run of
+# consecutive changed rows. Cells past the table's end are blanked so a shrinking table leaves no tail.
+def changed_ranges(title, current, values):
+    width = max(map(len, current + values), default=0)
+    height = max(len(current), len(values))
+    row = lambda rows, i: _trim(list(rows[i])) if i < len(rows) else []
+    changed = [i for i in range(height) if row(current, i) != row(values, i)]
+    ranges = []
+    for i in changed:
+        padded = row(values, i) + [''] * (width - len(row(values, i)))
+        if ranges and ranges[-1][1] == i:
+            ranges[-1][1] += 1
+            ranges[-1][2].append(padded)
+        else:
+            ranges.append([i, i + 1, [padded]])
+    return [{'range': f"{_quote_title(title)}!{rowcol_to_a1(first + 1, 1)}:{rowcol_to_a1(last, width)}",
+             'values': rows}
+            for first, last, rows in ranges]
+
+class SheetsExporter:
+    def __init__(self, spreadsheet, prefix=EXPORT_PREFIX, retries=EXPORT_RETRIES, backoff=EXPORT_BACKOFF_SECONDS):
+        self.spreadsheet = spreadsheet
+        self.prefix = prefix
+        self.retries = retries
+        self.backoff = backoff
+        self.api_calls = 0
+
+    # Call the Sheets API, waiting out rate limits and transient server errors. Retry-After is honoured
+    # when the response gives one in seconds.
+    def _call(self, method, *args, **kwargs):
+        for attempt in range(self.retries + 1):
+            self.api_calls += 1
+            try:
+                return method(*args, **kwargs)
+            except gspread.exceptions.APIError as e:
+                status = getattr(e.response, 'status_code', None)
+                if status not in EXPORT_RETRY_STATUS or attempt == self.retries:
+                    raise
+                retry_after = str(getattr(e.response, 'headers', {}).get('Retry-After', ''))
+                delay = float(retry_after) if retry_after.isdigit() else self.backoff * 2 ** attempt * (1 + random.random())
+                time.sleep(min(delay, EXPORT_MAX_BACKOFF_SECONDS))
+
+    # Write tables (name -> DataFrame) to their output worksheets. Costs one metadata read, one structural
+    # update when worksheets must be added or grown, one batch read and one batch write of the changed
+    # ranges, however many tables there are. Returns rows, columns and the ranges written per worksheet.
+    def export(self, tables):
+        values = {self.prefix + name: sheet_values(df) for name, df in tables.items()}
+
+        with tracer.stage('sheets_export', tables=len(values)) as stage:
+            worksheets = self._call(list_worksheets, self.spreadsheet, refresh=True)
+            before = _spreadsheet_modified.get(self.spreadsheet.id)
+            # The cell limit is on the whole spreadsheet, so the grids of the other worksheets count too;
+            # nothing is written when the output would not fit
+            cells = sum(ws.row_count * ws.col_count for title, ws in worksheets.items() if title not in values)
+            sizes = {}
+            for title, rows in values.items():
+                size = {'rowCount': max(len(rows), 1), 'columnCount': max(map(len, rows))}
+                if title in worksheets:
+                    size = {'rowCount': max(worksheets[title].row_count, size['rowCount']),
+                            'columnCount': max(worksheets[title].col_count, size['columnCount'])}
+                sizes[title] = size
+                cells += size['rowCount'] * size['columnCount']
+            if cells > SHEETS_MAX_CELLS:
+                raise ValueError(f"The spreadsheet would hold {cells} cells after the export, "
+                                 f"over the {SHEETS_MAX_CELLS} cell limit")
+
+            requests = []
+            for title, size in sizes.items():
+                if title not in worksheets:
+                    requests.append({'addSheet': {'properties': {'title': title, 'gridProperties': size}}})
+                elif (worksheets[title].row_count, worksheets[title].col_count) != (size['rowCount'], size['columnCount']):
+                    requests.append({'updateSheetProperties': {
+                        'properties': {'sheetId': worksheets[title].id, 'gridProperties': size},
+                        'fields': 'gridProperties.rowCount,gridProperties.columnCount'}})
+            if requests:
+                self._call(self.spreadsheet.batch_update, {'requests': requests})
+
+            existing = [title for title in values if title in worksheets]
+            current = dict.fromkeys(values, [])
+            if existing:
+                response = self._call(self.spreadsheet.values_batch_get, [_quote_title(title) for title in existing],
+                                      params={'valueRenderOption': 'UNFORMATTED_VALUE'})
+                for title, value_range in zip(existing, response.get('valueRanges', [])):
+                    current[title] = value_range.get('values', [])
+
+            data, summary = [], []
+            for title, rows in values.items():
+                ranges = changed_ranges(title, current[title], rows)
+                data.extend(ranges)
+                summary.append({'Worksheet': title, 'Rows': len(rows) - 1, 'Columns': len(rows[0]),
+                                'Ranges written': len(ranges),
+                                'Rows written': sum(len(r['values']) for r in ranges)})
+            if data:
+                self._call(self.spreadsheet.values_batch_update, body={'valueInputOption': 'RAW', 'data': data})
+            if requests or data:
+                self._call(record_own_write, self.spreadsheet, before)
+            stage['rows'] = sum(row['Rows written'] for row in summary)
+        return pd.DataFrame(summary)
+
+# The tables published for a national refresh: every rollup of the score cube with its EB means,
+# county item pass rates, paired baseline tests at national, county and facility level, and the
+# instrument correlations. Rows are sorted so an unchanged group always lands on the same sheet rows.
+def summary_tables(cube, panel, combined, survey, baseline_wave=BASELINE_WAVE):
+    columns = {'count': 'Count', 'mean': 'Mean', 'std': 'Std'}
+    facilities = cube.scores.join(cube.shrunken)[list(columns) + ['EB mean', 'EB low', 'EB high']] \
+                 .rename(columns=columns).sort_index().round(1)
+
+    items = cube.items[cube.items.index.get_level_values('Facility') == ALL] \
+            [['Passed', 'Responses', 'Pass rate(%)']].sort_index().round(1)
+
+    waves = {}
+    compared = {baseline_wave, survey} <= set(panel.waves) and survey != baseline_wave
+    for instrument in panel.instruments if compared else []:
+        changes = panel.deltas(instrument, baseline_wave, survey)
+        if len(changes):
+            waves[instrument] = (pd.DataFrame({'mentee_id': changes.index, 'Score': changes[baseline_wave].to_numpy()}),
+                                 pd.DataFrame({'mentee_id': changes.index, 'County': changes['County'].to_numpy(),
+                                               'Facility': changes['Facility'].to_numpy(),
+                                               'Score': changes[survey].to_numpy()}))
+    paired = paired_tests(waves, {instrument: ['Score'] for instrument in waves},
+                          levels=[(), ('County',), ('County', 'Facility')]) \
+             .sort_values(['Instrument', 'County', 'Facility']).reset_index(drop=True).round(4) \
+             if waves else pd.DataFrame()
+
+    correlations = pd.concat({'Pearson': combined.correlations('pearson').round(3),
+                              'Spearman': combined.correlations('spearman').round(3),
+                              'Mentees': combined.pair_counts()}, names=['Statistic', 'Instrument'])
+    tables = {'Facility scores': facilities, 'Item pass rates': items, 'Correlations': correlations}
+    if len(paired):
+        tables['Paired tests'] = paired
+    return tables
 
-corr_matrix.rename(columns=column_mapper, inplace=True)
+# @title
+# Publish the summary tables to output worksheets of the survey spreadsheet (or of EXPORT_SHEET_URL)
+EXPORT_TO_SHEETS = False
+EXPORT_SHEET_URL = None
+
+if EXPORT_TO_SHEETS:
+    exporter = SheetsExporter(gc.open_by_url(EXPORT_SHEET_URL) if EXPORT_SHEET_URL else spreadsheet)
+    print(exporter.export(summary_tables(score_cube, mentee_panel, combined, SURVEY)))
+    print(f"{exporter.api_calls} Sheets API calls")
+
+"""# Query service
+Facility summaries, item pass rates and baseline vs endline from a cube kept warm in memory,
+over a Python API or local HTTP, without rerunning the notebook
+"""
 
-# Set up the matplotlib figure
-plt.figure(figsize=(6, 4))
+# @title
+# Warm-cache query service
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+START_QUERY_SERVER = False
+QUERY_SERVER_PORT = 8765
+QUERY_REFRESH_SECONDS = 300
+
+# Facility table with its 'Overall' row labelled in the Facility column
+def _label_overall(table):
+    return table.assign(Facility=table['Facility'].astype(object).where(table.index != 'Overall', 'Overall'))
+
+class SurveyService:
+    QUERIES = ('facility_summary', 'item_pass_rates', 'baseline_endline')
+
+    # spreadsheet: a gspread Spreadsheet, or SyntheticSpreadsheet to run offline
+    def __init__(self, spreadsheet, refresh_seconds=QUERY_REFRESH_SECONDS):
+        self.spreadsheet = spreadsheet
+        self.refresh_seconds = refresh_seconds
+        self.server = None
+        self._reload_lock = threading.Lock()
+        self._stop = threading.Event()
+        # Its own rule engine, so refreshes on the service thread leave the notebook's data_rules alone
+        self.rules = RuleEngine()
+        self.worksheets = [sheet for spec in INSTRUMENTS.values() for sheet in (spec.worksheet, spec.baseline_worksheet)]
+        self.reload()
+
+    # Last update time of the spreadsheet and sizes of the worksheets the service reads; edits and new
+    # form responses change them
+    def source_version(self):
+        worksheets = list_worksheets(self.spreadsheet, refresh=True)
+        return (_spreadsheet_modified.get(self.spreadsheet.id),) \
+            + tuple((name, worksheets[name].row_count, worksheets[name].col_count) for name in self.worksheets)
+
+    # Rebuild the cube and the mentee panel and swap them in with one assignment, so queries never see
+    # a half-built state. Only stale worksheets are refetched (see read_worksheet).
+    def reload(self):
+        with self._reload_lock:
+            version = self.source_version()
+            sheets = ingest_worksheets(self.spreadsheet, names=self.worksheets)
+            frames = instrument_frames_from_sheets(sheets, self.rules)
+            baselines = {name: self.rules.apply(spec.baseline_worksheet, sheets[spec.baseline_worksheet], whole=True)
+                         for name, spec in INSTRUMENTS.items()}
+            self._state = {'cube': ScoreCube.build(frames, instrument_items, instrument_pass_rules),
+                           'panel': MenteePanel.build(frames, baselines),
+                           'cache': {}, 'version': version, 'loaded_at': time.time()}
+
+    def refresh_if_changed(self):
+        if self.source_version() == self._state['version']:
+            return False
+        self.reload()
+        return True
+
+    # Poll the source every refresh_seconds on a daemon thread
+    def start_background_refresh(self):
+        def poll():
+            while not self._stop.wait(self.refresh_seconds):
+                try:
+                    self.refresh_if_changed()
+                except Exception as e:
+                    print(f"Query service refresh failed: {e}")
+        threading.Thread(target=poll, name='survey-refresh', daemon=True).start()
+
+    # Results are cached per query and parameters until the next reload
+    def _cached(self, name, params, compute):
+        state = self._state
+        key = (name,) + tuple(sorted(params.items()))
+        if key not in state['cache']:
+            state['cache'][key] = compute(state)
+        return state['cache'][key]
+
+    def facility_summary(self, instrument, county=None, survey=None):
+        return self._cached('facility_summary', {'instrument': instrument, 'county': county, 'survey': survey},
+                            lambda state: _label_overall(state['cube'].facility_table(instrument, county, survey)))
+
+    def item_pass_rates(self, instrument, county=None, survey=None, facility=None):
+        params = {'instrument': instrument, 'county': county, 'survey': survey, 'facility': facility}
+        return self._cached('item_pass_rates', params,
+                            lambda state: state['cube'].item_pass_rates(instrument, county, survey, facility).round(1))
+
+    # Facility means in the Baseline and Endline waves side by side, with the change. Baseline scores
+    # come from the baseline worksheets through the mentee panel; mentees count at their latest facility.
+    def baseline_endline(self, instrument, county=None):
+        waves = [BASELINE_WAVE, 'Endline']
+
+        def compute(state):
+            panel = state['panel']
+            if instrument not in panel.instruments:
+                raise KeyError(f"No instrument {instrument!r} in the mentee panel")
+            missing = [wave for wave in waves if wave not in panel.waves]
+            if missing:
+                raise KeyError(f"No {missing[0]} wave in the mentee panel")
+            scores = panel.trajectories(instrument, waves, county=county).astype(float)
+            if scores.empty:
+                raise KeyError(f"No {instrument} scores for county {county!r} in the {' or '.join(waves)} wave")
+            by_facility = scores.groupby(panel.attributes['Facility'].reindex(scores.index).rename('Facility'))
+            means, counts = by_facility.mean(), by_facility.count()
+            means.loc['Overall'], counts.loc['Overall'] = scores.mean(), scores.count()
+            table = pd.concat({f"{wave} {stat}": frame[wave] for wave in waves
+                               for stat, frame in (('Mean', means.round(1)), ('Count', counts))}, axis=1)
+            return table.assign(Change=(table[f"{waves[1]} Mean"] - table[f"{waves[0]} Mean"]).round(1)) \
+                        .rename_axis('Facility').reset_index()
+        return self._cached('baseline_endline', {'instrument': instrument, 'county': county}, compute)
+
+    # JSON-ready rows for a named query
+    def query(self, name, **params):
+        if name not in self.QUERIES:
+            raise ValueError(f"Unknown query: {name}")
+        result = getattr(self, name)(**params)
+        if result.index.name is not None:
+            result = result.reset_index()
+        return json.loads(result.to_json(orient='records'))
+
+    # Serve GET /<query>?instrument=...&county=...&survey=... on a background thread
+    def serve(self, port=QUERY_SERVER_PORT, host='127.0.0.1'):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                name = url.path.strip('/')
+                params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+                try:
+                    if name == 'health':
+                        state = service._state
+                        status, body = 200, {'loaded_at': state['loaded_at'], 'version': state['version']}
+                    else:
+                        status, body = 200, service.query(name, **params)
+                except KeyError as e:
+                    status, body = 404, {'error': e.args[0] if e.args else str(e)}
+                except (ValueError, TypeError) as e:
+                    status, body = 400, {'error': str(e)}
+                payload = json.dumps(body, default=str).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self.server.serve_forever, name='survey-http', daemon=True).start()
+        return self.server
+
+    def stop(self):
+        self._stop.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
 
-# Draw the heatmap
-sns.heatmap(corr_matrix, annot=True, cmap= 'Blues', linewidths=.5, fmt=".2f")
+# @title
+# Start the service on this runtime, e.g. GET http://127.0.0.1:8765/facility_summary?instrument=NNR&county=Muranga
+if START_QUERY_SERVER:
+    survey_service = SurveyService(spreadsheet)
+    survey_service.serve()
+    survey_service.start_background_refresh()
+
+"""# Pipeline trace
+Stage timings of this run, saved as JSON lines and as a Chrome trace when TRACE_PIPELINE is on
+"""
 
-# Adding titles and labels for clarity
-plt.title('Correlation Mentee Cohort')
-plt.show()
+# @title
+# Save and summarise the trace
+TRACE_DIR = os.path.join(SNAPSHOT_DIR, str(spreadsheet.id), 'traces')
+
+if tracer.enabled:
+    trace_run = time.strftime('%Y%m%dT%H%M%S')
+    tracer.save_json(os.path.join(TRACE_DIR, 'stages.jsonl'), run=trace_run)
+    tracer.save_chrome_trace(os.path.join(TRACE_DIR, f'trace_{trace_run}.json'))
+    print(tracer.summary())
+
+"""# Synthetic data and benchmarks
+Synthetic workbooks shaped like the real worksheets, an offline stand-in for the gspread spreadsheet,
+and a stage-by-stage benchmark of the pipeline
+"""
+
+# @title
+# Synthetic survey generator
+KENYA_COUNTIES = ['Baringo', 'Bomet', 'Bungoma', 'Busia', 'Elgeyo Marakwet', 'Embu', 'Garissa', 'Homa Bay',
+                  'Isiolo', 'Kajiado', 'Kakamega', 'Kericho', 'Kiambu', 'Kilifi', 'Kirinyaga', 'Kisii',
+                  'Kisumu', 'Kitui', 'Kwale', 'Laikipia', 'Lamu', 'Machakos', 'Makueni', 'Mandera',
+                  'Marsabit', 'Meru', 'Migori', 'Mombasa', 'Muranga', 'Nairobi', 'Nakuru', 'Nandi',
+                  'Narok', 'Nyamira', 'Nyandarua', 'Nyeri', 'Samburu', 'Siaya', 'Taita Taveta', 'Tana River',
+                  'Tharaka Nithi', 'Trans Nzoia', 'Turkana', 'Uasin Gishu', 'Vihiga', 'Wajir', 'West Pokot']
+
+def _answers(rng, n, p_pass, categories):
+    codes = (rng.random(n) < p_pass).astype(np.int8)
+    return pd.Categorical.from_codes(codes, categories=categories)
+
+# Raw worksheets for n mentees, shaped like get_all_records() output: Endline rows in the main
+# sheets, Baseline rows in the '... Pre' sheets and CME/Drill completion.
+# Answer columns are categoricals so 10M-row workbooks fit in memory.
+def make_synthetic_survey(n, seed=0, mentees_per_facility=40):
+    rng = np.random.default_rng(seed)
+    n_facilities = max(5, n // mentees_per_facility)
+    facility_county = rng.integers(0, len(KENYA_COUNTIES), n_facilities)
+    facilities = pd.Categorical.from_codes(rng.integers(0, n_facilities, n),
+                                           categories=[f'Facility {i:05d}' for i in range(n_facilities)])
+    counties = pd.Categorical.from_codes(facility_county[facilities.codes], categories=KENYA_COUNTIES)
+    mentee_id = rng.permutation(np.arange(100_000_000, 100_000_000 + n))
+    names = pd.Series(mentee_id).astype(str).radd('Mentee ')
+    endline = pd.Categorical.from_codes(np.zeros(n, dtype=np.int8), categories=['Endline'])
+    ability = rng.normal(0, 1, n)
+
+    knowledge = {item: _answers(rng, n, 0.8 + 0.05 * np.tanh(ability), ['Incorrect', 'Correct'])
+                 for item in knowledge_items}
+    knowledge['medications_hip'] = knowledge.pop('hip_medications')
+    knowledge_score = np.mean([answer.codes for answer in knowledge.values()], axis=0) * 100
+    nnr = {item: _answers(rng, n, 0.9, ['No', 'Yes']) for item in nnr_items}
+    nnr_score = np.sum([answer.codes for answer in nnr.values()], axis=0) * 10
+    nnr_score[rng.random(n) < 0.01] = 0
+    ratings = {item: rng.integers(1, 6, n).astype(np.int8) for item in pc_items}
+    pc_score = np.sum(list(ratings.values()), axis=0) / (5 * len(pc_items)) * 100
+    percent = lambda scores: pd.Series(scores).round(1).astype(str) + '%'
+
+    completion = lambda: pd.DataFrame({
+        'Mentee': names, 'mentee_id': mentee_id, 'County': counties, 'Facility': facilities,
+        'Status': _answers(rng, n, 0.7, ['Incomplete', 'Complete']),
+        'mentee match': _answers(rng, n, 0.95, ['Not a match', 'Match'])})
+    baseline = lambda scores: pd.DataFrame({'mentee_id': mentee_id, 'Facility': facilities,
+                                            'Score': np.clip(scores - rng.normal(12, 8, n), 0, 100).round(1)})
+    return {
+        'Knowledge': pd.DataFrame({'mentee_id': mentee_id, 'Mentee': names, 'county': counties,
+                                   'Facility': facilities, 'Survey': endline,
+                                   **knowledge, 'Score': percent(knowledge_score)}),
+        'Knowledge Pre': baseline(knowledge_score),
+        'NNR': pd.DataFrame({'Mentee': names, 'mentee_id': mentee_id, 'County': counties,
+                             'Facility': facilities, 'Survey': endline, **nnr, 'Score': nnr_score}),
+        'NNR Pre': baseline(nnr_score),
+        'Provider Confidence': pd.DataFrame({'mentee_id': mentee_id, 'County': counties, 'Facility': facilities,
+                                             'Survey': endline, **ratings, 'Score': percent(pc_score)}),
+        'PC Pre': baseline(pc_score),
+        'CME Completion': completion(),
+        'Drill Completion': completion(),
+    }
+
+# Offline stand-ins for gspread's Spreadsheet and Worksheet, serving frames from memory
+from gspread.utils import a1_to_rowcol
+
+class SyntheticWorksheet:
+    def __init__(self, title, frame, sheet_id, spreadsheet=None):
+        self.title = title
+        self.id = sheet_id
+        self.frame = frame
+        self.spreadsheet = spreadsheet
+        self.reads = 0
+
+    # Sheets grids keep their size as rows fill them, e.g. the default 1000 rows of a new sheet
+    @property
+    def row_count(self):
+        return max(len(self.frame) + 1, self.spreadsheet.grid_rows if self.spreadsheet else 0)
+
+    @property
+    def col_count(self):
+        return len(self.frame.columns)
+
+    # Cells typed like gspread's numericise, or all as text with numericise_ignore=['all']
+    def get_all_records(self, numericise_ignore=None, **kwargs):
+        self.reads += 1
+        records = self.frame.astype(str if numericise_ignore == ['all'] else object)
+        return records.where(self.frame.notna(), '').to_dict('records')
+
+    # Formatted cell values as strings, like the API; rows count from 1 with the header in row 1
+    def _values(self, first, last, first_col=1, last_col=None):
+        rows = self.frame.iloc[max(first - 2, 0):max(last - 1, 0), first_col - 1:last_col]
+        values = rows.astype(str).where(rows.notna(), '').values.tolist()
+        if first == 1:
+            values.insert(0, [str(col) for col in self.frame.columns[first_col - 1:last_col]])
+        return values
+
+    def row_values(self, row, **kwargs):
+        values = self._values(row, row)
+        return values[0] if values else []
+
+    def get_values(self, range_name=None, **kwargs):
+        if range_name is None:
+            return self._values(1, self.row_count)
+        start, end = range_name.split('!')[-1].split(':')
+        (first, first_col), (last, last_col) = a1_to_rowcol(start), a1_to_rowcol(end)
+        return self._values(first, last, first_col, last_col)
+
+    # Edits bump the spreadsheet's last update time, as they do in Drive
+    def update_cell(self, row, col, value):
+        self.frame.iloc[row - 2, col - 1] = value
+        self.spreadsheet.touch()
+
+    def append_row(self, values, **kwargs):
+        self.frame.loc[len(self.frame)] = values
+        self.spreadsheet.touch()
+
+# Worksheets added through batch_update: a fixed-size grid of raw cell values, like the output sheets
+class SyntheticGridWorksheet:
+    def __init__(self, title, sheet_id, row_count, col_count):
+        self.title = title
+        self.id = sheet_id
+        self.row_count = row_count
+        self.col_count = col_count
+        self.rows = []
+
+    # Writes past the grid fail as they do in Sheets
+    def write(self, first_row, first_col, values):
+        last_col = first_col + max(map(len, values), default=1) - 1
+        if first_row + len(values) - 1 > self.row_count or last_col > self.col_count:
+            raise gspread.exceptions.APIError(_SyntheticResponse(400))
+        while len(self.rows) < first_row + len(values) - 1:
+            self.rows.append([])
+        for row, cells in zip(self.rows[first_row - 1:], values):
+            row.extend([''] * (first_col - 1 + len(cells) - len(row)))
+            row[first_col - 1:first_col - 1 + len(cells)] = cells
+
+    # Values as the API returns them, without trailing blank rows and cells
+    def values(self):
+        rows = [_trim(row) for row in self.rows]
+        while rows and not rows[-1]:
+            rows.pop()
+        return rows
+
+# Enough of a requests.Response for gspread's APIError
+class _SyntheticResponse:
+    def __init__(self, status):
+        self.status_code = status
+        self.headers = {'Retry-After': '0'} if status == 429 else {}
+        self.text = json.dumps({'error': {'code': status, 'message': f"Synthetic {status} error", 'status': str(status)}})
+
+    def json(self):
+        return json.loads(self.text)
+
+class SyntheticSpreadsheet:
+    def __init__(self, frames, spreadsheet_id='synthetic', grid_rows=0):
+        self.id = spreadsheet_id
+        self.grid_rows = grid_rows
+        self._worksheets = {title: SyntheticWorksheet(title, frame, i, self)
+                            for i, (title, frame) in enumerate(frames.items())}
+        self.revision = 0
+        self.lastUpdateTime = None
+        # API methods called, and statuses the next calls fail with (e.g. [429, 503])
+        self.calls = []
+        self.failures = []
+        self.touch()
+
+    def touch(self):
+        self.revision += 1
+        self.lastUpdateTime = time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(self.revision))
+
+    def _request(self, method):
+        self.calls.append(method)
+        if self.failures:
+            raise gspread.exceptions.APIError(_SyntheticResponse(self.failures.pop(0)))
+
+    def worksheets(self, **kwargs):
+        self._request('worksheets')
+        return list(self._worksheets.values())
+
+    def worksheet(self, title):
+        return self._worksheets[title]
+
+    # addSheet and updateSheetProperties (grid size) requests
+    def batch_update(self, body):
+        self._request('batch_update')
+        for request in body['requests']:
+            if 'addSheet' in request:
+                properties = request['addSheet']['properties']
+                grid = properties['gridProperties']
+                sheet_id = max((ws.id for ws in self._worksheets.values()), default=-1) + 1
+                self._worksheets[properties['title']] = SyntheticGridWorksheet(
+                    properties['title'], sheet_id, grid['rowCount'], grid['columnCount'])
+            else:
+                properties = request['updateSheetProperties']['properties']
+                worksheet = next(ws for ws in self._worksheets.values() if ws.id == properties['sheetId'])
+                worksheet.row_count = properties['gridProperties']['rowCount']
+                worksheet.col_count = properties['gridProperties']['columnCount']
+        self.touch()
+        return {'replies': [{} for request in body['requests']]}
+
+    def _range(self, name):
+        title, _, cells = name.rpartition('!') if '!' in name else (name, '', '')
+        if title.startswith("'"):
+            title = title[1:-1].replace("''", "'")
+        return self._worksheets[title], cells
+
+    # Whole-worksheet ranges of the grid worksheets
+    def values_batch_get(self, ranges, params=None):
+        self._request('values_batch_get')
+        value_ranges = []
+        for name in ranges:
+            values = self._range(name)[0].values()
+            value_ranges.append({'range': name, **({'values': values} if values else {})})
+        return {'spreadsheetId': self.id, 'valueRanges': value_ranges}
+
+    def values_batch_update(self, body=None):
+        self._request('values_batch_update')
+        for value_range in body['data']:
+            worksheet, cells = self._range(value_range['range'])
+            worksheet.write(*a1_to_rowcol(cells.split(':')[0]), value_range['values'])
+        self.touch()
+        return {'spreadsheetId': self.id, 'totalUpdatedCells': sum(len(row) for value_range in body['data'] for row in value_range['values'])}
+
+# @title
+# Stage-by-stage benchmark suite
+import shutil
+from datetime import datetime, timezone
+
+RUN_BENCHMARKS = False
+BENCHMARK_SIZES = [1_000, 10_000, 100_000, 1_000_000, 10_000_000]
+BENCHMARK_RESULTS = os.path.join(SNAPSHOT_DIR, 'benchmarks.jsonl')
+# A spreadsheet holds at most 10M cells, so API-shaped ingest is only timed up to this many rows
+BENCHMARK_MAX_INGEST_ROWS = 100_000
+
+# Time and memory-profile each pipeline stage on synthetic workbooks of the given sizes.
+# tracemalloc slows allocation-heavy stages several times over, so every size is run twice:
+# wall and CPU time come from an untraced pass and peak memory from a separate traced pass
+# (memory=False skips it). The result cache is off so both passes compute every stage.
+# Records are appended as JSON lines to out_path so runs can be compared for regressions.
+def run_benchmarks(sizes=BENCHMARK_SIZES, seed=0, render=True, memory=True, out_path=BENCHMARK_RESULTS):
+    run = datetime.now(timezone.utc).isoformat(timespec='seconds')
+    bench = StageTracer(enabled=True, memory=False)
+    cache_enabled, result_cache.enabled = result_cache.enabled, False
+    try:
+        for n in sizes:
+            raw = make_synthetic_survey(n, seed)
+            timed = len(bench.records)
+            _benchmark_stages(bench, raw, n, seed, render)
+            if memory:
+                traced = StageTracer(enabled=True, memory=True)
+                _benchmark_stages(traced, raw, n, seed, render)
+                peaks = {record['stage']: record['peak_mb'] for record in traced.records}
+                for record in bench.records[timed:]:
+                    record['peak_mb'] = peaks[record['stage']]
+    finally:
+        result_cache.enabled = cache_enabled
+
+    if out_path:
+        bench.save_json(out_path, run=run)
+    return bench.to_frame().assign(run=run)
+
+def _benchmark_stages(bench, raw, n, seed, render):
+    if n <= BENCHMARK_MAX_INGEST_ROWS:
+        client = SyntheticSpreadsheet(raw, spreadsheet_id=f'synthetic-{n}-{seed}')
+        with bench.stage('ingest', n):
+            ingest_worksheets(client, refresh=True)
+        shutil.rmtree(os.path.join(SNAPSHOT_DIR, client.id), ignore_errors=True)
+
+    with bench.stage('parse', n):
+        parsed = {name: parse_worksheet(df, WORKSHEET_SCHEMAS.get(name), name)[0] for name, df in raw.items()}
+    with bench.stage('cleaning', n):
+        frames = instrument_frames_from_sheets(parsed)
+    with bench.stage('facility_aggregation', n):
+        cube = ScoreCube.build(frames, instrument_items, instrument_pass_rules)
+    with bench.stage('item_analysis', n):
+        for name, df in frames.items():
+            ResponseMatrix.from_frame(df, instrument_items[name], instrument_pass_rules[name],
+                                      groups=['Facility']).pass_counts_by('Facility')
+    with bench.stage('paired_tests', n):
+        paired_tests({'Knowledge': (parsed['Knowledge Pre'], frames['Knowledge'])}, {'Knowledge': ['Score']},
+                     levels=[(), ('County',), ('County', 'Facility')])
+    with bench.stage('correlation', n):
+        combined = CombinedScores('Endline')
+        for name, df in frames.items():
+            combined.refresh(name, df)
+        for method in ('pearson', 'spearman'):
+            combined.correlations(method)
+    if render:
+        county = str(frames['Knowledge']['County'].iloc[0])
+        chart_dir = tempfile.mkdtemp()
+        with bench.stage('rendering', n):
+            render_chart_pack(county_chart_specs(cube, county, 'Endline')[:12], chart_dir)
+        shutil.rmtree(chart_dir, ignore_errors=True)
+
+# @title
+# Run the benchmarks (slow for the largest sizes)
+if RUN_BENCHMARKS:
+    benchmark_results = run_benchmarks()
+    print(benchmark_results.pivot(index='stage', columns='rows', values='wall_s'))
+
+"""# Offline checks
+The pipeline checked end to end against SyntheticSpreadsheet, with no Sheets access
+"""
+
+# @title
+# Offline checks
+RUN_OFFLINE_CHECKS = False
+
+# Snapshots are reused until the spreadsheet changes; an edited cell or a row appended inside the
+# sheet's grid is refetched
+def check_snapshot_cache(n=500, seed=0):
+    client = SyntheticSpreadsheet(make_synthetic_survey(n, seed), spreadsheet_id='offline-snapshots', grid_rows=1000)
+    worksheet = client.worksheet('NNR')
+    try:
+        ingest_worksheets(client, names=['NNR'], refresh=True)
+        ingest_worksheets(client, names=['NNR'])
+        assert worksheet.reads == 1, 'unchanged worksheet was refetched'
+
+        worksheet.update_cell(12, worksheet.frame.columns.get_loc('Score') + 1, 10)
+        assert ingest_worksheets(client, names=['NNR'])['NNR']['Score'].iloc[10] == 10, 'edited cell read from a stale snapshot'
+        worksheet.append_row(worksheet.frame.iloc[-1].tolist())
+        assert len(ingest_worksheets(client, names=['NNR'])['NNR']) == n + 1, 'appended row read from a stale snapshot'
+        assert worksheet.reads == 3
+        assert ingest_worksheets(client, names=[]) == {}
+    finally:
+        shutil.rmtree(os.path.join(SNAPSHOT_DIR, client.id), ignore_errors=True)
+
+# Instrument frames of a synthetic workbook, parsed and cleaned like the real sheets
+def _synthetic_frames(n, seed=0):
+    raw = make_synthetic_survey(n, seed)
+    parsed = {name: parse_worksheet(df, WORKSHEET_SCHEMAS.get(name), name)[0] for name, df in raw.items()}
+    return parsed, instrument_frames_from_sheets(parsed)
+
+def _assert_same_stats(stats, expected):
+    for table, value_columns in (('moments', ['count', 'mean', 'M2']), ('histograms', ['Count']),
+                                 ('item_counts', ['Passed', 'Responses'])):
+        got, want = getattr(stats, table), getattr(expected, table)
+        keys = [col for col in want.columns if col not in value_columns]
+        got, want = (frame.sort_values(keys).reset_index(drop=True) for frame in (got, want))
+        pd.testing.assert_frame_equal(got[keys], want[keys], check_dtype=False)
+        np.testing.assert_allclose(got[value_columns].to_numpy(float), want[value_columns].to_numpy(float),
+                                   rtol=1e-9, atol=1e-6, err_msg=table)
+
+# A refresh after an edit to an already aggregated row, or to the pass rule, matches a rebuild from scratch
+def check_incremental_stats(n=3000, first=1500, seed=0):
+    frames = _synthetic_frames(n, seed)[1]
+    instrument, items, passed = 'NNR', instrument_items['NNR'], instrument_pass_rules['NNR']
+    df = frames[instrument]
+    stats = FacilityScoreStats()
+    stats.refresh(instrument, df.iloc[:first], items, passed)
+    df = df.copy()
+    df.loc[df.index[10], 'Score'] = (df['Score'].iloc[10] + 37) % 100
+    assert stats.refresh(instrument, df, items, passed) == len(df), 'edited row did not trigger a rebuild'
+    expected = FacilityScoreStats()
+    expected.update(instrument, df, items, passed)
+    _assert_same_stats(stats, expected)
+    assert stats.refresh(instrument, df, items, passed) == 0
+
+    # An edited pass rule re-counts the item passes too
+    instrument, items = 'Provider Confidence', instrument_items['Provider Confidence']
+    df = frames[instrument]
+    stats = FacilityScoreStats()
+    stats.refresh(instrument, df, items, instrument_pass_rules[instrument])
+    lenient = lambda v: v >= 3
+    assert stats.refresh(instrument, df, items, lenient) == len(df), 'edited pass rule did not trigger a rebuild'
+    expected = FacilityScoreStats()
+    expected.update(instrument, df, items, lenient)
+    _assert_same_stats(stats, expected)
+
+# Combined scores and their correlations pick up a corrected score in an earlier row
+def check_combined_refresh(n=3000, first=1500, seed=0):
+    frames = _synthetic_frames(n, seed)[1]
+    combined = CombinedScores('Endline')
+    assert combined.instruments == list(INSTRUMENTS)
+    for instrument, df in frames.items():
+        combined.refresh(instrument, df.iloc[:first])
+    df = frames['NNR'].copy()
+    df.loc[df.index[10], 'Score'] = (df['Score'].iloc[10] + 37) % 100
+    frames['NNR'] = df
+    for instrument, df in frames.items():
+        combined.refresh(instrument, df)
+    expected = CombinedScores('Endline')
+    for instrument, df in frames.items():
+        expected.upsert(instrument, df)
+    pd.testing.assert_frame_equal(combined.table.sort_index(), expected.table.sort_index())
+    pd.testing.assert_frame_equal(combined.correlations(), expected.correlations())
+
+# Answers outside an item's allowed values are reported with their sheet rows, and left blank
+def check_invalid_answers(n=200, seed=0):
+    raw = make_synthetic_survey(n, seed)['Knowledge']
+    item = 'signs_obstructed_labor'
+    raw[item] = raw[item].astype(object)
+    raw.loc[[3, 7], item] = ['Corect', 'Correct ']
+    raw.loc[9, item] = ''
+    df, report = parse_worksheet(raw, WORKSHEET_SCHEMAS['Knowledge'], 'Knowledge')
+    bad = report[report['Column'] == item]
+    assert bad['Row'].tolist() == [5, 9] and bad['Value'].tolist() == ['Corect', 'Correct '], bad
+    assert df[item].iloc[[3, 7, 9]].isna().all()
+    assert list(df[item].cat.categories) == ANSWER_CATEGORIES['correct']
+
+# The store appends new rows, and rewrites a table when an already stored row is edited
+def check_store_sync(n=2000, first=1500, seed=0):
+    df = _synthetic_frames(n, seed)[0]['NNR']
+    with tempfile.TemporaryDirectory() as tmp:
+        store = SurveyStore(os.path.join(tmp, 'store.sqlite'))
+        store.sync('NNR', df.iloc[:first])
+        assert store.sync('NNR', df) == n - first
+        df = df.copy()
+        df.loc[10, 'Score'] = (df.loc[10, 'Score'] + 37) % 100
+        assert store.sync('NNR', df) == n, 'edited row did not rewrite the table'
+        stored = store.select('NNR')
+        assert len(stored) == n and stored['Score'].iloc[10] == df['Score'].iloc[10], 'store serves the old score'
+        store.close()
+
+# Rule reports add up over the chunks of a streamed sheet, match one pass over the whole sheet, and
+# drop rows deleted from it
+def check_rule_report_chunks(n=3000, chunk_rows=1000, seed=0):
+    df = _synthetic_frames(n, seed)[0]['NNR'].copy()
+    df.loc[::73, 'Score'] = 0
+    whole = RuleEngine()
+    whole.apply('NNR', df)
+    chunked = RuleEngine()
+    kept = pd.concat([chunked.apply('NNR', df.iloc[start:start + chunk_rows])
+                      for start in range(0, n, chunk_rows)])
+    pd.testing.assert_frame_equal(chunked.report(), whole.report())
+    assert whole.report().set_index('Rule').loc['unscored', 'Violations'] == n - len(kept) > 0
+
+    # Rows deleted from the end of the sheet leave the report once the whole sheet is checked again
+    shorter = RuleEngine()
+    shorter.apply('NNR', df.iloc[:n // 2])
+    whole.apply('NNR', df.iloc[:n // 2], whole=True)
+    pd.testing.assert_frame_equal(whole.report(), shorter.report())
+
+# Streamed instruments give the same cube as the full frames, without any whole-sheet read,
+# and leave their rows in the store for the row-level cells; an edit to a middle row reaches both
+def check_streamed_cube(n=2500, chunk_rows=1000, seed=0):
+    raw = make_synthetic_survey(n, seed)
+    client = SyntheticSpreadsheet(raw, spreadsheet_id='offline-stream')
+    stats = FacilityScoreStats()
+
+    def compare(store):
+        streamed = ScoreCube.build(None, instrument_items, instrument_pass_rules, stats=stats)
+        parsed = {name: parse_worksheet(df, WORKSHEET_SCHEMAS.get(name), name)[0] for name, df in raw.items()}
+        expected_frames = instrument_frames_from_sheets(parsed, RuleEngine())
+        expected = ScoreCube.build(expected_frames, instrument_items, instrument_pass_rules)
+        pd.testing.assert_frame_equal(streamed.scores.sort_index(), expected.scores.sort_index(), check_dtype=False)
+        for name, df in instrument_frames_from_store(store, rules=RuleEngine()).items():
+            assert df.index.equals(expected_frames[name].index), f"{name}: store rows differ from the sheet"
+            pd.testing.assert_series_equal(df['Score'], expected_frames[name]['Score'], check_dtype=False)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = SurveyStore(os.path.join(tmp, 'store.sqlite'))
+        for instrument in INSTRUMENTS:
+            assert stream_instrument_stats(client, stats, instrument, chunk_rows, store=store) == n
+            assert stream_instrument_stats(client, stats, instrument, chunk_rows, store=store) == 0
+        compare(store)
+
+        worksheet = client.worksheet('NNR')
+        worksheet.update_cell(12, worksheet.frame.columns.get_loc('Score') + 1, (worksheet.frame['Score'].iloc[10] + 40) % 100)
+        list_worksheets(client, refresh=True)
+        assert stream_instrument_stats(client, stats, 'NNR', chunk_rows, store=store) == n, 'edited row was not re-read'
+        compare(store)
+        store.close()
+    assert all(client.worksheet(name).reads == 0 for name in instrument_worksheets.values()), 'a sheet was read whole'
+
+# The three service queries answer from a synthetic workbook, whose Baseline wave is only in the
+# baseline worksheets, and an unknown county, survey or facility is a KeyError naming it
+def check_query_service(n=1000, seed=0):
+    raw = make_synthetic_survey(n, seed)
+    client = SyntheticSpreadsheet(raw, spreadsheet_id='offline-service')
+    try:
+        service = SurveyService(client)
+        county = service._state['cube'].scores.index.get_level_values('County')[0]
+        summary = service.facility_summary('NNR', county, 'Endline').set_index('Facility')
+        rates = service.item_pass_rates('NNR', county, 'Endline')
+        assert list(rates.index) == list(instrument_items['NNR']) and rates['Pass rate(%)'].between(0, 100).all()
+
+        change = service.baseline_endline('NNR', county).set_index('Facility')
+        baseline = parse_worksheet(raw['NNR Pre'], WORKSHEET_SCHEMAS['NNR Pre'], 'NNR Pre')[0]
+        baseline = baseline[baseline['Facility'].isin(summary.index)]
+        assert change.loc['Overall', 'Baseline Count'] == len(baseline)
+        assert abs(change.loc['Overall', 'Baseline Mean'] - baseline['Score'].mean()) < 0.05
+        assert change.loc['Overall', 'Endline Count'] == summary.loc['Overall', 'Count']
+        assert len(service.query('baseline_endline', instrument='NNR', county=county)) == len(change)
+
+        unknown = [(service.facility_summary, ('NNR', 'Atlantis'), 'Atlantis'),
+                   (service.baseline_endline, ('NNR', 'Atlantis'), 'Atlantis'),
+                   (service.item_pass_rates, ('NNR', 'Atlantis'), 'Atlantis'),
+                   (service.item_pass_rates, ('NNR', county, 'Endlnie'), 'Endlnie'),
+                   (service.item_pass_rates, ('NNR', county, 'Endline', 'Nowhere SCH'), 'Nowhere SCH'),
+                   (service._state['cube'].distribution, ('NNR', 'Atlantis'), 'Atlantis')]
+        for query, args, value in unknown:
+            try:
+                query(*args)
+            except KeyError as e:
+                assert value in e.args[0], e.args[0]
+            else:
+                raise AssertionError(f"{query.__name__}{args} accepted an unknown value")
+        service.stop()
+    finally:
+        shutil.rmtree(os.path.join(SNAPSHOT_DIR, client.id), ignore_errors=True)
+
+# A memoized wrapper is recomputed when a helper it calls, or a constant in its body, changes, and
+# callers get copies of cached results
+def check_memoize_key():
+    cache = ResultCache(1 << 20)
+    namespace = {'__name__': 'offline_memoize', 'memoize': cache.memoize}
+    define = lambda helper, factor: exec(f"def _helper(x):\n    return x + {helper}\n"
+                                         f"@memoize\ndef scaled(x):\n    return _helper(x) * {factor}\n", namespace)
+    define(1, 2)
+    assert namespace['scaled'](1) == 4 and namespace['scaled'](1) == 4 and cache.hits == 1
+    define(2, 2)
+    assert namespace['scaled'](1) == 6, 'changed helper served from the cache'
+    define(2, 3)
+    assert namespace['scaled'](1) == 9, 'changed constant served from the cache'
+
+    # Mutating a returned dict, or a frame inside it, leaves the cached result alone
+    tables = cache.memoize(lambda n: {'scores': pd.DataFrame({'Score': [n]}), 'label': 'x'})
+    first = tables(1)
+    first['label'] = 'changed'
+    first['scores'].loc[0, 'Score'] = -1
+    assert tables(1)['label'] == 'x' and tables(1)['scores'].loc[0, 'Score'] == 1, 'cached dict was mutated'
+
+# The export writes only changed rows in a fixed number of calls, blanks the tail of a shrinking table,
+# retries rate limits and server errors, and refuses output that would overflow the spreadsheet
+def check_sheets_export(seed=0):
+    rng = np.random.default_rng(seed)
+    client = SyntheticSpreadsheet(make_synthetic_survey(200, seed), spreadsheet_id='offline-export')
+    try:
+        facilities = pd.DataFrame({'Mean': rng.normal(80, 5, 50).round(1), 'Count': rng.integers(1, 40, 50)},
+                                  index=pd.Index([f'Facility {i:05d}' for i in range(50)], name='Facility'))
+        correlations = pd.DataFrame(rng.random((3, 3)).round(3), columns=list(INSTRUMENTS),
+                                    index=pd.Index(list(INSTRUMENTS), name='Instrument'))
+        tables = {'Facility scores': facilities, 'Correlations': correlations}
+        exporter = SheetsExporter(client, backoff=0)
+
+        def export(tables, calls):
+            client.calls.clear()
+            summary = exporter.export(tables).set_index('Worksheet')['Rows written']
+            assert client.calls == calls, client.calls
+            for name, df in tables.items():
+                assert client.worksheet(EXPORT_PREFIX + name).values() == [_trim(row) for row in sheet_values(df)], name
+            return summary
+
+        export(tables, ['worksheets', 'batch_update', 'values_batch_update'])
+        assert export(tables, ['worksheets', 'values_batch_get']).sum() == 0
+        edited = facilities['Mean'].where(facilities.index != 'Facility 00007', 10.0)
+        tables['Facility scores'] = facilities.assign(Mean=edited)
+        assert export(tables, ['worksheets', 'values_batch_get', 'values_batch_update']).sum() == 1
+        tables['Correlations'] = correlations.iloc[:1]
+        client.failures = [429, 503]
+        export(tables, ['worksheets', 'worksheets', 'worksheets', 'values_batch_get', 'values_batch_update'])
+
+        client.failures = [400]
+        try:
+            exporter.export(tables)
+        except gspread.exceptions.APIError as e:
+            assert e.response.status_code == 400
+        else:
+            raise AssertionError('a 400 error was retried')
+
+        # The source worksheets' grids count towards the limit, however small the output
+        crowded = SyntheticSpreadsheet(make_synthetic_survey(20, seed), spreadsheet_id='offline-crowded',
+                                       grid_rows=SHEETS_MAX_CELLS // 20)
+        try:
+            SheetsExporter(crowded).export({'Correlations': correlations})
+        except ValueError as e:
+            assert 'cell limit' in str(e) and crowded.calls == ['worksheets'], crowded.calls
+        else:
+            raise AssertionError('an export over the spreadsheet cell limit was written')
+    finally:
+        shutil.rmtree(os.path.join(SNAPSHOT_DIR, client.id), ignore_errors=True)
+
+# Publishing into the survey spreadsheet leaves its snapshots valid, and an edit after it is still seen
+def check_export_keeps_snapshots(n=200, seed=0):
+    client = SyntheticSpreadsheet(make_synthetic_survey(n, seed), spreadsheet_id='offline-own-writes')
+    worksheet = client.worksheet('NNR')
+    try:
+        ingest_worksheets(client, names=['NNR'], refresh=True)
+        for mean in (80.0, 81.0):
+            SheetsExporter(client).export({'Facility scores': pd.DataFrame({'Mean': [mean]})})
+            ingest_worksheets(client, names=['NNR'])
+            assert worksheet.reads == 1, 'the export invalidated the survey snapshots'
+        worksheet.update_cell(12, worksheet.frame.columns.get_loc('Score') + 1, 10)
+        ingest_worksheets(client, names=['NNR'])
+        assert worksheet.reads == 2, 'an edit after the export was read from a stale snapshot'
+    finally:
+        shutil.rmtree(os.path.join(SNAPSHOT_DIR, client.id), ignore_errors=True)
+
+# Rows without a mentee_id in either wave are never paired with each other
+def check_paired_missing_ids():
+    before = pd.DataFrame({'mentee_id': [1, np.nan], 'Score': [50.0, 10.0]})
+    after = pd.DataFrame({'mentee_id': [1, np.nan], 'Score': [70.0, 90.0]})
+    long = paired_differences(before, after, ['Score'])
+    assert long['Change'].tolist() == [20.0], long
+
+# A completion row with neither ID nor name is left unmatched, rather than linked to a nameless mentee
+def check_blank_names():
+    roster = mentee_roster({'NNR': pd.DataFrame({'mentee_id': [1, 2, 2], 'Mentee': ['', '', 'Jane Doe'],
+                                                 'Facility': 'Facility 00001', 'County': 'Nairobi'})})
+    assert roster.set_index('mentee_id').loc[2, 'Mentee'] == 'Jane Doe'
+    records = pd.DataFrame({'mentee_id': [np.nan, np.nan], 'Mentee': ['', 'DOE, jane'], 'Facility': 'Facility 00001'})
+    matches = match_mentees(records, roster)
+    assert matches['Match'].tolist() == ['none', 'name'] and matches['matched_id'].iloc[1] == 2, matches
+
+OFFLINE_CHECKS = [check_snapshot_cache, check_incremental_stats, check_invalid_answers, check_store_sync,
+                  check_combined_refresh, check_rule_report_chunks, check_streamed_cube, check_query_service,
+                  check_memoize_key, check_sheets_export, check_export_keeps_snapshots, check_blank_names,
+                  check_paired_missing_ids]
+
+# @title
+# Run the offline checks
+if RUN_OFFLINE_CHECKS:
+    for check in OFFLINE_CHECKS:
+        check()
+        print(f"{check.__name__}: ok")